@@ -10,6 +10,8 @@ from sipyco.sync_struct import Subscriber, process_mod
 from sipyco import pyon
 from sipyco.pipe_ipc import AsyncioChildComm
 
+from artiq.master.sync_filter import filtered_notifier_name
+
 
 logger = logging.getLogger(__name__)
 
@@ -111,8 +113,9 @@ class SimpleApplet:
     def args_init(self):
         self.args = self.argparser.parse_args()
         self.embed = os.getenv("ARTIQ_APPLET_EMBED")
+        # Optional dataset arguments that are not given are None.
         self.datasets = {getattr(self.args, arg.replace("-", "_"))
-                         for arg in self.dataset_args}
+                         for arg in self.dataset_args} - {None}
 
     def qasync_init(self):
         app = QtWidgets.QApplication([])
@@ -197,10 +200,27 @@ class SimpleApplet:
         else:
             self.emit_data_changed(self.data, [mod])
 
+    def sub_disconnected(self):
+        if self.subscriber.notifier_name != "datasets" and not hasattr(
+                self, "data"):
+            # Masters without filtered subscriptions close the connection
+            # without sending the datasets.
+            logger.info("master does not filter datasets, "
+                        "subscribing to all datasets")
+            asyncio.ensure_future(self.subscribe_all())
+
+    async def subscribe_all(self):
+        await self.subscriber.close()
+        self.subscriber = Subscriber("datasets", self.sub_init, self.sub_mod)
+        await self.subscriber.connect(self.args.server, self.args.port)
+
     def subscribe(self):
         if self.embed is None:
-            self.subscriber = Subscriber("datasets",
-                                         self.sub_init, self.sub_mod)
+            # Only receive the datasets used by the applet from the master.
+            self.subscriber = Subscriber(
+                filtered_notifier_name("datasets", self.datasets),
+                self.sub_init, self.sub_mod,
+                disconnect_cb=self.sub_disconnected)
             self.loop.run_until_complete(self.subscriber.connect(
                 self.args.server, self.args.port))
         else:
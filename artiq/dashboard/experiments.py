@@ -164,7 +164,8 @@ class _ArgumentEditor(QtWidgets.QTreeWidget):
 
     async def _recompute_argument(self, name):
         try:
-            expdesc = await self.manager.compute_expdesc(self.expurl)
+            expdesc = await self.manager.compute_expdesc(self.expurl,
+                                                         refresh=True)
         except:
             logger.error("Could not recompute argument '%s' of '%s'",
                          name, self.expurl, exc_info=True)
@@ -391,7 +392,8 @@ class _ExperimentDock(QtWidgets.QMdiSubWindow):
 
     async def _recompute_arguments_task(self, overrides=dict()):
         try:
-            expdesc = await self.manager.compute_expdesc(self.expurl)
+            expdesc = await self.manager.compute_expdesc(self.expurl,
+                                                         refresh=True)
         except:
             logger.error("Could not recompute experiment description of '%s'",
                          self.expurl, exc_info=True)
@@ -731,14 +733,14 @@ class ExperimentManager:
                 rids.append(rid)
         asyncio.ensure_future(self._request_term_multiple(rids))
 
-    async def compute_expdesc(self, expurl):
+    async def compute_expdesc(self, expurl, refresh=False):
         file, class_name, use_repository = self.resolve_expurl(expurl)
         if use_repository:
             revision = self.get_submission_options(expurl)["repo_rev"]
         else:
             revision = None
         description = await self.experiment_db_ctl.examine(
-            file, use_repository, revision)
+            file, use_repository, revision, refresh)
         return description[class_name]
 
     async def open_file(self, file):
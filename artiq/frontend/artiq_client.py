@@ -3,7 +3,8 @@
 Client to send commands to :mod:`artiq_master` and display results locally.
 
 The client can perform actions such as accessing/setting datasets,
-scanning devices, scheduling experiments, and looking for experiments/devices.
+scanning devices, scheduling experiments, looking for experiments/devices and
+finding past runs.
 """
 
 import argparse
@@ -23,6 +24,7 @@ from sipyco.broadcast import Receiver
 from sipyco import common_args, pyon
 
 from artiq.tools import short_format, parse_arguments
+from artiq.master.sync_filter import filtered_notifier_name
 from artiq import __version__ as artiq_version
 
 
@@ -69,6 +71,12 @@ def get_argparser():
                                  "(defaults to head, ignored without -R)")
     parser_add.add_argument("-c", "--class-name", default=None,
                             help="name of the class to run")
+    parser_add.add_argument("-b", "--batch", default=None, metavar="BATCH",
+                            help="submit one run for each element of the "
+                                 "list contained in this PYON file. Each "
+                                 "element is a dictionary of run arguments "
+                                 "that override those given on the command "
+                                 "line")
     parser_add.add_argument("file", metavar="FILE",
                             help="file containing the experiment to run")
     parser_add.add_argument("arguments", metavar="ARGUMENTS", nargs="*",
@@ -105,6 +113,14 @@ def get_argparser():
         "what", metavar="WHAT",
         choices=["schedule", "log", "ccb", "devices", "datasets"],
         help="select object to show: %(choices)s")
+    parser_show.add_argument(
+        "-d", "--dataset", default=[], action="append",
+        help="only show this dataset (datasets only, may be given "
+             "several times)")
+    parser_show.add_argument(
+        "-p", "--prefix", default=[], action="append",
+        help="only show datasets whose name starts with this prefix "
+             "(datasets only, may be given several times)")
 
     subparsers.add_parser(
         "scan-devices", help="trigger a device database (re)scan")
@@ -122,6 +138,35 @@ def get_argparser():
         "ls", help="list a directory on the master")
     parser_ls.add_argument("directory", default="", nargs="?")
 
+    parser_query = subparsers.add_parser(
+        "query-results", help="find past runs in the results catalog")
+    parser_query.add_argument("-c", "--class-name", default=None,
+                              help="only show runs of this class")
+    parser_query.add_argument("-f", "--file", default=None,
+                              help="only show runs of this file")
+    parser_query.add_argument("-r", "--revision", default=None,
+                              help="only show runs of this repository "
+                                   "revision")
+    parser_query.add_argument("--since", default=None, type=str,
+                              help="only show runs started at or after "
+                                   "this date")
+    parser_query.add_argument("--until", default=None, type=str,
+                              help="only show runs started before this date")
+    parser_query.add_argument("--min-rid", default=None, type=int,
+                              help="only show runs with at least this RID")
+    parser_query.add_argument("--max-rid", default=None, type=int,
+                              help="only show runs with at most this RID")
+    parser_query.add_argument("-d", "--dataset", default=[],
+                              action="append",
+                              help="only show runs that produced this "
+                                   "dataset (may be given several times)")
+    parser_query.add_argument("--offset", default=0, type=int,
+                              help="number of matching runs to skip "
+                                   "(default: %(default)s)")
+    parser_query.add_argument("-n", "--limit", default=100, type=int,
+                              help="maximum number of runs to show "
+                                   "(default: %(default)s)")
+
     common_args.verbosity_args(parser)
     return parser
 
@@ -144,9 +189,20 @@ def _action_submit(remote, args):
         due_date = None
     else:
         due_date = time.mktime(parse_date(args.timed).timetuple())
-    rid = remote.submit(args.pipeline, expid,
-                        args.priority, due_date, args.flush)
-    print("RID: {}".format(rid))
+    if args.batch is None:
+        rid = remote.submit(args.pipeline, expid,
+                            args.priority, due_date, args.flush)
+        print("RID: {}".format(rid))
+    else:
+        expids = []
+        for batch_arguments in pyon.load_file(args.batch):
+            batch_expid = dict(expid)
+            batch_expid["arguments"] = dict(arguments, **batch_arguments)
+            expids.append(batch_expid)
+        rids = remote.submit_many(args.pipeline, expids, args.priority,
+                                  [due_date]*len(expids), args.flush)
+        if rids:
+            print("RIDs: {}-{}".format(rids[0], rids[-1]))
 
 
 def _action_delete(remote, args):
@@ -186,6 +242,35 @@ def _action_ls(remote, args):
         print(name)
 
 
+def _parse_time(date):
+    if date is None:
+        return None
+    return time.mktime(parse_date(date).timetuple())
+
+
+def _action_query_results(remote, args):
+    runs = remote.query(
+        class_name=args.class_name, file=args.file, repo_rev=args.revision,
+        min_start_time=_parse_time(args.since),
+        max_start_time=_parse_time(args.until),
+        min_rid=args.min_rid, max_rid=args.max_rid, datasets=args.dataset,
+        offset=args.offset, limit=args.limit)
+    table = PrettyTable(["RID", "Start time", "Revision", "Class name",
+                         "Path", "Datasets"])
+    table.align["Datasets"] = "l"
+    for run in runs:
+        datasets = ", ".join(
+            k if v is None else "{}={}".format(k, short_format(v))
+            for k, v in sorted(run["datasets"].items(), key=itemgetter(0))
+            if not args.dataset or k in args.dataset)
+        table.add_row([run["rid"],
+                       time.strftime("%Y-%m-%d %H:%M:%S",
+                                     time.localtime(run["start_time"])),
+                       run["repo_rev"] or "", run["class_name"] or "",
+                       run["path"], datasets])
+    print(table)
+
+
 def _show_schedule(schedule):
     clear_screen()
     if schedule:
@@ -297,7 +382,12 @@ def main():
         elif args.what == "devices":
             _show_dict(args, "devices", _show_devices)
         elif args.what == "datasets":
-            _show_dict(args, "datasets", _show_datasets)
+            if args.dataset or args.prefix:
+                notifier_name = filtered_notifier_name(
+                    "datasets", args.dataset, args.prefix)
+            else:
+                notifier_name = "datasets"
+            _show_dict(args, notifier_name, _show_datasets)
         else:
             raise ValueError
     else:
@@ -309,7 +399,8 @@ def main():
             "del_dataset": "master_dataset_db",
             "scan_devices": "master_device_db",
             "scan_repository": "master_experiment_db",
-            "ls": "master_experiment_db"
+            "ls": "master_experiment_db",
+            "query_results": "master_results"
         }[action]
         remote = Client(args.server, port, target_name)
         try:
@@ -10,7 +10,7 @@ import sys
 from PyQt5 import QtCore, QtGui, QtWidgets
 from qasync import QEventLoop
 
-from sipyco.pc_rpc import AsyncioClient, Client
+from sipyco.pc_rpc import AsyncioClient, Client, IncompatibleServer
 from sipyco.broadcast import Receiver
 from sipyco import common_args
 from sipyco.asyncio_tools import atexit_register_coroutine
@@ -142,8 +142,18 @@ def main():
         atexit_register_coroutine(subscriber.close)
         sub_clients[notifier_name] = subscriber
 
+    # Masters without the log backlog only send individual log records.
+    try:
+        log_backlog = Client(args.server, args.port_control, "master_log")
+    except IncompatibleServer:
+        logging.warning("master does not keep a log backlog")
+        log_backlog = None
+        log_target = "log"
+    else:
+        log_target = "log_batch"
+
     broadcast_clients = dict()
-    for target in "log", "ccb":
+    for target in log_target, "ccb":
         client = Receiver(target, [], report_disconnect)
         loop.run_until_complete(client.connect(
             args.server, args.port_broadcast))
@@ -193,7 +203,22 @@ def main():
 
     logmgr = log.LogDockManager(main_window)
     smgr.register(logmgr)
-    broadcast_clients["log"].notify_cbs.append(logmgr.append_message)
+    if log_backlog is None:
+        broadcast_clients["log"].notify_cbs.append(logmgr.append_message)
+    else:
+        try:
+            last_seq, backlog = log_backlog.get()
+        finally:
+            log_backlog.close_rpc()
+        for msg in backlog:
+            logmgr.append_message(msg)
+        def append_log_batch(batch):
+            seq, records = batch
+            # Skip the batches received before the backlog was requested.
+            if seq > last_seq:
+                for msg in records:
+                    logmgr.append_message(msg)
+        broadcast_clients["log_batch"].notify_cbs.append(append_log_batch)
     widget_log_handler.callback = logmgr.append_message
 
     # lay out docks
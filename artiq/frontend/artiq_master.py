@@ -7,17 +7,21 @@ import os
 import logging
 
 from sipyco.pc_rpc import Server as RPCServer
-from sipyco.sync_struct import Publisher
 from sipyco.logging_tools import Server as LoggingServer
 from sipyco.broadcast import Broadcaster
 from sipyco import common_args
 from sipyco.asyncio_tools import atexit_register_coroutine
 
 from artiq import __version__ as artiq_version
-from artiq.master.log import log_args, init_log
+from artiq.master.log import log_args, init_log, LogBacklog
+from artiq.master.sync_filter import FilteredPublisher
+from artiq.master.sync_coalesce import CoalescedNotifier
 from artiq.master.databases import DeviceDB, DatasetDB
 from artiq.master.scheduler import Scheduler
+from artiq.master.metrics import MetricsServer
+from artiq.master.worker import WorkerPool
 from artiq.master.rid_counter import RIDCounter
+from artiq.master.results_catalog import ResultsDB
 from artiq.master.experiments import (FilesystemBackend, GitBackend,
                                       ExperimentDB)
 
@@ -34,7 +38,8 @@ def get_argparser():
         ("notify", "notifications", 3250),
         ("control", "control", 3251),
         ("logging", "remote logging", 1066),
-        ("broadcast", "broadcasts", 1067)
+        ("broadcast", "broadcasts", 1067),
+        ("metrics", "plain-text scheduler metrics (HTTP)", 3276)
     ])
 
     group = parser.add_argument_group("databases")
@@ -42,14 +47,103 @@ def get_argparser():
                        help="device database file (default: '%(default)s')")
     group.add_argument("--dataset-db", default="dataset_db.pyon",
                        help="dataset file (default: '%(default)s')")
+    group.add_argument("--dataset-db-journal", default=False,
+                       action="store_true",
+                       help="append modifications of persisted datasets to "
+                            "a journal instead of periodically rewriting "
+                            "the whole dataset file")
+    group.add_argument("--dataset-db-sidecar-threshold", default=None,
+                       type=int,
+                       help="save persisted NumPy arrays of at least this "
+                            "many bytes as memory-mapped binary files next "
+                            "to the dataset file (default: disabled)")
 
     group = parser.add_argument_group("repository")
     group.add_argument(
         "-g", "--git", default=False, action="store_true",
         help="use the Git repository backend")
+    group.add_argument(
+        "--git-shared-store", default=False, action="store_true",
+        help="hard-link files that are identical across checked out "
+             "revisions to a single copy. Checked out files are then "
+             "read-only, and must not be modified by experiments "
+             "(Git backend only)")
+    group.add_argument(
+        "--git-keep-checkouts", default=0, type=int,
+        help="number of unused checked out revisions to keep for reuse "
+             "(Git backend only, default: %(default)d)")
     group.add_argument(
         "-r", "--repository", default="repository",
         help="path to the repository (default: '%(default)s')")
+    group.add_argument(
+        "--scan-cache", default=None,
+        help="file in which to cache the results of examining experiment "
+             "files, so that rescans only examine files that changed. "
+             "Changes to imported modules or to datasets read while "
+             "examining are not detected (default: no cache)")
+    group.add_argument(
+        "--scan-workers", default=1, type=int,
+        help="number of workers examining experiment files in parallel "
+             "during repository scans (default: %(default)d)")
+
+    group = parser.add_argument_group("workers")
+    group.add_argument(
+        "--worker-pool-size", default=0, type=int,
+        help="number of worker processes to spawn in advance, so that runs "
+             "and repository scans do not wait for them to start "
+             "(default: %(default)d)")
+    group.add_argument(
+        "--worker-reuse", default=False, action="store_true",
+        help="keep the worker processes of completed runs for later runs, "
+             "along with the local devices marked as reusable in the "
+             "device database. Kept processes count towards "
+             "--worker-pool-size, which must be at least 1")
+    group.add_argument(
+        "--worker-ipc", default="pyon", choices=["pyon", "binary"],
+        help="encoding of the messages exchanged with worker processes. "
+             "'binary' sends NumPy arrays as raw buffers "
+             "(default: %(default)s)")
+    group.add_argument(
+        "--dataset-batch-period", default=None, type=float,
+        help="coalesce the modifications of broadcast datasets made by "
+             "experiments and send them to the master at most this many "
+             "seconds late, or at the next request to the master or stage "
+             "boundary (default: send immediately)")
+    group.add_argument(
+        "--dataset-batch-size", default=256, type=int,
+        help="maximum number of dataset modifications held back by an "
+             "experiment when batching (default: %(default)d)")
+    group.add_argument(
+        "--worker-trace-parent-actions", default=False, action="store_true",
+        help="save the start time and duration of each request made by "
+             "experiments to the master in the results, in addition to "
+             "the per-request totals")
+
+    group = parser.add_argument_group("scheduler")
+    group.add_argument(
+        "--prepare-ahead", default=[], action="append",
+        metavar="[PIPELINE=]NUMBER",
+        help="number of pending runs that are built and prepared "
+             "concurrently while the current run executes, for all "
+             "pipelines or for the given pipeline. Can be used several "
+             "times (default: 1)")
+    group.add_argument(
+        "--analyze-concurrency", default=[], action="append",
+        metavar="[PIPELINE=]NUMBER",
+        help="number of completed runs that are analyzed concurrently, for "
+             "all pipelines or for the given pipeline. Can be used several "
+             "times (default: 1)")
+    group.add_argument(
+        "--analyze-backlog", default=None, type=int,
+        help="do not start new runs in a pipeline while this many "
+             "completed runs wait for analysis (default: no limit, i.e. "
+             "runs are never held back and completed runs can pile up "
+             "while analysis is slower than the run stage)")
+    group.add_argument(
+        "--schedule-coalesce-period", default=None, type=float,
+        help="send the changes of each run to schedule subscribers at most "
+             "this many seconds late, merging successive status changes "
+             "(default: send immediately)")
 
     log_args(parser)
 
@@ -60,6 +154,21 @@ def get_argparser():
     return parser
 
 
+def parse_pipeline_option(values):
+    default = 1
+    pipelines = dict()
+    for value in values:
+        pipeline, sep, number = value.rpartition("=")
+        number = int(number)
+        if number < 1:
+            raise ValueError("number of runs must be at least 1")
+        if sep:
+            pipelines[pipeline] = number
+        else:
+            default = number
+    return default, pipelines
+
+
 class MasterConfig:
     def __init__(self, name):
         self.name = name
@@ -69,7 +178,11 @@ class MasterConfig:
 
 
 def main():
-    args = get_argparser().parse_args()
+    parser = get_argparser()
+    args = parser.parse_args()
+    if args.worker_reuse and args.worker_pool_size < 1:
+        parser.error("--worker-reuse requires a --worker-pool-size "
+                     "of at least 1")
     log_forwarder = init_log(args)
     if os.name == "nt":
         loop = asyncio.ProactorEventLoop()
@@ -86,6 +199,10 @@ def main():
 
     log_forwarder.callback = (lambda msg:
         server_broadcast.broadcast("log", msg))
+    log_forwarder.batch_callback = (lambda batch:
+        server_broadcast.broadcast("log_batch", batch))
+    log_forwarder.start()
+    atexit_register_coroutine(log_forwarder.stop)
     def ccb_issue(service, *args, **kwargs):
         msg = {
             "service": service,
@@ -95,21 +212,53 @@ def main():
         server_broadcast.broadcast("ccb", msg)
 
     device_db = DeviceDB(args.device_db)
-    dataset_db = DatasetDB(args.dataset_db)
+    dataset_db = DatasetDB(
+        args.dataset_db, journal=args.dataset_db_journal,
+        sidecar_threshold=args.dataset_db_sidecar_threshold)
     dataset_db.start()
     atexit_register_coroutine(dataset_db.stop)
     worker_handlers = dict()
+    if args.dataset_batch_period is None:
+        dataset_batching = None
+    else:
+        dataset_batching = (args.dataset_batch_period,
+                            args.dataset_batch_size)
+    worker_pool = WorkerPool(worker_handlers, args.worker_pool_size,
+                             args.worker_ipc, dataset_batching,
+                             args.worker_trace_parent_actions,
+                             args.worker_reuse)
+    worker_pool.start()
+    atexit_register_coroutine(worker_pool.close)
 
     if args.git:
-        repo_backend = GitBackend(args.repository)
+        repo_backend = GitBackend(args.repository, args.git_shared_store,
+                                  args.git_keep_checkouts)
     else:
         repo_backend = FilesystemBackend(args.repository)
-    experiment_db = ExperimentDB(repo_backend, worker_handlers)
+    experiment_db = ExperimentDB(repo_backend, worker_handlers, worker_pool,
+                                 args.scan_cache, args.scan_workers)
     atexit.register(experiment_db.close)
 
-    scheduler = Scheduler(RIDCounter(), worker_handlers, experiment_db)
+    prepare_ahead, pipeline_prepare_ahead = parse_pipeline_option(
+        args.prepare_ahead)
+    analyze_concurrency, pipeline_analyze_concurrency = \
+        parse_pipeline_option(args.analyze_concurrency)
+    scheduler = Scheduler(RIDCounter(), worker_handlers, experiment_db,
+                          worker_pool, prepare_ahead, pipeline_prepare_ahead,
+                          analyze_concurrency, pipeline_analyze_concurrency,
+                          args.analyze_backlog)
     scheduler.start()
     atexit_register_coroutine(scheduler.stop)
+    scheduler.metrics.start()
+    atexit_register_coroutine(scheduler.metrics.stop)
+    if args.schedule_coalesce_period is None:
+        schedule_notifier = scheduler.notifier
+    else:
+        schedule_coalescer = CoalescedNotifier(scheduler.notifier,
+                                               args.schedule_coalesce_period)
+        schedule_coalescer.start()
+        atexit_register_coroutine(schedule_coalescer.stop)
+        schedule_notifier = schedule_coalescer.notifier
 
     config = MasterConfig(args.name)
 
@@ -119,6 +268,7 @@ def main():
         "get_dataset": dataset_db.get,
         "update_dataset": dataset_db.update,
         "scheduler_submit": scheduler.submit,
+        "scheduler_submit_many": scheduler.submit_many,
         "scheduler_delete": scheduler.delete,
         "scheduler_request_termination": scheduler.request_termination,
         "scheduler_get_status": scheduler.get_status,
@@ -132,23 +282,32 @@ def main():
         "master_device_db": device_db,
         "master_dataset_db": dataset_db,
         "master_schedule": scheduler,
-        "master_experiment_db": experiment_db
+        "master_experiment_db": experiment_db,
+        "master_results": ResultsDB(),
+        "master_log": LogBacklog(log_forwarder)
     }, allow_parallel=True)
     loop.run_until_complete(server_control.start(
         bind, args.port_control))
     atexit_register_coroutine(server_control.stop)
 
-    server_notify = Publisher({
-        "schedule": scheduler.notifier,
+    server_notify = FilteredPublisher({
+        "schedule": schedule_notifier,
         "devices": device_db.data,
         "datasets": dataset_db.data,
         "explist": experiment_db.explist,
-        "explist_status": experiment_db.status
-    })
+        "explist_status": experiment_db.status,
+        "worker_pool": worker_pool.stats,
+        "scheduler_metrics": scheduler.metrics.notifier
+    }, filterable=["datasets"])
     loop.run_until_complete(server_notify.start(
         bind, args.port_notify))
     atexit_register_coroutine(server_notify.stop)
 
+    server_metrics = MetricsServer(scheduler.metrics.format_text)
+    loop.run_until_complete(server_metrics.start(
+        bind, args.port_metrics))
+    atexit_register_coroutine(server_metrics.stop)
+
     server_logging = LoggingServer()
     loop.run_until_complete(server_logging.start(
         bind, args.port_logging))
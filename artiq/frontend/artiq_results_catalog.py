@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from sipyco import common_args
+
+from artiq.master.results_catalog import ResultsCatalog
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(
+        description="ARTIQ results catalog management tool")
+    common_args.verbosity_args(parser)
+    parser.add_argument("-r", "--results", default="results",
+                        help="results directory (default: '%(default)s')")
+
+    subparsers = parser.add_subparsers(dest="action")
+    subparsers.required = True
+    subparsers.add_parser(
+        "rebuild", help="recreate the catalog from the result files")
+
+    return parser
+
+
+def main():
+    args = get_argparser().parse_args()
+    common_args.init_logger_from_args(args)
+
+    catalog = ResultsCatalog(args.results)
+    if args.action == "rebuild":
+        n = catalog.rebuild()
+        print("Recorded {} result files in {}".format(n, catalog.path))
+
+
+if __name__ == "__main__":
+    main()
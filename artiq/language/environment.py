@@ -331,7 +331,8 @@ class HasEnvironment:
 
     @rpc(flags={"async"})
     def set_dataset(self, key, value,
-                    broadcast=False, persist=False, archive=True, save=None):
+                    broadcast=False, persist=False, archive=True, save=None,
+                    stream=False):
         """Sets the contents and handling modes of a dataset.
 
         Datasets must be scalars (``bool``, ``int``, ``float`` or NumPy scalar)
@@ -344,12 +345,21 @@ class HasEnvironment:
         :param archive: the data is saved into the local storage of the current
             run (archived as a HDF5 file).
         :param save: deprecated.
+        :param stream: when archiving, the data is written to the HDF5 file
+            of the run as it is appended to, instead of at the end of the run.
+            Only the most recent elements are kept in memory and returned by
+            :meth:`get_dataset`. The value must be a list or NumPy array whose
+            elements all have the same type and shape; strings can have any
+            length. Until the end of the run, the datasets are in a separate
+            ``.h5.part`` file, which is kept if the results cannot be
+            written. Cannot be combined with ``broadcast`` or ``persist``, as
+            the master needs the whole value.
         """
         if save is not None:
             warnings.warn("set_dataset save parameter is deprecated, "
                           "use archive instead", FutureWarning)
             archive = save
-        self.__dataset_mgr.set(key, value, broadcast, persist, archive)
+        self.__dataset_mgr.set(key, value, broadcast, persist, archive, stream)
 
     @rpc(flags={"async"})
     def mutate_dataset(self, key, index, value):
@@ -430,6 +440,13 @@ class Experiment:
     Deriving from this class enables automatic experiment discovery in
     Python modules.
     """
+    #: If true, the analyze stage of this experiment is not run concurrently
+    #: with that of other runs of the same pipeline: it starts once the
+    #: analyses in progress have completed (see :meth:`analyze`). Runs
+    #: waiting for analysis are still taken in priority order, not in order
+    #: of completion.
+    analyze_ordered = False
+
     def prepare(self):
         """Entry point for pre-computing data necessary for running the
         experiment.
@@ -465,6 +482,10 @@ class Experiment:
         algorithm on pre-existing data, and CPU-bound analyses to be run
         overlapped with the next experiment in a pipelined manner.
 
+        The master may analyze several runs of a pipeline concurrently.
+        Experiments whose analysis depends on that of previous runs (e.g.
+        through datasets) should set :attr:`analyze_ordered`.
+
         This method must not interact with the hardware.
         """
         pass
@@ -1,11 +1,19 @@
 import asyncio
+import logging
+import os
 import tokenize
+import uuid
+
+import numpy as np
 
 from sipyco.sync_struct import Notifier, process_mod, update_from_dict
 from sipyco import pyon
 from sipyco.asyncio_tools import TaskObject
 
 
+logger = logging.getLogger(__name__)
+
+
 def device_db_from_file(filename):
     glbs = dict()
     with tokenize.open(filename) as f:
@@ -33,34 +41,243 @@ class DeviceDB:
         return desc
 
 
+_SIDECAR = "__sidecar__"
+
+
+def _is_sidecar(value):
+    return (isinstance(value, dict) and len(value) == 1
+            and isinstance(value.get(_SIDECAR), str))
+
+
+def _mod_key(mod):
+    return mod["path"][0] if mod["path"] else mod["key"]
+
+
+def _file_id(filename):
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
 class DatasetDB(TaskObject):
-    def __init__(self, persist_file, autosave_period=30):
+    """Dataset database, persisting datasets to ``persist_file``.
+
+    By default, all persisted datasets are rewritten to the file every
+    ``autosave_period`` seconds. In journal mode, the modifications of
+    persisted datasets are instead appended to ``persist_file + ".journal"``
+    as they happen, and the journal is compacted into ``persist_file`` when
+    it has grown larger than that file (and ``journal_min_compact`` bytes),
+    and on shutdown.
+
+    The first line of the journal identifies the version of ``persist_file``
+    it applies to, so that a journal left behind by an interrupted compaction
+    is discarded rather than replayed twice. A truncated or corrupted tail
+    (e.g. after a crash) is dropped when the journal is replayed.
+
+    If ``sidecar_threshold`` is set, persisted datasets that are NumPy
+    arrays of at least that many bytes are saved as ``.npy`` files in the
+    ``persist_file + ".arrays"`` directory instead of as PYON text, and are
+    memory-mapped on load. Such a file is only written again when its dataset
+    has been modified. Arrays found in that directory are loaded regardless
+    of ``sidecar_threshold``.
+    """
+    def __init__(self, persist_file, autosave_period=30, journal=False,
+                 journal_min_compact=1024*1024, sidecar_threshold=None):
         self.persist_file = persist_file
         self.autosave_period = autosave_period
+        self.journal_file = persist_file + ".journal"
+        self.journal = journal
+        self.journal_min_compact = journal_min_compact
+        self.sidecar_dir = persist_file + ".arrays"
+        self.sidecar_threshold = sidecar_threshold
 
         try:
             file_data = pyon.load_file(self.persist_file)
         except FileNotFoundError:
             file_data = dict()
-        self.data = Notifier({k: (True, v) for k, v in file_data.items()})
+        self._sidecars = dict()
+        self._dirty = set()
+        data = dict()
+        for k, v in file_data.items():
+            if _is_sidecar(v):
+                name = v[_SIDECAR]
+                try:
+                    v = self._load_sidecar(name)
+                except:
+                    logger.error("failed to load dataset '%s' from '%s'",
+                                 k, name, exc_info=True)
+                    continue
+                self._sidecars[k] = name
+            data[k] = (True, v)
+        self._journal_f = None
+        self._journal_size = self._replay_journal(data)
+        self.data = Notifier({k: v for k, v in data.items() if v[0]})
+        if self.journal and self._journal_size is None:
+            self._start_journal()
+
+    def _replay_journal(self, data):
+        try:
+            with open(self.journal_file, "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+
+        end = content.find(b"\n")
+        try:
+            header = pyon.decode(content[:end].decode())
+            valid = end >= 0 and header["base"] == _file_id(self.persist_file)
+        except:
+            valid = False
+        if not valid:
+            logger.warning("discarding dataset journal '%s' that does not "
+                           "match '%s'", self.journal_file, self.persist_file)
+            os.unlink(self.journal_file)
+            return None
+
+        good = end + 1
+        count = 0
+        while True:
+            end = content.find(b"\n", good)
+            if end < 0:
+                break
+            try:
+                mod = pyon.decode(content[good:end].decode())
+                process_mod(data, mod)
+                self._dirty.add(_mod_key(mod))
+            except:
+                logger.warning("failed to replay dataset journal entry",
+                               exc_info=True)
+                break
+            good = end + 1
+            count += 1
+        if good != len(content):
+            logger.warning("dropping %d bytes at the end of dataset "
+                           "journal '%s'", len(content) - good,
+                           self.journal_file)
+            with open(self.journal_file, "r+b") as f:
+                f.truncate(good)
+        logger.debug("replayed %d dataset journal entries", count)
+        return good
+
+    def _start_journal(self):
+        if self._journal_f is not None:
+            self._journal_f.close()
+        header = pyon.encode({"base": _file_id(self.persist_file)}) + "\n"
+        self._journal_f = open(self.journal_file, "w")
+        self._journal_f.write(header)
+        self._journal_f.flush()
+        self._journal_size = len(header)
+
+    def _write_journal(self, mod):
+        if self._journal_f is None:
+            self._journal_f = open(self.journal_file, "a")
+        line = pyon.encode(mod) + "\n"
+        self._journal_f.write(line)
+        self._journal_f.flush()
+        self._journal_size += len(line)
+
+    def _close_journal(self):
+        if self._journal_f is not None:
+            self._journal_f.close()
+            self._journal_f = None
+
+    def _load_sidecar(self, name):
+        # Copy-on-write mapping: in-place modifications of the dataset never
+        # reach the file, which is rewritten under a new name on save.
+        array = np.load(os.path.join(self.sidecar_dir, name),
+                        mmap_mode="c", allow_pickle=False)
+        return array.view(np.ndarray)
+
+    def _use_sidecar(self, value):
+        return (self.sidecar_threshold is not None
+                and isinstance(value, np.ndarray)
+                and not value.dtype.hasobject
+                and value.nbytes > 0
+                and value.nbytes >= self.sidecar_threshold)
+
+    def _write_sidecar(self, value):
+        os.makedirs(self.sidecar_dir, exist_ok=True)
+        name = uuid.uuid4().hex + ".npy"
+        np.save(os.path.join(self.sidecar_dir, name), value,
+                allow_pickle=False)
+        return name
+
+    def _remove_unused_sidecars(self):
+        try:
+            names = os.listdir(self.sidecar_dir)
+        except FileNotFoundError:
+            return
+        used = set(self._sidecars.values())
+        for name in names:
+            if name.endswith(".npy") and name not in used:
+                try:
+                    os.unlink(os.path.join(self.sidecar_dir, name))
+                except OSError:
+                    # e.g. still mapped on Windows; retried on next save
+                    logger.debug("failed to remove '%s'", name,
+                                 exc_info=True)
 
     def save(self):
-        data = {k: v[1] for k, v in self.data.raw_view.items() if v[0]}
+        data = dict()
+        sidecars = dict()
+        for k, (persist, v) in self.data.raw_view.items():
+            if not persist:
+                continue
+            if self._use_sidecar(v):
+                name = self._sidecars.get(k)
+                if name is None or k in self._dirty:
+                    name = self._write_sidecar(v)
+                sidecars[k] = name
+                v = {_SIDECAR: name}
+            data[k] = v
         pyon.store_file(self.persist_file, data)
+        self._sidecars = sidecars
+        self._dirty.clear()
+        self._remove_unused_sidecars()
+        if self.journal:
+            self._start_journal()
+        elif self._journal_size is not None:
+            self._close_journal()
+            os.unlink(self.journal_file)
+            self._journal_size = None
+
+    def _compact_due(self):
+        try:
+            base_size = os.path.getsize(self.persist_file)
+        except FileNotFoundError:
+            base_size = 0
+        return self._journal_size > max(base_size, self.journal_min_compact)
 
     async def _do(self):
         try:
             while True:
                 await asyncio.sleep(self.autosave_period)
-                self.save()
+                if not self.journal or self._compact_due():
+                    self.save()
         finally:
             self.save()
+            self._close_journal()
 
     def get(self, key):
         return self.data.raw_view[key][1]
 
     def update(self, mod):
+        key = _mod_key(mod)
+        entry = self.data.raw_view.get(key)
+        persisted_before = entry is not None and entry[0]
         process_mod(self.data, mod)
+        self._dirty.add(key)
+        if not self.journal:
+            return
+        entry = self.data.raw_view.get(key)
+        persisted_after = entry is not None and entry[0]
+        if persisted_before:
+            self._write_journal(mod)
+        elif persisted_after:
+            self._write_journal({"action": "setitem", "path": [],
+                                 "key": key, "value": entry})
 
     # convenience functions (update() can be used instead)
     def set(self, key, value, persist=None):
@@ -69,8 +286,9 @@ class DatasetDB(TaskObject):
                 persist = self.data.raw_view[key][0]
             else:
                 persist = False
-        self.data[key] = (persist, value)
+        self.update({"action": "setitem", "path": [], "key": key,
+                     "value": (persist, value)})
 
     def delete(self, key):
-        del self.data[key]
+        self.update({"action": "delitem", "path": [], "key": key})
     #
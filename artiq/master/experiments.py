@@ -4,10 +4,16 @@ import tempfile
 import shutil
 import time
 import logging
+import hashlib
+import stat
+import copy
+from collections import OrderedDict
 
 from sipyco.sync_struct import Notifier, update_from_dict
+from sipyco import pyon
 
-from artiq.master.worker import (Worker, WorkerInternalException,
+from artiq import __version__ as artiq_version
+from artiq.master.worker import (WorkerPool, WorkerInternalException,
                                  log_worker_exception)
 from artiq.tools import get_windows_drives, exc_to_warning
 
@@ -15,19 +21,194 @@ from artiq.tools import get_windows_drives, exc_to_warning
 logger = logging.getLogger(__name__)
 
 
-class _RepoScanner:
-    def __init__(self, worker_handlers):
-        self.worker_handlers = worker_handlers
-        self.worker = None
+def _blob_id(data):
+    # Same as the Git blob ID of a file with these contents.
+    h = hashlib.sha1()
+    h.update("blob {}\0".format(len(data)).encode())
+    h.update(data)
+    return h.hexdigest()
+
+
+class _ScanCache:
+    """Persistent cache of the descriptions obtained by examining
+    experiment files during repository scans.
 
-    async def process_file(self, entry_dict, root, filename):
-        logger.debug("processing file %s %s", root, filename)
+    Entries are keyed by the path of the file relative to the repository
+    root and by the Git blob ID of its contents. The whole cache is
+    discarded when the ARTIQ version changes. Only the entries used during
+    the last scan are kept when saving.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._entries = dict()
+        self._used = dict()
         try:
-            description = await self.worker.examine(
-                "scan", os.path.join(root, filename))
+            data = pyon.load_file(self.filename)
+            version, entries = data["artiq_version"], data["entries"]
+            if not isinstance(entries, dict):
+                raise TypeError("invalid cache entries")
+        except FileNotFoundError:
+            return
         except:
-            log_worker_exception()
-            raise
+            logger.warning("failed to load repository scan cache, ignoring",
+                           exc_info=True)
+            return
+        if version == artiq_version:
+            self._entries = entries
+        else:
+            logger.info("ARTIQ version changed, discarding repository "
+                        "scan cache")
+
+    def get(self, filename, blob_id):
+        entry = self._entries.get(filename, None)
+        if entry is None or entry["blob_id"] != blob_id:
+            return None
+        self._used[filename] = entry
+        return entry["description"]
+
+    def set(self, filename, blob_id, description):
+        entry = {"blob_id": blob_id, "description": description}
+        self._entries[filename] = entry
+        self._used[filename] = entry
+
+    def save(self):
+        self._entries, self._used = self._used, dict()
+        pyon.store_file(self.filename, {
+            "artiq_version": artiq_version,
+            "entries": self._entries
+        })
+
+
+def _dataset_id(value):
+    if value is None:
+        return None
+    return _blob_id(pyon.encode(value[0]).encode())
+
+
+class ExamineCache:
+    """In-memory cache of the descriptions obtained by examining experiment
+    files, e.g. when recomputing the arguments of an experiment.
+
+    Entries are keyed by the path of the file, the repository revision and
+    the Git blob ID of the file contents. Each entry also records the
+    datasets read during examination (through ``get_dataset`` requests of
+    the worker), and is only used if the values returned by
+    ``get_dataset`` for these keys are still the same, and if the device
+    database returned by ``get_device_db`` is unchanged. Changes to modules
+    imported by the file are not detected, so the cache should only be used
+    for files of revisions that cannot change, e.g. Git revisions.
+
+    At most ``size`` entries are kept, discarding the least recently used
+    ones first.
+    """
+    def __init__(self, get_dataset, get_device_db, size=64):
+        self.get_dataset = get_dataset
+        self.get_device_db = get_device_db
+        self.size = size
+        self._entries = OrderedDict()
+
+    def _datasets_unchanged(self, datasets):
+        for key, dataset_id in datasets.items():
+            try:
+                value = (self.get_dataset(key), )
+            except KeyError:
+                value = None
+            if _dataset_id(value) != dataset_id:
+                return False
+        return True
+
+    async def examine(self, new_worker, filename, revision=None,
+                      refresh=False):
+        """Returns the description of the experiments in ``filename``,
+        examining it in a worker obtained by calling ``new_worker`` unless a
+        valid cache entry exists. If ``refresh`` is true, the file is always
+        examined again, e.g. when the user explicitly asks for it."""
+        with open(filename, "rb") as f:
+            key = (filename, revision, _blob_id(f.read()),
+                   _blob_id(pyon.encode(self.get_device_db()).encode()))
+        entry = self._entries.pop(key, None)
+        if entry is not None and not refresh:
+            datasets, description = entry
+            if self._datasets_unchanged(datasets):
+                logger.debug("using cached description of %s", filename)
+                self._entries[key] = entry
+                return copy.deepcopy(description)
+
+        datasets_read = dict()
+        worker = new_worker()
+        try:
+            description = await worker.examine("examine", filename,
+                                               datasets_read=datasets_read)
+        finally:
+            await worker.close()
+        datasets = {k: _dataset_id(v) for k, v in datasets_read.items()}
+        self._entries[key] = datasets, copy.deepcopy(description)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return description
+
+    def clear(self):
+        self._entries.clear()
+
+
+class _RepoScanner:
+    """Examines the experiment files of a repository using up to
+    ``concurrency`` workers in parallel.
+
+    The experiment list is assembled from the examination results in sorted
+    path order, so that renaming of duplicate experiment names does not
+    depend on which worker finishes first.
+    """
+    def __init__(self, worker_pool, cache=None, concurrency=1):
+        self.worker_pool = worker_pool
+        self.cache = cache
+        self.concurrency = concurrency
+        self.workers = []
+
+    async def _examine(self, i, root, filename):
+        path = os.path.join(root, filename)
+        if self.cache is not None:
+            with open(path, "rb") as f:
+                blob_id = _blob_id(f.read())
+            description = self.cache.get(filename, blob_id)
+            if description is not None:
+                logger.debug("using cached description of %s", filename)
+                return description
+        if self.workers[i] is None:
+            self.workers[i] = self.worker_pool.get()
+        description = await self.workers[i].examine("scan", path)
+        if self.cache is not None:
+            self.cache.set(filename, blob_id, description)
+        return description
+
+    async def _process_files(self, i, root, queue, descriptions):
+        while True:
+            try:
+                filename = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            logger.debug("processing file %s %s", root, filename)
+            try:
+                try:
+                    descriptions[filename] = await self._examine(
+                        i, root, filename)
+                except:
+                    log_worker_exception()
+                    raise
+            except Exception as exc:
+                logger.warning("Skipping file '%s'", filename,
+                    exc_info=not isinstance(exc, WorkerInternalException))
+                # restart worker
+                if self.workers[i] is not None:
+                    await self.workers[i].close()
+                    self.workers[i] = None
+
+    def _add_entries(self, entry_dict, filename, description):
+        subdir = os.path.dirname(filename)
+        if subdir:
+            prefix = "/".join(subdir.split(os.path.sep)) + "/"
+        else:
+            prefix = ""
         for class_name, class_desc in description.items():
             name = class_desc["name"]
             arginfo = class_desc["arginfo"]
@@ -35,10 +216,10 @@ class _RepoScanner:
                 logger.warning("Character '/' is not allowed in experiment "
                                "name (%s)", name)
                 name = name.replace("/", "_")
-            if name in entry_dict:
+            if prefix + name in entry_dict:
                 basename = name
                 i = 1
-                while name in entry_dict:
+                while prefix + name in entry_dict:
                     name = basename + str(i)
                     i += 1
                 logger.warning("Duplicate experiment name: '%s'\n"
@@ -50,43 +231,59 @@ class _RepoScanner:
                 "arginfo": arginfo,
                 "scheduler_defaults": class_desc["scheduler_defaults"]
             }
-            entry_dict[name] = entry
+            entry_dict[prefix + name] = entry
 
-    async def _scan(self, root, subdir=""):
-        entry_dict = dict()
+    def _list_files(self, root, subdir=""):
+        filenames = []
         for de in os.scandir(os.path.join(root, subdir)):
             if de.name.startswith("."):
                 continue
             if de.is_file() and de.name.endswith(".py"):
-                filename = os.path.join(subdir, de.name)
-                try:
-                    await self.process_file(entry_dict, root, filename)
-                except Exception as exc:
-                    logger.warning("Skipping file '%s'", filename,
-                        exc_info=not isinstance(exc, WorkerInternalException))
-                    # restart worker
-                    await self.worker.close()
-                    self.worker = Worker(self.worker_handlers)
+                filenames.append(os.path.join(subdir, de.name))
             if de.is_dir():
-                subentries = await self._scan(
+                filenames += self._list_files(
                     root, os.path.join(subdir, de.name))
-                entries = {de.name + "/" + k: v for k, v in subentries.items()}
-                entry_dict.update(entries)
-        return entry_dict
+        return filenames
 
     async def scan(self, root):
-        self.worker = Worker(self.worker_handlers)
+        queue = asyncio.Queue()
+        for filename in sorted(self._list_files(root)):
+            queue.put_nowait(filename)
+        descriptions = dict()
+        n = max(1, min(self.concurrency, queue.qsize()))
+        self.workers = [None]*n
         try:
-            r = await self._scan(root)
+            await asyncio.gather(*[
+                self._process_files(i, root, queue, descriptions)
+                for i in range(n)])
         finally:
-            await self.worker.close()
-        return r
+            for worker in self.workers:
+                if worker is not None:
+                    await worker.close()
+
+        entry_dict = dict()
+        for filename in sorted(descriptions.keys()):
+            self._add_entries(entry_dict, filename, descriptions[filename])
+        return entry_dict
 
 
 class ExperimentDB:
-    def __init__(self, repo_backend, worker_handlers):
+    def __init__(self, repo_backend, worker_handlers, worker_pool=None,
+                 scan_cache=None, scan_workers=1):
         self.repo_backend = repo_backend
         self.worker_handlers = worker_handlers
+        self.scan_workers = scan_workers
+        if worker_pool is None:
+            worker_pool = WorkerPool(worker_handlers)
+        self.worker_pool = worker_pool
+        if scan_cache is None:
+            self._scan_cache = None
+        else:
+            self._scan_cache = _ScanCache(scan_cache)
+        # The handlers may be registered after construction.
+        self._examine_cache = ExamineCache(
+            lambda key: self.worker_handlers["get_dataset"](key),
+            lambda: self.worker_handlers["get_device_db"]())
 
         self.cur_rev = self.repo_backend.get_head_rev()
         self.repo_backend.request_rev(self.cur_rev)
@@ -101,6 +298,7 @@ class ExperimentDB:
     def close(self):
         # The object cannot be used anymore after calling this method.
         self.repo_backend.release_rev(self.cur_rev)
+        self.repo_backend.close()
 
     async def scan_repository(self, new_cur_rev=None):
         if self._scanning:
@@ -115,8 +313,15 @@ class ExperimentDB:
             self.cur_rev = new_cur_rev
             self.status["cur_rev"] = new_cur_rev
             t1 = time.monotonic()
-            new_explist = await _RepoScanner(self.worker_handlers).scan(wd)
+            new_explist = await _RepoScanner(self.worker_pool,
+                                             self._scan_cache,
+                                             self.scan_workers).scan(wd)
             logger.info("repository scan took %d seconds", time.monotonic()-t1)
+            if self._scan_cache is not None:
+                self._scan_cache.save()
+            # Rescans also pick up changes to the modules imported by
+            # experiments, which the examine cache does not detect.
+            self._examine_cache.clear()
             update_from_dict(self.explist, new_explist)
         finally:
             self._scanning = False
@@ -126,20 +331,29 @@ class ExperimentDB:
         asyncio.ensure_future(
             exc_to_warning(self.scan_repository(new_cur_rev)))
 
-    async def examine(self, filename, use_repository=True, revision=None):
+    async def examine(self, filename, use_repository=True, revision=None,
+                      refresh=False):
+        """Returns the description of the experiments in ``filename``.
+
+        Results for revisions of repositories whose revisions cannot change
+        are cached, unless ``refresh`` is true."""
         if use_repository:
             if revision is None:
                 revision = self.cur_rev
             wd, _ = self.repo_backend.request_rev(revision)
             filename = os.path.join(wd, filename)
-        worker = Worker(self.worker_handlers)
         try:
-            description = await worker.examine("examine", filename)
+            if use_repository and self.repo_backend.immutable_revisions:
+                return await self._examine_cache.examine(
+                    self.worker_pool.get, filename, revision, refresh)
+            worker = self.worker_pool.get()
+            try:
+                return await worker.examine("examine", filename)
+            finally:
+                await worker.close()
         finally:
-            await worker.close()
-        if use_repository:
-            self.repo_backend.release_rev(revision)
-        return description
+            if use_repository:
+                self.repo_backend.release_rev(revision)
 
     def list_directory(self, directory):
         r = []
@@ -160,6 +374,9 @@ class ExperimentDB:
 
 
 class FilesystemBackend:
+    # The files can be modified at any time.
+    immutable_revisions = False
+
     def __init__(self, root):
         self.root = os.path.abspath(root)
 
@@ -172,28 +389,173 @@ class FilesystemBackend:
     def release_rev(self, rev):
         pass
 
+    def close(self):
+        pass
+
+
+# Git tree entry file modes
+_GIT_FILEMODE_TREE = 0o040000
+_GIT_FILEMODE_BLOB = 0o100644
+_GIT_FILEMODE_BLOB_EXECUTABLE = 0o100755
+_GIT_FILEMODE_LINK = 0o120000
+
+
+def _rmtree_onerror(func, path, exc_info):
+    # Files hard-linked from the checkout store are read-only, which
+    # prevents their removal on Windows.
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
+
+
+class _CheckoutStore:
+    """Materializes Git revisions into directories, sharing the files that
+    are identical across revisions.
+
+    Blobs are written once into a cache directory and hard-linked into each
+    checkout. If hard links are not supported, the files are copied instead.
+
+    All the links of a blob share the same inode, so the checked out files
+    are read-only: writing to them fails. A file that is made writable and
+    modified anyway is modified in every checkout that shares it. Such
+    blobs are detected by their size, modification time and permissions,
+    and are written again for the later checkouts.
+    """
+    def __init__(self, git):
+        self.git = git
+        self.root = tempfile.mkdtemp(prefix="artiq_git_")
+        self.blob_dir = os.path.join(self.root, "blobs")
+        os.mkdir(self.blob_dir)
+        # path -> (size, modification time, permissions) of the blobs
+        self._blob_stats = dict()
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns, stat.S_IMODE(st.st_mode)
+
+    def _get_blob(self, oid, executable):
+        name = str(oid)
+        if executable:
+            name += "x"
+        path = os.path.join(self.blob_dir, name[:2], name[2:])
+        if path in self._blob_stats:
+            try:
+                if self._stat(path) == self._blob_stats[path]:
+                    return path
+                logger.warning("checked out file %s was modified, "
+                               "writing it again", name)
+                os.chmod(path, stat.S_IWRITE)
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            del self._blob_stats[path]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpname = path + ".tmp"
+        with open(tmpname, "wb") as f:
+            f.write(self.git[oid].data)
+        os.chmod(tmpname, 0o555 if executable else 0o444)
+        os.replace(tmpname, path)
+        self._blob_stats[path] = self._stat(path)
+        return path
+
+    def _checkout_tree(self, tree, directory, blobs):
+        for entry in tree:
+            path = os.path.join(directory, entry.name)
+            if entry.filemode == _GIT_FILEMODE_TREE:
+                os.mkdir(path)
+                self._checkout_tree(self.git[entry.id], path, blobs)
+            elif entry.filemode in (_GIT_FILEMODE_BLOB,
+                                    _GIT_FILEMODE_BLOB_EXECUTABLE):
+                blob = self._get_blob(
+                    entry.id,
+                    entry.filemode == _GIT_FILEMODE_BLOB_EXECUTABLE)
+                try:
+                    os.link(blob, path)
+                except OSError:
+                    shutil.copy(blob, path)
+                blobs.append(blob)
+            elif entry.filemode == _GIT_FILEMODE_LINK:
+                target = self.git[entry.id].data
+                try:
+                    os.symlink(target, path)
+                except OSError:
+                    # Same as Git on systems without symbolic links
+                    with open(path, "wb") as f:
+                        f.write(target)
+            # Submodules are not checked out, as with checkout_tree.
+
+    def checkout(self, commit):
+        """Checks out the tree of the given commit into a new directory.
+
+        Returns the path of the directory and the list of cached blobs that
+        it uses."""
+        path = tempfile.mkdtemp(dir=self.root)
+        blobs = []
+        self._checkout_tree(commit.tree, path, blobs)
+        return path, blobs
+
+    def dispose(self, path, blobs):
+        shutil.rmtree(path, onerror=_rmtree_onerror)
+        for blob in set(blobs):
+            try:
+                if os.stat(blob).st_nlink == 1:
+                    os.chmod(blob, stat.S_IWRITE)
+                    os.unlink(blob)
+                    self._blob_stats.pop(blob, None)
+            except FileNotFoundError:
+                self._blob_stats.pop(blob, None)
+            except OSError:
+                logger.warning("failed to remove unused blob %s", blob,
+                               exc_info=True)
+
+    def close(self):
+        shutil.rmtree(self.root, onerror=_rmtree_onerror)
+
 
 class _GitCheckout:
-    def __init__(self, git, rev):
-        self.path = tempfile.mkdtemp()
+    def __init__(self, git, rev, store=None):
+        self.store = store
         commit = git.get(rev)
-        git.checkout_tree(commit, directory=self.path)
+        if store is None:
+            self.path = tempfile.mkdtemp()
+            git.checkout_tree(commit, directory=self.path)
+        else:
+            self.path, self.blobs = store.checkout(commit)
         self.message = commit.message.strip()
         self.ref_count = 1
         logger.info("checked out revision %s into %s", rev, self.path)
 
     def dispose(self):
         logger.info("disposing of checkout in folder %s", self.path)
-        shutil.rmtree(self.path)
+        if self.store is None:
+            shutil.rmtree(self.path)
+        else:
+            self.store.dispose(self.path, self.blobs)
 
 
 class GitBackend:
-    def __init__(self, root):
+    """Repository backend checking out revisions of a Git repository.
+
+    If ``shared_store`` is set, files that are identical across revisions
+    are hard-linked to a single read-only copy (see
+    :class:`_CheckoutStore`). Checkouts that are no longer used are disposed
+    of, except for the ``keep_checkouts`` most recently released ones, which
+    can be requested again without checking them out.
+    """
+    immutable_revisions = True
+
+    def __init__(self, root, shared_store=False, keep_checkouts=0):
         # lazy import - make dependency optional
         import pygit2
 
         self.git = pygit2.Repository(root)
         self.checkouts = dict()
+        self.keep_checkouts = keep_checkouts
+        self._unused_checkouts = OrderedDict()
+        if shared_store:
+            self._store = _CheckoutStore(self.git)
+        else:
+            self._store = None
 
     def get_head_rev(self):
         return str(self.git.head.target)
@@ -202,8 +564,12 @@ class GitBackend:
         if rev in self.checkouts:
             co = self.checkouts[rev]
             co.ref_count += 1
+        elif rev in self._unused_checkouts:
+            co = self._unused_checkouts.pop(rev)
+            co.ref_count = 1
+            self.checkouts[rev] = co
         else:
-            co = _GitCheckout(self.git, rev)
+            co = _GitCheckout(self.git, rev, self._store)
             self.checkouts[rev] = co
         return co.path, co.message
 
@@ -211,5 +577,20 @@ class GitBackend:
         co = self.checkouts[rev]
         co.ref_count -= 1
         if not co.ref_count:
-            co.dispose()
             del self.checkouts[rev]
+            self._unused_checkouts[rev] = co
+            while len(self._unused_checkouts) > self.keep_checkouts:
+                _, co = self._unused_checkouts.popitem(last=False)
+                co.dispose()
+
+    def close(self):
+        while self._unused_checkouts:
+            _, co = self._unused_checkouts.popitem(last=False)
+            co.dispose()
+        if self._store is not None:
+            if self.checkouts:
+                logger.warning("removing %d checkouts still in use",
+                               len(self.checkouts))
+            # The checkouts are within the store.
+            self._store.close()
+            self.checkouts.clear()
@@ -1,20 +1,118 @@
+import asyncio
+import collections
 import logging
 import logging.handlers
+import threading
+import time
 
 from sipyco.logging_tools import SourceFilter
+from sipyco.asyncio_tools import TaskObject
 
 
-class LogForwarder(logging.Handler):
-    def __init__(self, *args, **kwargs):
-        logging.Handler.__init__(self, *args, **kwargs)
+class LogForwarder(logging.Handler, TaskObject):
+    """Forwards log records to ``callback`` and ``batch_callback``.
+
+    Records are collected every ``period`` seconds. Each
+    ``(level, source, time, message)`` record is then passed to ``callback``,
+    and the whole batch to ``batch_callback``, as a tuple of a batch sequence
+    number and the list of records. Each source may forward at
+    most ``rate`` records per second on average, with bursts of up to
+    ``burst`` records; the records beyond are dropped and replaced with a
+    warning giving their number. The last ``backlog_size`` records forwarded
+    are kept and returned by :meth:`get_backlog`.
+    """
+    def __init__(self, period=0.1, rate=100.0, burst=1000, backlog_size=1000):
+        logging.Handler.__init__(self)
         self.callback = None
+        self.batch_callback = None
         self.setFormatter(logging.Formatter("%(name)s:%(message)s"))
 
+        self.period = period
+        self.rate = rate
+        self.burst = burst
+
+        self._lock = threading.Lock()
+        self._pending = []
+        self._seq = 0
+        self._backlog = collections.deque(maxlen=backlog_size)
+        # source -> [tokens, last update (monotonic), suppressed records]
+        self._buckets = dict()
+
+    def _allow(self, source):
+        now = time.monotonic()
+        try:
+            bucket = self._buckets[source]
+        except KeyError:
+            bucket = self._buckets[source] = [self.burst, now, 0]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1])*self.rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        else:
+            bucket[2] += 1
+            return False
+
     def emit(self, record):
+        message = self.format(record)
+        with self._lock:
+            if self._allow(record.source):
+                self._pending.append((record.levelno, record.source,
+                                      record.created, message))
+
+    def _suppressed_records(self):
+        records = []
+        now = time.time()
+        for source, bucket in list(self._buckets.items()):
+            if bucket[2]:
+                records.append((
+                    logging.WARNING, source, now,
+                    "{}:{} messages suppressed".format(__name__, bucket[2])))
+                bucket[2] = 0
+            elif bucket[0] >= self.burst:
+                # Full again, forget the source.
+                del self._buckets[source]
+        return records
+
+    def send(self):
+        """Forwards the pending records now."""
+        with self._lock:
+            records = self._pending + self._suppressed_records()
+            self._pending = []
+            if not records:
+                return
+            self._seq += 1
+            self._backlog.extend(records)
+            batch = self._seq, records
         if self.callback is not None:
-            message = self.format(record)
-            self.callback((record.levelno, record.source, record.created,
-                           message))
+            for record in records:
+                self.callback(record)
+        if self.batch_callback is not None:
+            self.batch_callback(batch)
+
+    def get_backlog(self):
+        """Returns the sequence number of the last batch forwarded and the
+        last records forwarded, oldest first. Batches with a sequence number
+        up to the one returned are included in these records."""
+        with self._lock:
+            return self._seq, list(self._backlog)
+
+    async def _do(self):
+        while True:
+            await asyncio.sleep(self.period)
+            self.send()
+
+
+class LogBacklog:
+    """Gives access to the recent records of a :class:`LogForwarder`.
+
+    The master exposes this as the ``master_log`` RPC target."""
+    def __init__(self, log_forwarder):
+        self._log_forwarder = log_forwarder
+
+    def get(self):
+        """See :meth:`LogForwarder.get_backlog`."""
+        return self._log_forwarder.get_backlog()
 
 
 def log_args(parser):
@@ -30,6 +128,20 @@ def log_args(parser):
                        help="number of old log files to keep, or 0 to keep "
                             "all log files. '.<yyyy>-<mm>-<dd>' is added "
                             "to the base filename (default: %(default)d)")
+    group.add_argument("--log-batch-period", type=float, default=0.1,
+                       help="period in seconds at which log messages are "
+                            "sent to clients (default: %(default)s)")
+    group.add_argument("--log-rate-limit", type=float, default=100.0,
+                       help="average number of log messages per second "
+                            "sent to clients from each source, beyond which "
+                            "messages are dropped (default: %(default)s)")
+    group.add_argument("--log-rate-burst", type=int, default=1000,
+                       help="number of log messages a source can send to "
+                            "clients in a burst above the rate limit "
+                            "(default: %(default)d)")
+    group.add_argument("--log-backlog", type=int, default=1000,
+                       help="number of recent log messages sent to newly "
+                            "connected dashboards (default: %(default)d)")
 
 
 def init_log(args):
@@ -52,7 +164,8 @@ def init_log(args):
             "%(asctime)s %(levelname)s:%(source)s:%(name)s:%(message)s"))
         handlers.append(file_handler)
     
-    log_forwarder = LogForwarder()
+    log_forwarder = LogForwarder(args.log_batch_period, args.log_rate_limit,
+                                 args.log_rate_burst, args.log_backlog)
     handlers.append(log_forwarder)
 
     for handler in handlers:
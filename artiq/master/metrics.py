@@ -0,0 +1,163 @@
+"""Latency metrics of the scheduler stages.
+
+:class:`StageMetrics` collects the time spent by runs in each stage,
+per pipeline. Summaries of the most recent samples are published
+periodically through a notifier, and cumulative histograms are served as plain text by
+:class:`MetricsServer`, in the Prometheus exposition format.
+"""
+
+import asyncio
+import bisect
+from collections import deque
+
+from sipyco.sync_struct import Notifier
+from sipyco.asyncio_tools import AsyncioServer, TaskObject
+
+
+# Upper bounds of the histogram buckets, in seconds. The last bucket is
+# unbounded.
+buckets = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+           1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0, 1000.0]
+
+
+def _quantile(sorted_samples, q):
+    return sorted_samples[min(int(q*len(sorted_samples)),
+                              len(sorted_samples) - 1)]
+
+
+class _Histogram:
+    def __init__(self, window):
+        self.recent = deque(maxlen=window)
+        self.counts = [0]*(len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, duration):
+        self.recent.append(duration)
+        self.counts[bisect.bisect_left(buckets, duration)] += 1
+        self.count += 1
+        self.sum += duration
+
+    def summary(self):
+        samples = sorted(self.recent)
+        counts = [0]*(len(buckets) + 1)
+        for duration in samples:
+            counts[bisect.bisect_left(buckets, duration)] += 1
+        return {
+            "count": len(samples),
+            "total": self.count,
+            "mean": sum(samples)/len(samples),
+            "p50": _quantile(samples, 0.5),
+            "p90": _quantile(samples, 0.9),
+            "p99": _quantile(samples, 0.99),
+            "max": samples[-1],
+            "counts": counts
+        }
+
+
+class StageMetrics(TaskObject):
+    """Histograms of the durations of the scheduler stages, per pipeline.
+
+    The ``notifier`` contains the upper bounds of the buckets (``buckets``,
+    the last bucket being unbounded) and, for each pipeline and stage
+    (``pipelines``), a summary of the last ``window`` durations recorded:
+    their number, mean, median, 90th and 99th percentiles, maximum and
+    counts per bucket, and the total number of durations ever recorded.
+
+    The summaries are updated by :meth:`publish`, which is called every
+    ``period`` seconds once the task is started.
+    """
+    def __init__(self, window=1000, period=1.0):
+        self.window = window
+        self.period = period
+        self._histograms = dict()
+        # (pipeline name, stage) of the histograms modified since the last
+        # publication
+        self._dirty = set()
+        self.notifier = Notifier({"buckets": list(buckets), "pipelines": {}})
+
+    def record(self, pipeline_name, stage, duration):
+        """Adds a duration (in seconds) of the given stage of a run of the
+        given pipeline."""
+        try:
+            histograms = self._histograms[pipeline_name]
+        except KeyError:
+            histograms = self._histograms[pipeline_name] = dict()
+        try:
+            histogram = histograms[stage]
+        except KeyError:
+            histogram = histograms[stage] = _Histogram(self.window)
+        histogram.add(duration)
+        self._dirty.add((pipeline_name, stage))
+
+    def publish(self):
+        """Updates the summaries of the notifier with the durations recorded
+        since the last call."""
+        dirty, self._dirty = self._dirty, set()
+        pipelines = self.notifier["pipelines"]
+        for pipeline_name, stage in sorted(dirty):
+            if pipeline_name not in pipelines.raw_view:
+                pipelines[pipeline_name] = dict()
+            pipelines[pipeline_name][stage] = \
+                self._histograms[pipeline_name][stage].summary()
+
+    async def _do(self):
+        try:
+            while True:
+                await asyncio.sleep(self.period)
+                self.publish()
+        finally:
+            self.publish()
+
+    def format_text(self):
+        """Returns the cumulative histograms of all the durations recorded,
+        in the Prometheus text exposition format."""
+        name = "artiq_scheduler_stage_seconds"
+        lines = [
+            "# HELP {} Time spent by runs in each scheduler stage.".format(
+                name),
+            "# TYPE {} histogram".format(name)
+        ]
+        for pipeline_name, histograms in sorted(self._histograms.items()):
+            for stage, histogram in sorted(histograms.items()):
+                labels = "pipeline=\"{}\",stage=\"{}\"".format(
+                    pipeline_name.replace("\\", "\\\\").replace("\"", "\\\""),
+                    stage)
+                cumulative = 0
+                for bound, count in zip(buckets + ["+Inf"],
+                                        histogram.counts):
+                    cumulative += count
+                    lines.append("{}_bucket{{{},le=\"{}\"}} {}".format(
+                        name, labels, bound, cumulative))
+                lines.append("{}_sum{{{}}} {}".format(
+                    name, labels, histogram.sum))
+                lines.append("{}_count{{{}}} {}".format(
+                    name, labels, histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer(AsyncioServer):
+    """Minimal HTTP server that answers every request with the text
+    returned by ``format_text``."""
+    def __init__(self, format_text):
+        AsyncioServer.__init__(self)
+        self.format_text = format_text
+
+    async def _handle_connection_cr(self, reader, writer):
+        try:
+            # Skip the request line and headers.
+            while True:
+                line = await reader.readline()
+                if not line or line in (b"\r\n", b"\n"):
+                    break
+            body = self.format_text().encode()
+            writer.write(b"HTTP/1.0 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4\r\n"
+                         + "Content-Length: {}\r\n\r\n".format(
+                             len(body)).encode()
+                         + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,378 @@
+"""Index of the result files of experiment runs.
+
+The catalog is a SQLite database in the results directory that records the
+metadata and dataset keys of each result file. Workers add each file they
+write, so that runs can be found without walking the directory tree and
+opening the files. ``artiq_results_catalog rebuild`` recreates the catalog
+from the result files.
+"""
+
+import logging
+import os
+import re
+import sqlite3
+from urllib.request import pathname2url
+
+import h5py
+
+from sipyco import pyon
+
+
+logger = logging.getLogger(__name__)
+
+
+def iter_result_files(results_dir, since=None):
+    """Yields ``(path, rid)`` for the result files in the
+    ``YYYY-MM-DD/HH`` subdirectories of ``results_dir``. ``path`` is
+    relative to ``results_dir``.
+
+    If ``since`` is the path of a result file, in the same form, only the
+    subdirectories of the same hour or later are listed."""
+    if since is None:
+        since_df = since_hmf = ""
+    else:
+        since_df, since_hmf = since.split("/")[:2]
+    try:
+        day_folders = os.listdir(results_dir)
+    except:
+        return
+    day_folders = filter(
+        lambda x: re.fullmatch("\\d\\d\\d\\d-\\d\\d-\\d\\d", x)
+                  and x >= since_df,
+        day_folders)
+    for df in day_folders:
+        day_path = os.path.join(results_dir, df)
+        try:
+            hm_folders = os.listdir(day_path)
+        except:
+            continue
+        hm_folders = filter(lambda x: re.fullmatch("\\d\\d(-\\d\\d)?", x)
+                            and (df > since_df or x >= since_hmf),
+                            hm_folders)
+        for hmf in hm_folders:
+            hm_path = os.path.join(day_path, hmf)
+            try:
+                h5files = os.listdir(hm_path)
+            except:
+                continue
+            for x in h5files:
+                m = re.fullmatch(
+                    "(\\d\\d\\d\\d\\d\\d\\d\\d\\d)-.*\\.h5", x)
+                if m is None:
+                    continue
+                yield os.path.join(df, hmf, x), int(m.group(1))
+
+
+def _decode_str(value):
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+max_scalar_length = 256
+
+
+def _scalar_value(dataset):
+    # Only small scalars are stored in the catalog and returned by queries.
+    if dataset.shape != ():
+        return None
+    value = dataset[()]
+    if dataset.dtype.kind in "biuf":
+        return value.item()
+    if dataset.dtype.kind in "SUO":
+        value = _decode_str(value)
+        if isinstance(value, str) and len(value) <= max_scalar_length:
+            return value
+    return None
+
+
+def _scalar_values(group):
+    r = dict()
+    for key, dataset in group.items():
+        if isinstance(dataset, h5py.Dataset):
+            r[key] = _scalar_value(dataset)
+        else:
+            r[key] = None
+    return r
+
+
+def read_entry(f):
+    """Returns the catalog entry of the open result file ``f``.
+
+    Datasets are given as dictionaries mapping their keys to their value if
+    they are numeric, boolean or short string scalars, and to ``None``
+    otherwise."""
+    expid = pyon.decode(_decode_str(f["expid"][()]))
+    entry = {
+        "rid": int(f["rid"][()]),
+        "class_name": expid.get("class_name"),
+        "file": expid.get("file"),
+        "repo_rev": expid.get("repo_rev"),
+        "start_time": float(f["start_time"][()]),
+        "run_time": None,
+        "artiq_version": None,
+        "datasets": _scalar_values(f["datasets"]) if "datasets" in f else {},
+        "archive": _scalar_values(f["archive"]) if "archive" in f else {}
+    }
+    if "run_time" in f:
+        entry["run_time"] = float(f["run_time"][()])
+    if "artiq_version" in f:
+        entry["artiq_version"] = _decode_str(f["artiq_version"][()])
+    return entry
+
+
+_schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    rid INTEGER NOT NULL,
+    class_name TEXT,
+    file TEXT,
+    repo_rev TEXT,
+    start_time REAL,
+    run_time REAL,
+    artiq_version TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_rid ON runs (rid);
+CREATE INDEX IF NOT EXISTS runs_class_name ON runs (class_name);
+CREATE INDEX IF NOT EXISTS runs_start_time ON runs (start_time);
+CREATE TABLE IF NOT EXISTS datasets (
+    run_id INTEGER NOT NULL,
+    archive INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (run_id, archive, key)
+);
+CREATE INDEX IF NOT EXISTS datasets_key ON datasets (key);
+"""
+
+
+class ResultsCatalog:
+    """SQLite catalog of the result files in ``results_dir``.
+
+    Paths are stored relative to ``results_dir``, with ``/`` separators.
+    Several processes can update the catalog concurrently.
+    """
+    filename = "catalog.sqlite3"
+
+    def __init__(self, results_dir="results", timeout=30.0):
+        self.results_dir = results_dir
+        self.timeout = timeout
+
+    @property
+    def path(self):
+        return os.path.join(self.results_dir, self.filename)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def connect(self, readonly=False):
+        """Opens the catalog, creating it unless ``readonly`` is set.
+
+        A read-only connection fails if the catalog does not exist."""
+        if readonly:
+            uri = "file:{}?mode=ro".format(
+                pathname2url(os.path.abspath(self.path)))
+            return sqlite3.connect(uri, uri=True, timeout=self.timeout)
+        os.makedirs(self.results_dir, exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=self.timeout)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(_schema)
+        return db
+
+    def _relpath(self, path):
+        path = os.path.relpath(path, self.results_dir)
+        return path.replace(os.sep, "/")
+
+    def _add(self, db, path, entry):
+        path = self._relpath(path)
+        row = db.execute("SELECT id FROM runs WHERE path = ?",
+                         (path, )).fetchone()
+        if row is not None:
+            db.execute("DELETE FROM datasets WHERE run_id = ?", row)
+            db.execute("DELETE FROM runs WHERE id = ?", row)
+        run_id = db.execute(
+            "INSERT INTO runs (path, rid, class_name, file, repo_rev, "
+            "start_time, run_time, artiq_version) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, entry["rid"], entry["class_name"], entry["file"],
+             entry["repo_rev"], entry["start_time"], entry["run_time"],
+             entry["artiq_version"])).lastrowid
+        db.executemany(
+            "INSERT OR IGNORE INTO datasets (run_id, archive, key, value) "
+            "VALUES (?, ?, ?, ?)",
+            [(run_id, archive, key,
+              None if value is None else pyon.encode(value))
+             for archive, group in enumerate((entry["datasets"],
+                                              entry["archive"]))
+             for key, value in group.items()])
+
+    def add(self, path, entry):
+        """Records the result file at ``path`` with the metadata ``entry``
+        (see :func:`read_entry`)."""
+        db = self.connect()
+        try:
+            with db:
+                self._add(db, path, entry)
+        finally:
+            db.close()
+
+    @staticmethod
+    def _where(class_name, file, repo_rev, min_start_time, max_start_time,
+               min_rid, max_rid, datasets):
+        conditions = []
+        parameters = []
+        for column, value in (("class_name", class_name), ("file", file),
+                              ("repo_rev", repo_rev)):
+            if value is not None:
+                conditions.append(column + " = ?")
+                parameters.append(value)
+        for condition, value in (("start_time >= ?", min_start_time),
+                                 ("start_time < ?", max_start_time),
+                                 ("rid >= ?", min_rid),
+                                 ("rid <= ?", max_rid)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        for key in datasets:
+            conditions.append(
+                "EXISTS (SELECT 1 FROM datasets WHERE run_id = runs.id "
+                "AND archive = 0 AND key = ?)")
+            parameters.append(key)
+        if conditions:
+            return " WHERE " + " AND ".join(conditions), parameters
+        else:
+            return "", parameters
+
+    def query(self, class_name=None, file=None, repo_rev=None,
+              min_start_time=None, max_start_time=None,
+              min_rid=None, max_rid=None, datasets=[],
+              offset=0, limit=100):
+        """Returns the runs matching all the given criteria, in order of
+        increasing RID.
+
+        ``min_start_time`` and ``max_start_time`` are in seconds since the
+        epoch; the range includes its start but not its end. The RID range
+        includes both ends. Runs must have all the (non-archive) datasets
+        listed in ``datasets``. At most ``limit`` runs are returned, after
+        skipping the first ``offset`` matching runs.
+
+        Each run is a dictionary with the keys ``rid``, ``path`` (relative
+        to the results directory), ``class_name``, ``file``, ``repo_rev``,
+        ``start_time``, ``run_time``, ``artiq_version`` and ``datasets``.
+        The latter maps the keys of the datasets of the run to their value
+        if it is a small scalar, and to ``None`` otherwise.
+        """
+        if not self.exists():
+            return []
+        where, parameters = self._where(
+            class_name, file, repo_rev, min_start_time, max_start_time,
+            min_rid, max_rid, datasets)
+        db = self.connect(readonly=True)
+        try:
+            rows = db.execute(
+                "SELECT id, rid, path, class_name, file, repo_rev, "
+                "start_time, run_time, artiq_version FROM runs" + where
+                + " ORDER BY rid, path LIMIT ? OFFSET ?",
+                parameters + [limit, offset]).fetchall()
+            runs = dict()
+            for row in rows:
+                runs[row[0]] = {
+                    "rid": row[1],
+                    "path": row[2],
+                    "class_name": row[3],
+                    "file": row[4],
+                    "repo_rev": row[5],
+                    "start_time": row[6],
+                    "run_time": row[7],
+                    "artiq_version": row[8],
+                    "datasets": dict()
+                }
+            if runs:
+                values = db.execute(
+                    "SELECT run_id, key, value FROM datasets "
+                    "WHERE archive = 0 AND run_id IN ({})".format(
+                        ", ".join("?"*len(runs))),
+                    list(runs.keys()))
+                for run_id, key, value in values:
+                    runs[run_id]["datasets"][key] = (
+                        None if value is None else pyon.decode(value))
+            return list(runs.values())
+        finally:
+            db.close()
+
+    def count(self, class_name=None, file=None, repo_rev=None,
+              min_start_time=None, max_start_time=None,
+              min_rid=None, max_rid=None, datasets=[]):
+        """Returns the number of runs matching the given criteria (see
+        :meth:`query`)."""
+        if not self.exists():
+            return 0
+        where, parameters = self._where(
+            class_name, file, repo_rev, min_start_time, max_start_time,
+            min_rid, max_rid, datasets)
+        db = self.connect(readonly=True)
+        try:
+            return db.execute("SELECT COUNT(*) FROM runs" + where,
+                              parameters).fetchone()[0]
+        finally:
+            db.close()
+
+    def last_run(self):
+        """Returns the RID and path of the run with the highest RID in the
+        catalog, or ``None`` if the catalog does not exist or is empty."""
+        if not self.exists():
+            return None
+        db = self.connect(readonly=True)
+        try:
+            return db.execute("SELECT rid, path FROM runs "
+                              "ORDER BY rid DESC LIMIT 1").fetchone()
+        finally:
+            db.close()
+
+    def last_rid(self):
+        """Returns the highest RID in the catalog, or ``None`` if the catalog
+        does not exist or is empty."""
+        run = self.last_run()
+        return None if run is None else run[0]
+
+    def rebuild(self):
+        """Recreates the catalog from the result files.
+
+        Returns the number of files recorded."""
+        db = self.connect()
+        n = 0
+        try:
+            with db:
+                db.execute("DELETE FROM datasets")
+                db.execute("DELETE FROM runs")
+                for path, rid in iter_result_files(self.results_dir):
+                    path = os.path.join(self.results_dir, path)
+                    try:
+                        with h5py.File(path, "r") as f:
+                            entry = read_entry(f)
+                    except:
+                        logger.warning("failed to read result file %s",
+                                       path, exc_info=True)
+                        continue
+                    self._add(db, path, entry)
+                    n += 1
+        finally:
+            db.close()
+        return n
+
+
+class ResultsDB:
+    """Queries the results catalog of ``results_dir``.
+
+    The master exposes this as the ``master_results`` RPC target."""
+    def __init__(self, results_dir="results"):
+        self.catalog = ResultsCatalog(results_dir)
+
+    def query(self, *args, **kwargs):
+        """See :meth:`ResultsCatalog.query`."""
+        return self.catalog.query(*args, **kwargs)
+
+    def count(self, *args, **kwargs):
+        """See :meth:`ResultsCatalog.count`."""
+        return self.catalog.count(*args, **kwargs)
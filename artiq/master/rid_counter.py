@@ -1,7 +1,8 @@
 import logging
 import os
 import tempfile
-import re
+
+from artiq.master.results_catalog import ResultsCatalog, iter_result_files
 
 logger = logging.getLogger(__name__)
 
@@ -10,7 +11,11 @@ class RIDCounter:
     """Monotonically incrementing counter for RIDs (experiment run ids).
 
     A cache is used, but if necessary, the last used rid will be determined
-    from the given results directory.
+    from the catalog of the given results directory, or by scanning the
+    directory if it has no catalog. As the catalog may lack the latest
+    result files (e.g. if a worker failed to record them), the directories
+    of the same hour as its last entry or later are scanned as well, and the
+    cache is only used if it is not behind the catalog.
     """
 
     def __init__(self, cache_filename="last_rid.pyon", results_dir="results"):
@@ -25,6 +30,15 @@ class RIDCounter:
         self._update_cache(rid)
         return rid
 
+    def get_many(self, n):
+        """Returns a range of ``n`` consecutive RIDs, updating the cache
+        only once."""
+        rids = range(self._next_rid, self._next_rid + n)
+        if n:
+            self._next_rid += n
+            self._update_cache(rids[-1])
+        return rids
+
     def _last_rid(self):
         try:
             rid = self._last_rid_from_cache()
@@ -35,6 +49,11 @@ class RIDCounter:
             return rid
         else:
             logger.debug("Using last RID from cache")
+            last_run = self._last_run_from_catalog()
+            if last_run is not None and last_run[0] > rid:
+                logger.warning("Last RID cache is behind the results "
+                               "catalog, using RID %d", last_run[0])
+                rid = last_run[0]
             return rid
 
     def _update_cache(self, rid):
@@ -50,35 +69,21 @@ class RIDCounter:
         with open(self.cache_filename, "r") as f:
             return int(f.read())
 
-    def _last_rid_from_results(self):
-        r = -1
+    def _last_run_from_catalog(self):
         try:
-            day_folders = os.listdir(self.results_dir)
+            return ResultsCatalog(self.results_dir).last_run()
         except:
-            return r
-        day_folders = filter(
-            lambda x: re.fullmatch("\\d\\d\\d\\d-\\d\\d-\\d\\d", x),
-            day_folders)
-        for df in day_folders:
-            day_path = os.path.join(self.results_dir, df)
-            try:
-                hm_folders = os.listdir(day_path)
-            except:
-                continue
-            hm_folders = filter(lambda x: re.fullmatch("\\d\\d(-\\d\\d)?", x),
-                                hm_folders)
-            for hmf in hm_folders:
-                hm_path = os.path.join(day_path, hmf)
-                try:
-                    h5files = os.listdir(hm_path)
-                except:
-                    continue
-                for x in h5files:
-                    m = re.fullmatch(
-                        "(\\d\\d\\d\\d\\d\\d\\d\\d\\d)-.*\\.h5", x)
-                    if m is None:
-                        continue
-                    rid = int(m.group(1))
-                    if rid > r:
-                        r = rid
-        return r
+            logger.warning("Failed to read results catalog",
+                           exc_info=True)
+            return None
+
+    def _last_rid_from_results(self):
+        last_run = self._last_run_from_catalog()
+        if last_run is None:
+            rid, since = -1, None
+        else:
+            logger.debug("Using last RID from results catalog")
+            rid, since = last_run
+        for _, file_rid in iter_result_files(self.results_dir, since):
+            rid = max(rid, file_rid)
+        return rid
@@ -1,12 +1,15 @@
 import asyncio
+import heapq
+import itertools
 import logging
 from enum import Enum
-from time import time
+from time import time, monotonic
 
 from sipyco.sync_struct import Notifier
 from sipyco.asyncio_tools import TaskObject, Condition
 
-from artiq.master.worker import Worker, log_worker_exception
+from artiq.master.worker import WorkerPool, log_worker_exception
+from artiq.master.metrics import StageMetrics
 from artiq.tools import asyncio_wait_or_cancel
 
 
@@ -25,9 +28,22 @@ class RunStatus(Enum):
     paused = 8
 
 
+# Stages recorded for the time runs spend in each status. The time spent
+# preparing is recorded as the "worker_spawn", "build" and "prepare" stages.
+_status_stages = {
+    RunStatus.pending: "pending",
+    RunStatus.flushing: "flushing",
+    RunStatus.prepare_done: "prepare_done",
+    RunStatus.running: "run",
+    RunStatus.run_done: "run_done",
+    RunStatus.analyzing: "analyze",
+    RunStatus.paused: "paused"
+}
+
+
 def _mk_worker_method(name):
     async def worker_method(self, *args, **kwargs):
-        if self.worker.closed.is_set():
+        if self.closed.is_set():
             return True
         m = getattr(self.worker, name)
         try:
@@ -35,7 +51,7 @@ def _mk_worker_method(name):
         except Exception as e:
             if isinstance(e, asyncio.CancelledError):
                 raise
-            if self.worker.closed.is_set():
+            if self.closed.is_set():
                 logger.debug("suppressing worker exception of terminated run",
                              exc_info=True)
                 # Return completion on termination
@@ -58,10 +74,18 @@ class Run:
         self.due_date = due_date
         self.flush = flush
 
-        self.worker = Worker(pool.worker_handlers)
+        # The worker is taken from the pool when the run is built.
+        self._worker_pool = pool.worker_pool
+        self.worker = None
+        self.closed = asyncio.Event()
         self.termination_requested = False
 
+        # Time spent in each stage, in seconds
+        self.timings = dict()
+        self._record_timing = pool.record_timing
+
         self._status = RunStatus.pending
+        self._status_since = monotonic()
 
         notification = {
             "pipeline": self.pipeline_name,
@@ -75,6 +99,8 @@ class Run:
         self._notifier = pool.notifier
         self._notifier[self.rid] = notification
         self._state_changed = pool.state_changed
+        self._update_index = pool.update_index
+        self._update_index(self, None)
 
     @property
     def status(self):
@@ -82,8 +108,15 @@ class Run:
 
     @status.setter
     def status(self, value):
+        old_status = self._status
         self._status = value
-        if not self.worker.closed.is_set():
+        now = monotonic()
+        if old_status in _status_stages:
+            self.record_timing(_status_stages[old_status],
+                               now - self._status_since)
+        self._status_since = now
+        self._update_index(self, old_status)
+        if not self.closed.is_set():
             self._notifier[self.rid]["status"] = self._status.name
         self._state_changed.notify()
 
@@ -94,38 +127,130 @@ class Run:
         """
         return (self.priority, -(self.due_date or 0), -self.rid)
 
+    def record_timing(self, stage, duration):
+        """Adds ``duration`` to the time spent by the run in ``stage``."""
+        self.timings[stage] = self.timings.get(stage, 0.0) + duration
+        self._record_timing(self, stage, duration)
+
     async def close(self):
         # called through pool
-        await self.worker.close()
+        self.closed.set()
+        if self.worker is not None:
+            await self._worker_pool.release(self.worker)
         del self._notifier[self.rid]
+        if self._status == RunStatus.deleting:
+            self.record_timing("delete", monotonic() - self._status_since)
 
     _build = _mk_worker_method("build")
 
     async def build(self):
+        if self.closed.is_set():
+            return
+        if self.worker is None:
+            self.worker = self._worker_pool.get()
+        spawn = self.worker.ipc is None
+        t0 = monotonic()
         await self._build(self.rid, self.pipeline_name,
                           self.wd, self.expid,
                           self.priority)
+        duration = monotonic() - t0
+        if spawn and self.worker.spawn_time is not None:
+            self.record_timing("worker_spawn", self.worker.spawn_time)
+            duration -= self.worker.spawn_time
+        self.record_timing("build", duration)
+
+    _prepare = _mk_worker_method("prepare")
+
+    async def prepare(self):
+        t0 = monotonic()
+        await self._prepare()
+        self.record_timing("prepare", monotonic() - t0)
+
+    _run = _mk_worker_method("run")
+
+    async def run(self):
+        # The timings are saved in the results if run() fails.
+        return await self._run(self.timings)
 
-    prepare = _mk_worker_method("prepare")
-    run = _mk_worker_method("run")
     resume = _mk_worker_method("resume")
-    analyze = _mk_worker_method("analyze")
+    _analyze = _mk_worker_method("analyze")
+
+    @property
+    def analyze_ordered(self):
+        return self.worker.analyze_ordered
+
+    async def analyze(self):
+        await self._analyze(self.timings)
+
+
+def _highest_priority_first(run):
+    return tuple(-x for x in run.priority_key())
+
+
+class _RunHeap:
+    """Set of runs that supports retrieving the run with the smallest key
+    in O(log n).
+
+    Removed runs are dropped lazily, when they reach the top of the heap.
+    """
+    def __init__(self, key):
+        self._key = key
+        self._heap = []
+        self._rids = set()
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._rids)
+
+    def add(self, run):
+        if run.rid not in self._rids:
+            self._rids.add(run.rid)
+            heapq.heappush(self._heap,
+                           (self._key(run), next(self._counter), run))
+
+    def discard(self, run):
+        self._rids.discard(run.rid)
+        if len(self._heap) > 2*len(self._rids) + 32:
+            self._heap = [e for e in self._heap if e[2].rid in self._rids]
+            heapq.heapify(self._heap)
+
+    def peek(self):
+        while self._heap:
+            run = self._heap[0][2]
+            if run.rid in self._rids:
+                return run
+            heapq.heappop(self._heap)
+        return None
+
+    def pop(self):
+        run = self.peek()
+        if run is not None:
+            heapq.heappop(self._heap)
+            self._rids.discard(run.rid)
+        return run
 
 
 class RunPool:
-    def __init__(self, ridc, worker_handlers, notifier, experiment_db):
+    def __init__(self, ridc, worker_pool, notifier, experiment_db,
+                 metrics=None):
         self.runs = dict()
         self.state_changed = Condition()
 
+        # Per-status priority indexes, kept up to date by Run.status.
+        # Pending runs with a due date in the future are kept in a separate
+        # heap ordered by due date, and are moved to the pending priority
+        # index when their due date elapses.
+        self._by_status = {status: _RunHeap(_highest_priority_first)
+                           for status in RunStatus}
+        self._pending_due = _RunHeap(lambda r: r.due_date)
+
         self.ridc = ridc
-        self.worker_handlers = worker_handlers
+        self.worker_pool = worker_pool
         self.notifier = notifier
         self.experiment_db = experiment_db
+        self.metrics = metrics
 
-    def submit(self, expid, priority, due_date, flush, pipeline_name):
-        # mutates expid to insert head repository revision if None.
-        # called through scheduler.
-        rid = self.ridc.get()
+    def _add_run(self, rid, expid, priority, due_date, flush, pipeline_name):
         if "repo_rev" in expid:
             if expid["repo_rev"] is None:
                 expid["repo_rev"] = self.experiment_db.cur_rev
@@ -136,9 +261,73 @@ class RunPool:
         run = Run(rid, pipeline_name, wd, expid, priority, due_date, flush,
                   self, repo_msg=repo_msg)
         self.runs[rid] = run
+
+    def submit(self, expid, priority, due_date, flush, pipeline_name):
+        # mutates expid to insert head repository revision if None.
+        # called through scheduler.
+        rid = self.ridc.get()
+        self._add_run(rid, expid, priority, due_date, flush, pipeline_name)
         self.state_changed.notify()
         return rid
 
+    def submit_many(self, expids, priority, due_dates, flush, pipeline_name):
+        # same as submit, with a block of RIDs and a single notification
+        # of the stages. If a run cannot be added, those added before it
+        # are kept and still scheduled.
+        rids = self.ridc.get_many(len(expids))
+        try:
+            for rid, expid, due_date in zip(rids, expids, due_dates):
+                self._add_run(rid, expid, priority, due_date, flush,
+                              pipeline_name)
+        finally:
+            self.state_changed.notify()
+        return list(rids)
+
+    def record_timing(self, run, stage, duration):
+        # called through run
+        if self.metrics is not None:
+            self.metrics.record(run.pipeline_name, stage, duration)
+
+    def update_index(self, run, old_status):
+        # called through run
+        if old_status is not None:
+            self._by_status[old_status].discard(run)
+            if old_status == RunStatus.pending:
+                self._pending_due.discard(run)
+        if (run.status == RunStatus.pending
+                and run.due_date is not None and run.due_date >= time()):
+            self._pending_due.add(run)
+        else:
+            self._by_status[run.status].add(run)
+
+    def next_pending(self, now):
+        """Returns a tuple containing the pending run with the highest
+        priority among those the due date of which has elapsed, and the
+        pending run with the earliest due date that has not elapsed yet.
+
+        Either element can be ``None``.
+        """
+        pending = self._by_status[RunStatus.pending]
+        while True:
+            run = self._pending_due.peek()
+            if run is None or run.due_date >= now:
+                break
+            self._pending_due.pop()
+            pending.add(run)
+        return pending.peek(), self._pending_due.peek()
+
+    def highest_priority(self, status):
+        """Returns the run with the highest priority among those with the
+        given status, or ``None``."""
+        return self._by_status[status].peek()
+
+    def count(self, status):
+        """Returns the number of runs with the given status."""
+        n = len(self._by_status[status])
+        if status == RunStatus.pending:
+            n += len(self._pending_due)
+        return n
+
     async def delete(self, rid):
         # called through deleter
         if rid not in self.runs:
@@ -147,110 +336,143 @@ class RunPool:
         await run.close()
         if "repo_rev" in run.expid:
             self.experiment_db.repo_backend.release_rev(run.expid["repo_rev"])
+        self._by_status[run.status].discard(run)
+        self._pending_due.discard(run)
         del self.runs[rid]
 
 
 class PrepareStage(TaskObject):
-    def __init__(self, pool, delete_cb):
+    """Builds and prepares the pending runs of a pipeline.
+
+    Up to ``prepare_ahead`` runs are built and prepared concurrently, each
+    in its own worker, and runs keep being prepared in priority order until
+    that many are either preparing or waiting in ``prepare_done``. Pending
+    runs with a higher priority than all prepared runs are prepared
+    regardless of the latter. Runs with ``flush`` set are prepared on their
+    own, once the runs they wait for are done.
+    """
+    def __init__(self, pool, delete_cb, prepare_ahead=1):
         self.pool = pool
         self.delete_cb = delete_cb
+        self.prepare_ahead = prepare_ahead
+
+    def set_prepare_ahead(self, prepare_ahead):
+        self.prepare_ahead = prepare_ahead
+        self.pool.state_changed.notify()
 
     def _get_run(self):
         """If a run should get prepared now, return it. Otherwise, return a
         float giving the time until the next check, or None if no time-based
         check is required.
 
-        The latter can be the case if there are no due-date runs, or none
-        of them are going to become next-in-line before further pool state
-        changes (which will also cause a re-evaluation).
+        The latter is the case if there are no due-date runs. Otherwise, the
+        time until the earliest due date is returned, even if that run is not
+        going to become next-in-line; the re-evaluation then simply finds
+        nothing to do.
         """
-        pending_runs = list(
-            filter(lambda r: r.status == RunStatus.pending,
-                   self.pool.runs.values()))
-
         now = time()
-        def is_runnable(r):
-            return (r.due_date or 0) < now
-
-        prepared_max = max((r.priority_key() for r in self.pool.runs.values()
-                            if r.status == RunStatus.prepare_done),
-                           default=None)
-        def takes_precedence(r):
-            return prepared_max is None or r.priority_key() > prepared_max
-
-        candidate = max(filter(is_runnable, pending_runs),
-                        key=lambda r: r.priority_key(),
-                        default=None)
-        if candidate is not None and takes_precedence(candidate):
-            return candidate
+        candidate, next_due = self.pool.next_pending(now)
+
+        depth = max(1, self.prepare_ahead)
+        preparing = self.pool.count(RunStatus.preparing)
+        if candidate is not None and preparing < depth:
+            prepared = self.pool.highest_priority(RunStatus.prepare_done)
+            if (prepared is None
+                    or candidate.priority_key() > prepared.priority_key()
+                    or (not candidate.flush and preparing
+                        + self.pool.count(RunStatus.prepare_done) < depth)):
+                return candidate
+
+        if next_due is None:
+            return None
+        return next_due.due_date - now
+
+    async def _flush(self, run):
+        run.status = RunStatus.flushing
+        while not all(r.status in (RunStatus.pending,
+                                   RunStatus.deleting)
+                      or r.priority < run.priority
+                      or r is run
+                      for r in self.pool.runs.values()):
+            ev = [self.pool.state_changed.wait(),
+                  run.closed.wait()]
+            await asyncio_wait_or_cancel(
+                ev, return_when=asyncio.FIRST_COMPLETED)
+            if run.closed.is_set():
+                break
 
-        return min((r.due_date - now for r in pending_runs
-                    if (not is_runnable(r) and takes_precedence(r))),
-                   default=None)
+    async def _prepare(self, run):
+        try:
+            await run.build()
+            await run.prepare()
+        except:
+            logger.error("got worker exception in prepare stage, "
+                         "deleting RID %d", run.rid)
+            log_worker_exception()
+            self.delete_cb(run.rid)
+        else:
+            run.status = RunStatus.prepare_done
 
     async def _do(self):
-        while True:
-            run = self._get_run()
-            if run is None:
-                await self.pool.state_changed.wait()
-            elif isinstance(run, float):
-                await asyncio_wait_or_cancel([self.pool.state_changed.wait()],
-                                             timeout=run)
-            else:
-                if run.flush:
-                    run.status = RunStatus.flushing
-                    while not all(r.status in (RunStatus.pending,
-                                               RunStatus.deleting)
-                                  or r.priority < run.priority
-                                  or r is run
-                                  for r in self.pool.runs.values()):
-                        ev = [self.pool.state_changed.wait(),
-                              run.worker.closed.wait()]
-                        await asyncio_wait_or_cancel(
-                            ev, return_when=asyncio.FIRST_COMPLETED)
-                        if run.worker.closed.is_set():
-                            break
-                    if run.worker.closed.is_set():
+        tasks = set()
+        try:
+            while True:
+                run = self._get_run()
+                if run is None:
+                    await self.pool.state_changed.wait()
+                elif isinstance(run, float):
+                    await asyncio_wait_or_cancel(
+                        [self.pool.state_changed.wait()], timeout=run)
+                elif run.flush:
+                    await self._flush(run)
+                    if run.closed.is_set():
                         continue
-                run.status = RunStatus.preparing
-                try:
-                    await run.build()
-                    await run.prepare()
-                except:
-                    logger.error("got worker exception in prepare stage, "
-                                 "deleting RID %d", run.rid)
-                    log_worker_exception()
-                    self.delete_cb(run.rid)
+                    run.status = RunStatus.preparing
+                    await self._prepare(run)
                 else:
-                    run.status = RunStatus.prepare_done
+                    run.status = RunStatus.preparing
+                    task = asyncio.ensure_future(self._prepare(run))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.wait(tasks)
 
 
 class RunStage(TaskObject):
-    def __init__(self, pool, delete_cb):
+    """Runs the prepared runs of a pipeline.
+
+    If ``analyze_backlog`` is set, no new run is started while that many
+    completed runs are waiting for the analyze stage; paused runs can still
+    resume.
+    """
+    def __init__(self, pool, delete_cb, analyze_backlog=None):
         self.pool = pool
         self.delete_cb = delete_cb
+        self.analyze_backlog = analyze_backlog
 
-    def _get_run(self):
-        prepared_runs = filter(lambda r: r.status == RunStatus.prepare_done,
-                               self.pool.runs.values())
-        try:
-            r = max(prepared_runs, key=lambda r: r.priority_key())
-        except ValueError:
-            # prepared_runs is an empty sequence
-            r = None
-        return r
+    def get_run(self):
+        """Returns the prepared run with the highest priority that can be
+        started, or ``None``."""
+        if (self.analyze_backlog is not None
+                and self.pool.count(RunStatus.run_done)
+                    >= self.analyze_backlog):
+            return None
+        return self.pool.highest_priority(RunStatus.prepare_done)
 
     async def _do(self):
         stack = []
 
         while True:
-            next_irun = self._get_run()
+            next_irun = self.get_run()
             if not stack or (
                     next_irun is not None and
                     next_irun.priority_key() > stack[-1].priority_key()):
                 while next_irun is None:
                     await self.pool.state_changed.wait()
-                    next_irun = self._get_run()
+                    next_irun = self.get_run()
                 stack.append(next_irun)
 
             run = stack.pop()
@@ -280,42 +502,78 @@ class RunStage(TaskObject):
 
 
 class AnalyzeStage(TaskObject):
-    def __init__(self, pool, delete_cb):
+    """Analyzes the runs of a pipeline that completed, in priority order.
+
+    Up to ``concurrency`` runs are analyzed concurrently. Runs are only
+    analyzed when a slot is available and otherwise wait in ``run_done``.
+    The analysis of runs whose experiment sets ``analyze_ordered`` starts
+    once all analyses in progress have completed, and no other analysis
+    starts until it has completed.
+    """
+    def __init__(self, pool, delete_cb, concurrency=1):
         self.pool = pool
         self.delete_cb = delete_cb
+        self.concurrency = concurrency
+        self._ordered_run = None
+
+    def set_concurrency(self, concurrency):
+        self.concurrency = concurrency
+        self.pool.state_changed.notify()
 
     def _get_run(self):
-        run_runs = filter(lambda r: r.status == RunStatus.run_done,
-                          self.pool.runs.values())
+        if self._ordered_run is not None:
+            return None
+        analyzing = self.pool.count(RunStatus.analyzing)
+        if analyzing >= max(1, self.concurrency):
+            return None
+        run = self.pool.highest_priority(RunStatus.run_done)
+        if run is not None and run.analyze_ordered and analyzing:
+            return None
+        return run
+
+    async def _analyze(self, run):
         try:
-            r = max(run_runs, key=lambda r: r.priority_key())
-        except ValueError:
-            # run_runs is an empty sequence
-            r = None
-        return r
+            await run.analyze()
+        except:
+            logger.error("got worker exception in analyze stage of RID %d.",
+                         run.rid)
+            log_worker_exception()
+        finally:
+            if self._ordered_run is run:
+                self._ordered_run = None
+        self.delete_cb(run.rid)
 
     async def _do(self):
-        while True:
-            run = self._get_run()
-            while run is None:
-                await self.pool.state_changed.wait()
+        tasks = set()
+        try:
+            while True:
                 run = self._get_run()
-            run.status = RunStatus.analyzing
-            try:
-                await run.analyze()
-            except:
-                logger.error("got worker exception in analyze stage of RID %d.",
-                             run.rid)
-                log_worker_exception()
-            self.delete_cb(run.rid)
+                while run is None:
+                    await self.pool.state_changed.wait()
+                    run = self._get_run()
+                if run.analyze_ordered:
+                    self._ordered_run = run
+                run.status = RunStatus.analyzing
+                task = asyncio.ensure_future(self._analyze(run))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.wait(tasks)
 
 
 class Pipeline:
-    def __init__(self, ridc, deleter, worker_handlers, notifier, experiment_db):
-        self.pool = RunPool(ridc, worker_handlers, notifier, experiment_db)
-        self._prepare = PrepareStage(self.pool, deleter.delete)
-        self._run = RunStage(self.pool, deleter.delete)
-        self._analyze = AnalyzeStage(self.pool, deleter.delete)
+    def __init__(self, ridc, deleter, worker_pool, notifier, experiment_db,
+                 metrics=None, prepare_ahead=1, analyze_concurrency=1,
+                 analyze_backlog=None):
+        self.pool = RunPool(ridc, worker_pool, notifier, experiment_db,
+                            metrics)
+        self._prepare = PrepareStage(self.pool, deleter.delete, prepare_ahead)
+        self._run = RunStage(self.pool, deleter.delete, analyze_backlog)
+        self._analyze = AnalyzeStage(self.pool, deleter.delete,
+                                     analyze_concurrency)
 
     def start(self):
         self._prepare.start()
@@ -328,16 +586,30 @@ class Pipeline:
         await self._run.stop()
         await self._prepare.stop()
 
+    def set_prepare_ahead(self, prepare_ahead):
+        self._prepare.set_prepare_ahead(prepare_ahead)
+
+    def set_analyze_concurrency(self, analyze_concurrency):
+        self._analyze.set_concurrency(analyze_concurrency)
+
+    def next_run(self):
+        """Returns the prepared run that would be started next, or
+        ``None``."""
+        return self._run.get_run()
+
 
 class Deleter(TaskObject):
     """Provides a synchronous interface for instigating deletion of runs.
 
     :meth:`RunPool.delete` is an async function (it needs to close the worker
     connection, etc.), so we maintain a queue of RIDs to delete on a background task.
+    Each run is deleted in its own task, so that a worker process that takes
+    long to exit (e.g. while writing results) does not hold up the others.
     """
     def __init__(self, pipelines):
         self._pipelines = pipelines
         self._queue = asyncio.Queue()
+        self._deleting = dict()
 
     def delete(self, rid):
         """Delete the run with the given RID.
@@ -367,29 +639,77 @@ class Deleter(TaskObject):
     async def _gc_pipelines(self):
         pipeline_names = list(self._pipelines.keys())
         for name in pipeline_names:
-            if not self._pipelines[name].pool.runs:
+            pipeline = self._pipelines.get(name)
+            if pipeline is not None and not pipeline.pool.runs:
                 logger.debug("garbage-collecting pipeline '%s'...", name)
-                await self._pipelines[name].stop()
                 del self._pipelines[name]
+                await pipeline.stop()
                 logger.debug("garbage-collection of pipeline '%s' completed",
                              name)
 
-    async def _do(self):
-        while True:
-            rid = await self._queue.get()
+    async def _delete_task(self, rid):
+        try:
             await self._delete(rid)
             await self._gc_pipelines()
+        except:
+            logger.error("failed to delete RID %d", rid, exc_info=True)
+        finally:
+            del self._deleting[rid]
             self._queue.task_done()
 
+    async def _do(self):
+        try:
+            while True:
+                rid = await self._queue.get()
+                if rid in self._deleting:
+                    # already being deleted
+                    self._queue.task_done()
+                else:
+                    self._deleting[rid] = asyncio.ensure_future(
+                        self._delete_task(rid))
+        finally:
+            if self._deleting:
+                await asyncio.wait(list(self._deleting.values()))
+
 
 class Scheduler:
-    def __init__(self, ridc, worker_handlers, experiment_db):
+    """Schedules the runs submitted to a set of pipelines.
+
+    ``prepare_ahead`` is the number of runs of each pipeline that can be
+    built and prepared in advance of the running one (see
+    :class:`PrepareStage`). It can be overridden for individual pipelines
+    with the ``pipeline_prepare_ahead`` dictionary or
+    :meth:`set_prepare_ahead`.
+
+    Likewise, ``analyze_concurrency`` is the number of runs of each pipeline
+    that can be analyzed concurrently (see :class:`AnalyzeStage`), which can
+    be overridden with ``pipeline_analyze_concurrency`` or
+    :meth:`set_analyze_concurrency`. If ``analyze_backlog`` is set, pipelines
+    do not start new runs while that many completed runs wait for analysis.
+    """
+    def __init__(self, ridc, worker_handlers, experiment_db, worker_pool=None,
+                 prepare_ahead=1, pipeline_prepare_ahead=None,
+                 analyze_concurrency=1, pipeline_analyze_concurrency=None,
+                 analyze_backlog=None):
         self.notifier = Notifier(dict())
+        # Durations of the stages of the runs, per pipeline
+        self.metrics = StageMetrics()
 
         self._pipelines = dict()
-        self._worker_handlers = worker_handlers
+        if worker_pool is None:
+            worker_pool = WorkerPool(worker_handlers)
+        self._worker_pool = worker_pool
         self._experiment_db = experiment_db
         self._terminated = False
+        self._prepare_ahead = prepare_ahead
+        if pipeline_prepare_ahead is None:
+            pipeline_prepare_ahead = dict()
+        self._pipeline_prepare_ahead = dict(pipeline_prepare_ahead)
+        self._analyze_concurrency = analyze_concurrency
+        if pipeline_analyze_concurrency is None:
+            pipeline_analyze_concurrency = dict()
+        self._pipeline_analyze_concurrency = dict(pipeline_analyze_concurrency)
+        self._analyze_backlog = analyze_backlog
 
         self._ridc = ridc
         self._deleter = Deleter(self._pipelines)
@@ -408,6 +728,21 @@ class Scheduler:
         if self._pipelines:
             logger.warning("some pipelines were not garbage-collected")
 
+    def _get_pipeline(self, pipeline_name):
+        try:
+            return self._pipelines[pipeline_name]
+        except KeyError:
+            logger.debug("creating pipeline '%s'", pipeline_name)
+            pipeline = Pipeline(self._ridc, self._deleter,
+                                self._worker_pool, self.notifier,
+                                self._experiment_db, self.metrics,
+                                self.get_prepare_ahead(pipeline_name),
+                                self.get_analyze_concurrency(pipeline_name),
+                                self._analyze_backlog)
+            self._pipelines[pipeline_name] = pipeline
+            pipeline.start()
+            return pipeline
+
     def submit(self, pipeline_name, expid, priority=0, due_date=None, flush=False):
         """Submits a new run.
 
@@ -417,17 +752,71 @@ class Scheduler:
         # mutates expid to insert head repository revision if None
         if self._terminated:
             return
-        try:
-            pipeline = self._pipelines[pipeline_name]
-        except KeyError:
-            logger.debug("creating pipeline '%s'", pipeline_name)
-            pipeline = Pipeline(self._ridc, self._deleter,
-                                self._worker_handlers, self.notifier,
-                                self._experiment_db)
-            self._pipelines[pipeline_name] = pipeline
-            pipeline.start()
+        pipeline = self._get_pipeline(pipeline_name)
         return pipeline.pool.submit(expid, priority, due_date, flush, pipeline_name)
 
+    def submit_many(self, pipeline_name, expids, priority=0, due_dates=None,
+                    flush=False):
+        """Submits a run for each element of the list ``expids``, and
+        returns the list of their RIDs, which are consecutive.
+
+        ``due_dates`` is either ``None`` or a list with the due date of each
+        run. This is more efficient than calling :meth:`submit` for each
+        run, e.g. to submit the points of a large sweep.
+
+        When called through an experiment, the default values of
+        ``pipeline_name`` and ``priority`` correspond to those of the
+        current run.
+
+        If a run cannot be submitted (e.g. its repository revision does not
+        exist), the exception is raised and the runs before it in ``expids``
+        remain submitted."""
+        # mutates expids to insert head repository revision if None
+        if self._terminated:
+            return
+        if due_dates is None:
+            due_dates = [None]*len(expids)
+        elif len(due_dates) != len(expids):
+            raise ValueError("due_dates and expids must have the same length")
+        pipeline = self._get_pipeline(pipeline_name)
+        return pipeline.pool.submit_many(expids, priority, due_dates, flush,
+                                         pipeline_name)
+
+    def get_prepare_ahead(self, pipeline_name):
+        """Returns the number of runs of the given pipeline that can be
+        prepared in advance."""
+        return self._pipeline_prepare_ahead.get(pipeline_name,
+                                                self._prepare_ahead)
+
+    def set_prepare_ahead(self, pipeline_name, prepare_ahead):
+        """Sets the number of runs of the given pipeline that can be
+        prepared in advance. ``None`` restores the default."""
+        if prepare_ahead is None:
+            self._pipeline_prepare_ahead.pop(pipeline_name, None)
+        else:
+            self._pipeline_prepare_ahead[pipeline_name] = prepare_ahead
+        if pipeline_name in self._pipelines:
+            self._pipelines[pipeline_name].set_prepare_ahead(
+                self.get_prepare_ahead(pipeline_name))
+
+    def get_analyze_concurrency(self, pipeline_name):
+        """Returns the number of runs of the given pipeline that can be
+        analyzed concurrently."""
+        return self._pipeline_analyze_concurrency.get(
+            pipeline_name, self._analyze_concurrency)
+
+    def set_analyze_concurrency(self, pipeline_name, analyze_concurrency):
+        """Sets the number of runs of the given pipeline that can be
+        analyzed concurrently. ``None`` restores the default."""
+        if analyze_concurrency is None:
+            self._pipeline_analyze_concurrency.pop(pipeline_name, None)
+        else:
+            self._pipeline_analyze_concurrency[pipeline_name] = \
+                analyze_concurrency
+        if pipeline_name in self._pipelines:
+            self._pipelines[pipeline_name].set_analyze_concurrency(
+                self.get_analyze_concurrency(pipeline_name))
+
     def delete(self, rid):
         """Kills the run with the specified RID."""
         self._deleter.delete(rid)
@@ -470,12 +859,8 @@ class Scheduler:
                 if run.termination_requested:
                     return True
 
-                prepared_runs = filter(lambda r: r.status == RunStatus.prepare_done,
-                                       pipeline.pool.runs.values())
-                try:
-                    r = max(prepared_runs, key=lambda r: r.priority_key())
-                except ValueError:
-                    # prepared_runs is an empty sequence
+                r = pipeline.next_run()
+                if r is None:
                     return False
                 return r.priority_key() > run.priority_key()
         raise KeyError("RID not found")
@@ -0,0 +1,88 @@
+"""Coalescing of the modifications of a dictionary notifier.
+
+:class:`CoalescedNotifier` maintains a copy of a notifier, such as the
+schedule, that is published to clients instead of the original. The changes
+made to each top-level key of the original are applied to the copy at most
+every ``period`` seconds, so that successive changes of the same key (e.g.
+the status transitions of a run) are sent to subscribers as a single
+modification. Keys that are added and removed within a period are not sent
+at all.
+"""
+
+import asyncio
+import copy
+
+from sipyco.sync_struct import Notifier
+from sipyco.asyncio_tools import TaskObject
+
+
+__all__ = ["CoalescedNotifier"]
+
+
+class CoalescedNotifier(TaskObject):
+    """Copy of the dictionary notifier ``source``, kept up to date at most
+    ``period`` seconds late.
+
+    The copy is available as ``notifier``. Values that are dictionaries are
+    updated key by key, other values are replaced. The ``publish`` callback
+    of ``source`` is taken over; the notifier can still be read and modified
+    as before.
+    """
+    def __init__(self, source, period=0.1):
+        self.source = source
+        self.period = period
+        self.notifier = Notifier(copy.deepcopy(source.raw_view))
+        # Top-level keys modified since the last flush, in order of first
+        # modification.
+        self._dirty = dict()
+        self._changed = asyncio.Event()
+        source.publish = self._source_modified
+
+    def _source_modified(self, mod):
+        if mod["path"]:
+            key = mod["path"][0]
+        elif mod["action"] in {"setitem", "delitem"}:
+            key = mod["key"]
+        else:
+            # Not a modification of a single key, compare all of them.
+            for key in set(self.source.raw_view) | set(self.notifier.raw_view):
+                self._dirty[key] = None
+            self._changed.set()
+            return
+        self._dirty[key] = None
+        self._changed.set()
+
+    def _update_key(self, key):
+        source = self.source.raw_view
+        mirror = self.notifier.raw_view
+        if key not in source:
+            if key in mirror:
+                del self.notifier[key]
+        elif (key not in mirror
+                or not isinstance(source[key], dict)
+                or not isinstance(mirror[key], dict)):
+            self.notifier[key] = copy.deepcopy(source[key])
+        else:
+            new, old = source[key], mirror[key]
+            for k in list(old.keys()):
+                if k not in new:
+                    del self.notifier[key][k]
+            for k, v in new.items():
+                if k not in old or old[k] != v:
+                    self.notifier[key][k] = copy.deepcopy(v)
+
+    def flush(self):
+        """Applies the pending changes to the copy immediately."""
+        dirty, self._dirty = self._dirty, dict()
+        self._changed.clear()
+        for key in dirty:
+            self._update_key(key)
+
+    async def _do(self):
+        try:
+            while True:
+                await self._changed.wait()
+                await asyncio.sleep(self.period)
+                self.flush()
+        finally:
+            self.flush()
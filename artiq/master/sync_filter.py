@@ -0,0 +1,131 @@
+"""Subscriptions to a subset of the keys of a dictionary notifier.
+
+A subscriber requests a subset by connecting to the notifier named
+``filtered_notifier_name(name, keys, prefixes)`` instead of ``name``. The
+master then only sends the matching part of the initial structure and the
+modifications of matching keys, instead of leaving the subscriber to discard
+them after transfer.
+
+:class:`FilteredPublisher` implements the server side of the sync_struct
+protocol of :mod:`sipyco.sync_struct`, as the sipyco
+:class:`~sipyco.sync_struct.Publisher` cannot be extended with its public
+interface. Plain subscriptions are served as by that class, and clients use
+the sipyco :class:`~sipyco.sync_struct.Subscriber` in both cases.
+"""
+
+import asyncio
+from functools import partial
+
+from sipyco.asyncio_tools import AsyncioServer
+from sipyco import pyon
+
+
+__all__ = ["KeyFilter", "filtered_notifier_name", "FilteredPublisher"]
+
+
+# Version of the sync_struct protocol implemented here, as sent by the sipyco
+# Subscriber at the start of each connection. Connections with another
+# banner are rejected.
+_protocol_banner = b"ARTIQ sync_struct\n"
+
+
+class KeyFilter:
+    """Matches the top-level keys given in ``keys`` and the string keys
+    starting with one of ``prefixes``."""
+    def __init__(self, keys=(), prefixes=()):
+        self.keys = set(keys)
+        self.prefixes = tuple(prefixes)
+
+    def match_key(self, key):
+        return (key in self.keys
+                or (isinstance(key, str) and key.startswith(self.prefixes)))
+
+    def match_mod(self, mod):
+        if mod["path"]:
+            return self.match_key(mod["path"][0])
+        elif mod["action"] in {"setitem", "delitem"}:
+            return self.match_key(mod["key"])
+        else:
+            return True
+
+    def filter_struct(self, struct):
+        return {k: v for k, v in struct.items() if self.match_key(k)}
+
+
+def filtered_notifier_name(notifier_name, keys=(), prefixes=()):
+    """Returns the name to subscribe to for receiving only the given keys
+    and key prefixes of ``notifier_name``. ``None`` elements are ignored."""
+    return notifier_name + ":" + pyon.encode({
+        "keys": sorted(k for k in keys if k is not None),
+        "prefixes": sorted(p for p in prefixes if p is not None)
+    })
+
+
+class FilteredPublisher(AsyncioServer):
+    """Publishes the dictionary notifiers ``notifiers`` to subscribers, like
+    :class:`sipyco.sync_struct.Publisher`, and additionally accepts filtered
+    subscriptions to the notifiers named in ``filterable``."""
+    def __init__(self, notifiers, filterable=()):
+        AsyncioServer.__init__(self)
+        self.notifiers = notifiers
+        self.filterable = set(filterable)
+        # notifier name -> {queue: KeyFilter, or None for all keys}
+        self._recipients = {k: dict() for k in notifiers.keys()}
+        for notifier_name, notifier in notifiers.items():
+            notifier.publish = partial(self._publish, notifier_name)
+
+    async def _handle_connection_cr(self, reader, writer):
+        try:
+            line = await reader.readline()
+            if line != _protocol_banner:
+                return
+            line = await reader.readline()
+            if not line:
+                return
+            notifier_name, sep, spec = line.decode()[:-1].partition(":")
+            if sep:
+                if notifier_name not in self.filterable:
+                    return
+                spec = pyon.decode(spec)
+                key_filter = KeyFilter(spec["keys"], spec["prefixes"])
+            else:
+                key_filter = None
+            try:
+                notifier = self.notifiers[notifier_name]
+            except KeyError:
+                return
+
+            struct = notifier.raw_view
+            if key_filter is not None:
+                struct = key_filter.filter_struct(struct)
+            obj = {"action": "init", "struct": struct}
+            line = pyon.encode(obj) + "\n"
+            writer.write(line.encode())
+
+            queue = asyncio.Queue()
+            recipients = self._recipients[notifier_name]
+            recipients[queue] = key_filter
+            try:
+                while True:
+                    line = await queue.get()
+                    writer.write(line)
+                    # raise exception on connection error
+                    await writer.drain()
+            finally:
+                del recipients[queue]
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+            # subscribers disconnecting are a normal occurrence
+            pass
+        finally:
+            writer.close()
+
+    def _publish(self, notifier_name, mod):
+        recipients = [queue for queue, key_filter
+                      in self._recipients[notifier_name].items()
+                      if key_filter is None or key_filter.match_mod(mod)]
+        if not recipients:
+            return
+        line = pyon.encode(mod) + "\n"
+        line = line.encode()
+        for recipient in recipients:
+            recipient.put_nowait(line)
@@ -5,11 +5,13 @@ import logging
 import subprocess
 import time
 
-from sipyco import pipe_ipc, pyon
+from sipyco import pipe_ipc
+from sipyco.sync_struct import Notifier
 from sipyco.logging_tools import LogParser
 from sipyco.packed_exceptions import current_exc_packed
 
 from artiq.tools import asyncio_wait_or_cancel
+from artiq.master.worker_codec import codecs
 
 
 logger = logging.getLogger(__name__)
@@ -42,13 +44,33 @@ def log_worker_exception():
 
 
 class Worker:
-    def __init__(self, handlers=dict(), send_timeout=10.0):
+    def __init__(self, handlers=dict(), send_timeout=10.0, codec="pyon",
+                 dataset_batching=None, results_timeout=60.0,
+                 trace_parent_actions=False):
         self.handlers = handlers
         self.send_timeout = send_timeout
+        self.codec = codecs[codec]
+        self.dataset_batching = dataset_batching
+        self.trace_parent_actions = trace_parent_actions
+        self.results_timeout = results_timeout
+        # Set once the worker process is writing result files in the
+        # background, which it finishes before exiting.
+        self.results_pending = False
+        # Set once a run has completed, after which the process can be
+        # reset for another run.
+        self.resettable = False
+        # Set by build() if the experiment requires its analyze stage to be
+        # ordered with respect to other runs.
+        self.analyze_ordered = False
+        # Values of the datasets read by the worker process, recorded while
+        # examining a file if requested.
+        self.datasets_read = None
 
         self.rid = None
         self.filename = None
         self.ipc = None
+        # Time taken to start the worker process, in seconds.
+        self.spawn_time = None
         self.watchdogs = dict()  # wid -> expiration (using time.monotonic)
 
         self.io_lock = asyncio.Lock()
@@ -73,6 +95,17 @@ class Worker:
         else:
             return None
 
+    def update_datasets(self, mods):
+        update = self.handlers["update_dataset"]
+        for mod in mods:
+            try:
+                update(mod)
+            except KeyError:
+                # The batching of the worker can leave the deletion of a
+                # dataset that was never created, see DatasetManager.
+                if mod["action"] != "delitem" or mod["path"]:
+                    raise
+
     def _get_log_source(self):
         return "worker({},{})".format(self.rid, self.filename)
 
@@ -83,14 +116,16 @@ class Worker:
         try:
             if self.closed.is_set():
                 raise WorkerError("Attempting to create process after close")
+            t0 = time.monotonic()
             self.ipc = pipe_ipc.AsyncioParentComm()
             env = os.environ.copy()
             env["PYTHONUNBUFFERED"] = "1"
             await self.ipc.create_subprocess(
                 sys.executable, "-m", "artiq.master.worker_impl",
-                self.ipc.get_address(), str(log_level),
+                self.ipc.get_address(), str(log_level), self.codec.name,
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                 env=env, start_new_session=True)
+            self.spawn_time = time.monotonic() - t0
             asyncio.ensure_future(
                 LogParser(self._get_log_source).stream_task(
                     self.ipc.process.stdout))
@@ -122,7 +157,10 @@ class Worker:
                 return
             try:
                 await self._send({"action": "terminate"}, cancellable=False)
-                await asyncio.wait_for(self.ipc.process.wait(), term_timeout)
+                exit_timeout = term_timeout
+                if self.results_pending:
+                    exit_timeout = max(term_timeout, self.results_timeout)
+                await asyncio.wait_for(self.ipc.process.wait(), exit_timeout)
                 logger.debug("worker exited on request (RID %s)", self.rid)
                 return
             except:
@@ -157,8 +195,8 @@ class Worker:
 
     async def _send(self, obj, cancellable=True):
         assert self.io_lock.locked()
-        line = pyon.encode(obj)
-        self.ipc.write((line + "\n").encode())
+        for data in self.codec.encode(obj):
+            self.ipc.write(data)
         ifs = [self.ipc.drain()]
         if cancellable:
             ifs.append(self.closed.wait())
@@ -179,7 +217,7 @@ class Worker:
     async def _recv(self, timeout):
         assert self.io_lock.locked()
         fs = await asyncio_wait_or_cancel(
-            [self.ipc.readline(), self.closed.wait()],
+            [self.codec.read_async(self.ipc), self.closed.wait()],
             timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
         if all(f.cancelled() for f in fs):
             raise WorkerTimeout(
@@ -188,16 +226,15 @@ class Worker:
             raise WorkerError(
                 "Receiving data from worker cancelled (RID {})".format(
                     self.rid))
-        line = fs[0].result()
-        if not line:
+        try:
+            obj = fs[0].result()
+        except EOFError:
             raise WorkerError(
                 "Worker ended while attempting to receive data (RID {})".
                 format(self.rid))
-        try:
-            obj = pyon.decode(line.decode())
         except:
-            raise WorkerError("Worker sent invalid PYON data (RID {})".format(
-                self.rid))
+            raise WorkerError("Worker sent invalid {} data (RID {})".format(
+                self.codec.name, self.rid))
         return obj
 
     async def _handle_worker_requests(self):
@@ -212,10 +249,13 @@ class Worker:
                 raise WorkerWatchdogTimeout
             action = obj["action"]
             if action == "completed":
+                if "analyze_ordered" in obj:
+                    self.analyze_ordered = obj["analyze_ordered"]
                 return True
             elif action == "pause":
                 return False
             elif action == "exception":
+                self.results_pending = True
                 raise WorkerInternalException
             elif action == "create_watchdog":
                 func = self.create_watchdog
@@ -223,6 +263,10 @@ class Worker:
                 func = self.delete_watchdog
             elif action == "register_experiment":
                 func = self.register_experiment
+            elif action == "update_datasets":
+                func = self.update_datasets
+            elif action == "get_dataset" and self.datasets_read is not None:
+                func = self._get_dataset_traced
             else:
                 func = self.handlers[action]
             try:
@@ -259,6 +303,8 @@ class Worker:
 
     async def build(self, rid, pipeline_name, wd, expid, priority,
                     timeout=15.0):
+        self.resettable = False
+        self.analyze_ordered = False
         self.rid = rid
         self.filename = os.path.basename(expid["file"])
         await self._create_process(expid["log_level"])
@@ -268,14 +314,17 @@ class Worker:
              "pipeline_name": pipeline_name,
              "wd": wd,
              "expid": expid,
-             "priority": priority},
+             "priority": priority,
+             "dataset_batching": self.dataset_batching,
+             "trace_parent_actions": self.trace_parent_actions},
             timeout)
 
     async def prepare(self):
         await self._worker_action({"action": "prepare"})
 
-    async def run(self):
-        completed = await self._worker_action({"action": "run"})
+    async def run(self, timings=None):
+        completed = await self._worker_action({"action": "run",
+                                               "timings": timings})
         if not completed:
             self.yield_time = time.monotonic()
         return completed
@@ -290,10 +339,37 @@ class Worker:
             self.yield_time = time.monotonic()
         return completed
 
-    async def analyze(self):
-        await self._worker_action({"action": "analyze"})
+    async def analyze(self, timings=None):
+        await self._worker_action({"action": "analyze", "timings": timings})
+        self.results_pending = True
+        self.resettable = True
+
+    async def reset(self):
+        """Prepares the worker process for another run, once the analyze
+        stage has completed. Reusable devices are kept."""
+        self.resettable = False
+        await self._worker_action({"action": "reset"}, self.results_timeout)
+        self.results_pending = False
+        self.rid = None
+        self.filename = None
 
-    async def examine(self, rid, file, timeout=20.0):
+    def _get_dataset_traced(self, key):
+        try:
+            value = self.handlers["get_dataset"](key)
+        except KeyError:
+            self.datasets_read[key] = None
+            raise
+        self.datasets_read[key] = (value,)
+        return value
+
+    async def examine(self, rid, file, timeout=20.0, datasets_read=None):
+        """Examines the experiments of the given file and returns their
+        descriptions.
+
+        If ``datasets_read`` is a dictionary, the datasets read by the
+        experiments are added to it, mapping their keys to a 1-tuple
+        containing the value read, or to ``None`` if the dataset did not
+        exist."""
         self.rid = rid
         self.filename = os.path.basename(file)
 
@@ -303,7 +379,150 @@ class Worker:
         def register(class_name, name, arginfo, scheduler_defaults):
             r[class_name] = {"name": name, "arginfo": arginfo, "scheduler_defaults": scheduler_defaults}
         self.register_experiment = register
-        await self._worker_action({"action": "examine", "file": file},
-                                  timeout)
+        self.datasets_read = datasets_read
+        try:
+            await self._worker_action({"action": "examine", "file": file},
+                                      timeout)
+        finally:
+            self.datasets_read = None
         del self.register_experiment
         return r
+
+
+class WorkerPool:
+    """Maintains a number of worker processes that are spawned in advance,
+    so that runs and repository scans do not have to wait for the
+    interpreter to start and import the worker dependencies.
+
+    :meth:`get` returns a :class:`Worker` that is used exactly like a
+    freshly constructed one. If an idle process is available, it is handed
+    out and a replacement is spawned in the background. Otherwise, a plain
+    worker is returned that creates its process on first use. All workers
+    use the IPC ``codec`` given (see :mod:`artiq.master.worker_codec`) and
+    the ``dataset_batching`` parameters, a ``(period, max_pending)`` tuple
+    passed to ``DatasetManager.set_batching`` in the worker process. If
+    ``trace_parent_actions`` is true, the workers save each request they
+    make to the master in the results, in addition to per-action totals.
+
+    Workers obtained from the pool are closed by passing them to
+    :meth:`release`. If ``reuse`` is true, the processes of workers that
+    have completed a run are reset and kept in the pool for another run,
+    along with the local devices marked as reusable in the device database.
+    They take the place of idle processes, so that there are never more
+    than ``size`` idle processes.
+
+    Pool size, number of idle processes, hit/miss counters and number of
+    reused processes are published through the ``stats`` notifier.
+    """
+    def __init__(self, handlers=dict(), size=0, codec="pyon",
+                 dataset_batching=None, trace_parent_actions=False,
+                 reuse=False):
+        self.handlers = handlers
+        self.size = size
+        self.codec = codec
+        self.dataset_batching = dataset_batching
+        self.trace_parent_actions = trace_parent_actions
+        self.reuse = reuse
+
+        self._idle = []
+        self._spawn_tasks = set()
+        self._closed = False
+
+        self.stats = Notifier({
+            "size": size,
+            "idle": 0,
+            "hits": 0,
+            "misses": 0,
+            "reused": 0
+        })
+
+    def start(self):
+        self._replenish()
+
+    def _replenish(self):
+        while (not self._closed
+               and len(self._idle) + len(self._spawn_tasks) < self.size):
+            task = asyncio.ensure_future(self._spawn())
+            self._spawn_tasks.add(task)
+            task.add_done_callback(self._spawn_tasks.discard)
+
+    async def _spawn(self):
+        worker = Worker(self.handlers, codec=self.codec,
+                        dataset_batching=self.dataset_batching,
+                        trace_parent_actions=self.trace_parent_actions)
+        try:
+            # The log level is set again by the worker when it receives
+            # the experiment.
+            await worker._create_process(logging.WARNING)
+        except:
+            logger.warning("failed to spawn pooled worker process",
+                           exc_info=True)
+            await worker.close()
+            return
+        if self._closed or len(self._idle) >= self.size:
+            # A reset process may have taken its place.
+            await worker.close()
+        else:
+            self._idle.append(worker)
+            self.stats["idle"] = len(self._idle)
+
+    def get(self):
+        """Returns a worker, with its process already running if one was
+        available in the pool."""
+        worker = None
+        while self._idle:
+            candidate = self._idle.pop(0)
+            if candidate.ipc.process.returncode is None:
+                worker = candidate
+                break
+            logger.warning("pooled worker process ended unexpectedly "
+                           "with status code %d",
+                           candidate.ipc.process.returncode)
+            asyncio.ensure_future(candidate.close())
+        if worker is None:
+            worker = Worker(self.handlers, codec=self.codec,
+                            dataset_batching=self.dataset_batching,
+                            trace_parent_actions=self.trace_parent_actions)
+            self.stats["misses"] = self.stats.raw_view["misses"] + 1
+        else:
+            self.stats["hits"] = self.stats.raw_view["hits"] + 1
+        self.stats["idle"] = len(self._idle)
+        self._replenish()
+        return worker
+
+    async def release(self, worker):
+        """Closes a worker obtained from :meth:`get`, or keeps its process
+        for another run if reuse is enabled."""
+        if (self.reuse and worker.resettable and not self._closed
+                and not worker.closed.is_set()
+                and worker.ipc.process.returncode is None
+                and self.size > 0):
+            try:
+                await worker.reset()
+            except:
+                logger.warning("failed to reset worker process (RID %s)",
+                               worker.rid, exc_info=True)
+            else:
+                if self._closed:
+                    await worker.close()
+                else:
+                    if len(self._idle) >= self.size:
+                        # Replaces the most recently spawned process.
+                        asyncio.ensure_future(self._idle.pop().close())
+                    # Handed out first, as it may hold reusable devices.
+                    self._idle.insert(0, worker)
+                    self.stats["idle"] = len(self._idle)
+                    self.stats["reused"] = self.stats.raw_view["reused"] + 1
+                return
+        await worker.close()
+
+    async def close(self):
+        """Terminates all idle worker processes. Workers that have been
+        handed out must be closed by their users."""
+        self._closed = True
+        if self._spawn_tasks:
+            await asyncio.wait(list(self._spawn_tasks))
+        idle, self._idle = self._idle, []
+        for worker in idle:
+            await worker.close()
+        self.stats["idle"] = 0
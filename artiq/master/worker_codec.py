@@ -0,0 +1,176 @@
+"""Message encodings for the pipe between the master and its workers.
+
+The ``pyon`` codec sends each message as one line of PYON text.
+
+The ``binary`` codec sends length-prefixed frames. NumPy arrays anywhere in
+a message (inside dicts, lists and tuples) are sent as raw buffers after the
+PYON control section instead of being encoded as text. A frame consists of:
+
+* a header with the lengths of the control section and of the buffers,
+* the control section: PYON text of the message with each array replaced
+  by ``None``, and the path, dtype and shape of each array,
+* the array buffers, concatenated in the order they are listed.
+
+The codec is selected by the master when it starts a worker process.
+"""
+
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+from sipyco import pyon
+
+
+__all__ = ["codecs", "PyonCodec", "BinaryCodec"]
+
+
+class PyonCodec:
+    name = "pyon"
+
+    def encode(self, obj):
+        """Returns the list of buffers to write for ``obj``."""
+        return [(pyon.encode(obj) + "\n").encode()]
+
+    def read(self, ipc):
+        """Reads one message from a blocking ``ipc`` channel.
+        Raises ``EOFError`` if the channel was closed."""
+        line = ipc.readline()
+        if not line:
+            raise EOFError
+        return pyon.decode(line.decode())
+
+    async def read_async(self, ipc):
+        """Reads one message from an asyncio ``ipc`` channel.
+        Raises ``EOFError`` if the channel was closed."""
+        line = await ipc.readline()
+        if not line:
+            raise EOFError
+        return pyon.decode(line.decode())
+
+
+_header = struct.Struct("<QQ")
+
+
+def _is_raw_array(obj):
+    return (isinstance(obj, np.ndarray)
+            and obj.dtype.fields is None
+            and not obj.dtype.hasobject)
+
+
+def _extract_arrays(obj, path, arrays):
+    # Returns obj with arrays replaced by None, copying only the containers
+    # that hold arrays.
+    if _is_raw_array(obj):
+        arrays.append((list(path), obj))
+        return None
+    if isinstance(obj, dict):
+        items = obj.items()
+    elif isinstance(obj, (list, tuple)):
+        items = enumerate(obj)
+    else:
+        return obj
+    n = len(arrays)
+    new_items = []
+    for k, v in items:
+        path.append(k)
+        new_items.append((k, _extract_arrays(v, path, arrays)))
+        path.pop()
+    if len(arrays) == n:
+        return obj
+    if isinstance(obj, OrderedDict):
+        return OrderedDict(new_items)
+    elif isinstance(obj, dict):
+        return dict(new_items)
+    elif isinstance(obj, tuple):
+        return tuple(v for _, v in new_items)
+    else:
+        return [v for _, v in new_items]
+
+
+def _insert_arrays(obj, tree):
+    if isinstance(obj, tuple):
+        return tuple(_insert_arrays(list(obj), tree))
+    for k, v in tree.items():
+        if isinstance(v, np.ndarray):
+            obj[k] = v
+        else:
+            obj[k] = _insert_arrays(obj[k], v)
+    return obj
+
+
+def _read_into(read, buf):
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(buf):
+        data = read(len(buf) - pos)
+        if not data:
+            raise EOFError
+        view[pos:pos+len(data)] = data
+        pos += len(data)
+    return buf
+
+
+async def _read_into_async(read, buf):
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(buf):
+        data = await read(len(buf) - pos)
+        if not data:
+            raise EOFError
+        view[pos:pos+len(data)] = data
+        pos += len(data)
+    return buf
+
+
+class BinaryCodec:
+    name = "binary"
+
+    def encode(self, obj):
+        arrays = []
+        control = _extract_arrays(obj, [], arrays)
+        control = pyon.encode({
+            "obj": control,
+            "arrays": [(path, a.dtype.str, a.shape) for path, a in arrays]
+        }).encode()
+        buffers = [
+            memoryview(np.ascontiguousarray(a).reshape(-1).view(np.uint8))
+            for _, a in arrays]
+        size = sum(b.nbytes for b in buffers)
+        return [_header.pack(len(control), size) + control] + buffers
+
+    def _decode(self, control, payload):
+        control = pyon.decode(control.decode())
+        tree = dict()
+        offset = 0
+        for path, dtype, shape in control["arrays"]:
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape, dtype=np.int64))
+            array = np.frombuffer(payload, dtype, count, offset)
+            offset += array.nbytes
+            array = array.reshape(shape)
+            if not path:
+                return array
+            node = tree
+            for k in path[:-1]:
+                node = node.setdefault(k, dict())
+            node[path[-1]] = array
+        return _insert_arrays(control["obj"], tree)
+
+    def read(self, ipc):
+        header = _read_into(ipc.read, bytearray(_header.size))
+        control_len, payload_len = _header.unpack(header)
+        control = _read_into(ipc.read, bytearray(control_len))
+        # bytearray, so that the decoded arrays are writable
+        payload = _read_into(ipc.read, bytearray(payload_len))
+        return self._decode(control, payload)
+
+    async def read_async(self, ipc):
+        header = await _read_into_async(ipc.read, bytearray(_header.size))
+        control_len, payload_len = _header.unpack(header)
+        control = await _read_into_async(ipc.read, bytearray(control_len))
+        payload = await _read_into_async(ipc.read, bytearray(payload_len))
+        return self._decode(control, payload)
+
+
+codecs = {codec.name: codec for codec in (PyonCodec(), BinaryCodec())}
@@ -7,6 +7,13 @@ standalone command line tools).
 from operator import setitem
 import importlib
 import logging
+import copy
+import time
+import threading
+from collections import deque
+
+import numpy as np
+import h5py
 
 from sipyco.sync_struct import Notifier
 from sipyco.pc_rpc import AutoTarget, Client, BestEffortClient
@@ -19,6 +26,15 @@ class DummyDevice:
     pass
 
 
+def _controller_target(desc):
+    # Automatic target can be specified either by the absence of
+    # the target_name parameter, or a None value.
+    target_name = desc.get("target_name", None)
+    if target_name is None:
+        target_name = AutoTarget
+    return target_name
+
+
 def _create_device(desc, device_mgr):
     ty = desc["type"]
     if ty == "local":
@@ -30,36 +46,151 @@ def _create_device(desc, device_mgr):
             cls = BestEffortClient
         else:
             cls = Client
-        # Automatic target can be specified either by the absence of
-        # the target_name parameter, or a None value.
-        target_name = desc.get("target_name", None)
-        if target_name is None:
-            target_name = AutoTarget
-        return cls(desc["host"], desc["port"], target_name)
+        return device_mgr.create_client(cls, desc["host"], desc["port"],
+                                        _controller_target(desc))
     elif ty == "controller_aux_target":
         controller = device_mgr.get_desc(desc["controller"])
         if desc.get("best_effort", controller.get("best_effort", False)):
             cls = BestEffortClient
         else:
             cls = Client
-        return cls(controller["host"], controller["port"], desc["target_name"])
+        return device_mgr.create_client(cls, controller["host"],
+                                        controller["port"],
+                                        desc["target_name"])
     elif ty == "dummy":
         return DummyDevice()
     else:
         raise ValueError("Unsupported type in device DB: " + ty)
 
 
+def _device_key(desc):
+    # Hashable value that compares like the device description.
+    if isinstance(desc, dict):
+        return dict, tuple(sorted((k, _device_key(v))
+                                  for k, v in desc.items()))
+    elif isinstance(desc, (list, tuple)):
+        return type(desc), tuple(_device_key(v) for v in desc)
+    elif isinstance(desc, (set, frozenset)):
+        return type(desc), frozenset(_device_key(v) for v in desc)
+    try:
+        hash(desc)
+    except TypeError:
+        return type(desc), repr(desc)
+    return desc
+
+
+def _is_reusable(desc):
+    return desc["type"] == "local" and desc.get("reusable", False)
+
+
 class DeviceError(Exception):
     pass
 
 
+class ControllerPool:
+    """Keeps the RPC clients of controllers open after use, so that later
+    requests for the same controller target do not have to connect again.
+
+    An idle client is checked with a round trip to the controller before
+    being handed out again, and is closed once it has been idle for
+    ``max_idle`` seconds. Only :class:`sipyco.pc_rpc.Client` instances are
+    pooled.
+    """
+    def __init__(self, max_idle=300.0):
+        self.max_idle = max_idle
+        # (host, port, target_name) -> [(client, time of release)]
+        self._idle = dict()
+        # id(client) -> (host, port, target_name)
+        self._active = dict()
+
+    @staticmethod
+    def _close(client):
+        try:
+            client.close_rpc()
+        except Exception as e:
+            logger.warning("Exception %r when closing controller client", e)
+
+    def get(self, host, port, target_name):
+        """Returns an open client to the given controller target."""
+        key = host, port, target_name
+        idle = self._idle.get(key, [])
+        while idle:
+            client, released = idle.pop()
+            if time.monotonic() - released < self.max_idle:
+                try:
+                    client.get_rpc_method_list()
+                except:
+                    logger.debug("pooled client of %s failed health check",
+                                 key, exc_info=True)
+                else:
+                    self._active[id(client)] = key
+                    return client
+            self._close(client)
+        client = Client(host, port, target_name)
+        self._active[id(client)] = key
+        return client
+
+    def put(self, client):
+        """Returns a client obtained from :meth:`get` to the pool, or closes
+        it if it does not come from the pool."""
+        try:
+            key = self._active.pop(id(client))
+        except KeyError:
+            self._close(client)
+        else:
+            self._idle.setdefault(key, []).append((client, time.monotonic()))
+
+    def prune(self, device_db):
+        """Closes the idle clients of controller targets that are no longer
+        in the given device database contents, and those that have been
+        idle for too long."""
+        valid = set()
+        for desc in device_db.values():
+            if not isinstance(desc, dict):
+                continue
+            if desc["type"] == "controller":
+                valid.add((desc["host"], desc["port"],
+                           _controller_target(desc)))
+            elif desc["type"] == "controller_aux_target":
+                controller = desc["controller"]
+                while isinstance(controller, str):
+                    controller = device_db.get(controller)
+                if controller is not None:
+                    valid.add((controller["host"], controller["port"],
+                               desc["target_name"]))
+        now = time.monotonic()
+        for key, idle in list(self._idle.items()):
+            kept = []
+            for client, released in idle:
+                if key in valid and now - released < self.max_idle:
+                    kept.append((client, released))
+                else:
+                    self._close(client)
+            if kept:
+                self._idle[key] = kept
+            else:
+                del self._idle[key]
+
+    def close(self):
+        """Closes all idle clients."""
+        for idle in self._idle.values():
+            for client, _released in idle:
+                self._close(client)
+        self._idle.clear()
+
+
 class DeviceManager:
     """Handles creation and destruction of local device drivers and controller
     RPC clients."""
-    def __init__(self, ddb, virtual_devices=dict()):
+    def __init__(self, ddb, virtual_devices=dict(), controller_pool=None):
         self.ddb = ddb
         self.virtual_devices = virtual_devices
-        self.active_devices = []
+        self.controller_pool = controller_pool
+        # key -> (description, device), in the order of creation
+        self.active_devices = dict()
+        # key -> keys of the devices requested while creating the device
+        self._dependencies = dict()
+        self._creating = []
 
     def get_device_db(self):
         """Returns the full contents of the device database."""
@@ -68,6 +199,13 @@ class DeviceManager:
     def get_desc(self, name):
         return self.ddb.get(name, resolve_alias=True)
 
+    def create_client(self, cls, host, port, target_name):
+        """Returns an RPC client to a controller, from the controller pool
+        if there is one."""
+        if self.controller_pool is not None and cls is Client:
+            return self.controller_pool.get(host, port, target_name)
+        return cls(host, port, target_name)
+
     def get(self, name):
         """Get the device driver or controller client corresponding to a
         device database entry."""
@@ -80,42 +218,331 @@ class DeviceManager:
             raise DeviceError("Failed to get description of device '{}'"
                               .format(name)) from e
 
-        for existing_desc, existing_dev in self.active_devices:
-            if desc == existing_desc:
-                return existing_dev
+        key = _device_key(desc)
+        if self._creating:
+            self._dependencies[self._creating[-1]].add(key)
+        try:
+            return self.active_devices[key][1]
+        except KeyError:
+            pass
 
+        self._dependencies[key] = set()
+        self._creating.append(key)
         try:
             dev = _create_device(desc, self)
         except Exception as e:
+            del self._dependencies[key]
             raise DeviceError("Failed to create device '{}'"
                               .format(name)) from e
-        self.active_devices.append((desc, dev))
+        finally:
+            self._creating.pop()
+        self.active_devices[key] = desc, dev
         return dev
 
-    def close_devices(self):
+    def _reusable_keys(self, device_db):
+        current = {_device_key(desc) for desc in device_db.values()
+                   if isinstance(desc, dict)}
+        keys = set()
+        for key, (desc, _dev) in self.active_devices.items():
+            if not _is_reusable(desc):
+                continue
+            closure = set()
+            stack = [key]
+            while stack:
+                k = stack.pop()
+                if k not in closure:
+                    closure.add(k)
+                    stack.extend(self._dependencies.get(k, ()))
+            # Devices that no longer match their entry would not be handed
+            # out again, and may hold resources needed by their replacement.
+            if closure <= current:
+                keys |= closure
+        return keys
+
+    def close_devices(self, keep_reusable=False, device_db=None):
         """Closes all active devices, in the opposite order as they were
-        requested."""
-        for _desc, dev in reversed(self.active_devices):
+        requested.
+
+        If ``keep_reusable`` is true, local devices with ``"reusable": True``
+        in their description are kept open and returned by later requests,
+        along with the devices they requested while being created. Reusable
+        devices are closed anyway if their description, or that of one of
+        these devices, is no longer in ``device_db`` (by default, the current
+        contents of the device database)."""
+        if keep_reusable:
+            if device_db is None:
+                device_db = self.get_device_db()
+            keep = self._reusable_keys(device_db)
+        else:
+            keep = set()
+        for key, (_desc, dev) in reversed(list(self.active_devices.items())):
+            if key in keep:
+                continue
             try:
-                if isinstance(dev, (Client, BestEffortClient)):
+                if (self.controller_pool is not None
+                        and isinstance(dev, Client)):
+                    self.controller_pool.put(dev)
+                elif isinstance(dev, (Client, BestEffortClient)):
                     dev.close_rpc()
                 elif hasattr(dev, "close"):
                     dev.close()
             except Exception as e:
                 logger.warning("Exception %r when closing device %r", e, dev)
-        self.active_devices.clear()
+        self.active_devices = {key: v for key, v in self.active_devices.items()
+                               if key in keep}
+        self._dependencies = {key: v for key, v in self._dependencies.items()
+                              if key in keep}
+
+
+class _StreamedDataset:
+    # Archived dataset that is written to a resizable HDF5 dataset as it
+    # grows, keeping only the last elements in memory.
+    def __init__(self, group, key, value, window):
+        self.group = group
+        self.key = key
+        self.is_array = isinstance(value, np.ndarray)
+        if self.is_array:
+            # Returned while no element is in the window.
+            self.empty = value[:0].copy()
+        self.h5 = None
+        # Encoding of variable-length strings, or None for other types
+        self.str_encoding = None
+        self.n_written = 0
+        self.buffer = []
+        self.window = deque(maxlen=window)
+        self.last_flush = time.monotonic()
+        for x in value:
+            self.append(x)
+        # Create the HDF5 dataset even if no element has been added yet, if
+        # its type is known.
+        if self.is_array:
+            self._create(value.dtype, value.shape[1:])
+        self.flush()
+
+    def _create(self, dtype, shape):
+        if self.h5 is not None:
+            return
+        if self.key in self.group:
+            del self.group[self.key]
+        if dtype.kind in "US":
+            # Later elements may be longer than the first ones.
+            self.str_encoding = "utf-8" if dtype.kind == "U" else "ascii"
+            dtype = h5py.string_dtype(self.str_encoding)
+        try:
+            self.h5 = self.group.create_dataset(
+                self.key, shape=(0,) + shape, maxshape=(None,) + shape,
+                dtype=dtype, chunks=True)
+        except TypeError as e:
+            raise TypeError("Error streaming dataset '{}' of type '{}': {}"
+                            .format(self.key, dtype, e))
+
+    def append(self, x):
+        self.buffer.append(x)
+        self.window.append(x)
+        if len(self.buffer) >= self.window.maxlen:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = np.asarray(self.buffer)
+        self._create(data.dtype, data.shape[1:])
+        if self.str_encoding is not None:
+            data = data.astype(object)
+        n = self.n_written + len(data)
+        self.h5.resize(n, axis=0)
+        self.h5[self.n_written:n] = data
+        self.n_written = n
+        self.buffer.clear()
+        self.last_flush = time.monotonic()
+
+    def mutate(self, index, value):
+        self.flush()
+        if self.h5 is None:
+            raise IndexError("Cannot mutate empty dataset '{}'"
+                             .format(self.key))
+        self.h5[index] = value
+        start = max(0, self.n_written - self.window.maxlen)
+        self.window.clear()
+        if self.str_encoding == "utf-8":
+            data = self.h5.asstr()[start:self.n_written]
+        else:
+            data = self.h5[start:self.n_written]
+        self.window.extend(data if self.is_array else data.tolist())
+
+    def get(self):
+        if self.is_array:
+            if not self.window:
+                return self.empty.copy()
+            return np.array(self.window)
+        else:
+            return list(self.window)
+
+    def discard(self):
+        if self.h5 is not None:
+            del self.group[self.key]
 
 
 class DatasetManager:
+    """Manages the datasets of an experiment, forwarding the modifications
+    of broadcast datasets to ``ddb``.
+
+    By default, each modification is forwarded immediately. After
+    :meth:`set_batching` is called with a period, modifications are held
+    back and coalesced per dataset: setting or deleting a dataset supersedes
+    all its pending modifications, and consecutive appends are folded into
+    one slice assignment. A dataset that is created and deleted again
+    before it reaches ``ddb`` is only deleted, as ``ddb`` may have had it
+    before; ``ddb.update_many`` must ignore the deletion of datasets it
+    does not have. Pending modifications
+    are forwarded by :meth:`flush`, which happens automatically once
+    ``max_pending`` modifications are pending, and from a timer thread once
+    the oldest one is ``period`` seconds old. Users of the manager should
+    flush it whenever the state of ``ddb`` matters to others; ``ddb`` must
+    allow being called from the timer thread.
+    """
     def __init__(self, ddb):
         self._broadcaster = Notifier(dict())
         self.local = dict()
         self.archive = dict()
 
         self.ddb = ddb
-        self._broadcaster.publish = ddb.update
-
-    def set(self, key, value, broadcast=False, persist=False, archive=True):
+        self._broadcaster.publish = self._publish
+
+        self.batch_period = None
+        self.batch_max_pending = 0
+        # key -> "setitem", "delitem" or list of path mods
+        self._pending = dict()
+        self._folds = dict()  # key -> pending slice assignment being extended
+        self._n_pending = 0
+        self._first_pending = None
+        self._lock = threading.RLock()
+        self._timer = None
+
+        self.stream_filename = None
+        self.stream_window = 1024
+        self.stream_flush_period = 10.0
+        self._stream_file = None
+        self._streams = dict()
+
+    def set_batching(self, period, max_pending=256):
+        """Enables batching of modifications with the given budget, or
+        disables it if ``period`` is ``None``."""
+        with self._lock:
+            self.flush()
+            self.batch_period = period
+            self.batch_max_pending = max_pending
+
+    def _publish(self, mod):
+        with self._lock:
+            if self.batch_period is None:
+                self._forward([mod])
+            else:
+                self._add_pending(mod)
+
+    def _add_pending(self, mod):
+        path = mod["path"]
+        key = path[0] if path else mod["key"]
+        pending = self._pending.get(key)
+        if not path:
+            # The value is read when flushing, so that it includes all
+            # later modifications.
+            self._folds.pop(key, None)
+            self._pending[key] = mod["action"]
+        elif pending is None or isinstance(pending, list):
+            if pending is None:
+                pending = self._pending[key] = []
+            self._add_path_mod(key, pending, mod)
+
+        self._n_pending += 1
+        now = time.monotonic()
+        if self._first_pending is None:
+            self._first_pending = now
+            self._timer = threading.Timer(self.batch_period, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+        if (self._n_pending >= self.batch_max_pending
+                or now - self._first_pending >= self.batch_period):
+            self.flush()
+
+    def _expire(self):
+        with self._lock:
+            # Ignore a timer that was cancelled too late, the next batch
+            # has its own.
+            if (self._first_pending is None
+                    or time.monotonic() - self._first_pending
+                    < self.batch_period):
+                return
+            try:
+                self.flush()
+            except Exception:
+                logger.warning("Failed to send pending dataset "
+                               "modifications", exc_info=True)
+
+    def _add_path_mod(self, key, pending, mod):
+        if mod["action"] != "append":
+            self._folds.pop(key, None)
+            pending.append({k: copy.deepcopy(v) if k == "value" else v
+                            for k, v in mod.items()})
+            return
+
+        x = copy.deepcopy(mod["x"])
+        fold = self._folds.get(key)
+        if fold is not None and fold["path"] == mod["path"]:
+            fold["value"].append(x)
+        elif (pending and pending[-1]["action"] == "append"
+                and pending[-1]["path"] == mod["path"]):
+            target = self._broadcaster.raw_view
+            for k in mod["path"]:
+                target = target[k]
+            # The target already contains both appended elements.
+            start = len(target) - 2
+            fold = {"action": "setitem", "path": mod["path"],
+                    "key": slice(start, start),
+                    "value": [pending[-1]["x"], x]}
+            pending[-1] = fold
+            self._folds[key] = fold
+        else:
+            self._folds.pop(key, None)
+            pending.append({"action": "append", "path": mod["path"], "x": x})
+
+    def flush(self):
+        """Forwards all pending modifications to ``ddb``."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._n_pending = 0
+            self._first_pending = None
+            if not self._pending:
+                return
+            mods = []
+            for key, pending in self._pending.items():
+                if pending == "setitem":
+                    mods.append({"action": "setitem", "path": [], "key": key,
+                                 "value": self._broadcaster.raw_view[key]})
+                elif pending == "delitem":
+                    mods.append({"action": "delitem", "path": [], "key": key})
+                else:
+                    mods += pending
+            self._pending.clear()
+            self._folds.clear()
+            self._forward(mods, batched=True)
+
+    def _forward(self, mods, batched=False):
+        if batched and hasattr(self.ddb, "update_many"):
+            self.ddb.update_many(mods)
+            return
+        for mod in mods:
+            try:
+                self.ddb.update(mod)
+            except KeyError:
+                # Deleting a dataset whose creation was batched away.
+                if not batched or mod["action"] != "delitem" or mod["path"]:
+                    raise
+
+    def set(self, key, value, broadcast=False, persist=False, archive=True,
+            stream=False):
         if key in self.archive:
             logger.warning("Modifying dataset '%s' which is in archive, "
                            "archive will remain untouched",
@@ -123,17 +550,57 @@ class DatasetManager:
 
         if persist:
             broadcast = True
+        if broadcast and stream:
+            # The master needs the whole value, which streaming avoids
+            # keeping.
+            raise ValueError("Dataset '{}' cannot be both broadcast and "
+                             "streamed".format(key))
 
         if broadcast:
             self._broadcaster[key] = persist, value
         elif key in self._broadcaster.raw_view:
             del self._broadcaster[key]
 
-        if archive:
+        if key in self._streams:
+            self._streams.pop(key).discard()
+        if archive and stream and self.stream_filename is not None:
+            if key in self.local:
+                del self.local[key]
+            self._streams[key] = _StreamedDataset(
+                self._get_stream_group(), key, value, self.stream_window)
+            self._flush_stream_file()
+        elif archive:
             self.local[key] = value
         elif key in self.local:
             del self.local[key]
 
+    def _get_stream_group(self):
+        if self._stream_file is None:
+            self._stream_file = h5py.File(self.stream_filename, "w")
+        return self._stream_file.require_group("datasets")
+
+    def _flush_stream_file(self):
+        for stream in self._streams.values():
+            stream.flush()
+        self._stream_file.flush()
+
+    def _check_stream_flush(self, stream):
+        if time.monotonic() - stream.last_flush >= self.stream_flush_period:
+            self._flush_stream_file()
+
+    def close_stream(self):
+        """Writes out and closes the file of streamed datasets.
+
+        Returns the name of the file, or ``None`` if no dataset was
+        streamed."""
+        if self._stream_file is None:
+            return None
+        self._flush_stream_file()
+        self._stream_file.close()
+        self._stream_file = None
+        self._streams.clear()
+        return self.stream_filename
+
     def _get_mutation_target(self, key):
         target = self.local.get(key, None)
         if key in self._broadcaster.raw_view:
@@ -145,21 +612,33 @@ class DatasetManager:
         return target
 
     def mutate(self, key, index, value):
-        target = self._get_mutation_target(key)
         if isinstance(index, tuple):
             if isinstance(index[0], tuple):
                 index = tuple(slice(*e) for e in index)
             else:
                 index = slice(*index)
-        setitem(target, index, value)
+        stream = self._streams.get(key)
+        if stream is None:
+            setitem(self._get_mutation_target(key), index, value)
+        else:
+            stream.mutate(index, value)
+            self._check_stream_flush(stream)
 
     def append_to(self, key, value):
-        self._get_mutation_target(key).append(value)
+        stream = self._streams.get(key)
+        if stream is None:
+            self._get_mutation_target(key).append(value)
+        else:
+            stream.append(value)
+            self._check_stream_flush(stream)
 
     def get(self, key, archive=False):
+        if key in self._streams:
+            return self._streams[key].get()
         if key in self.local:
             return self.local[key]
-        
+
+        self.flush()
         data = self.ddb.get(key)
         if archive:
             if key in self.archive:
@@ -169,13 +648,20 @@ class DatasetManager:
         return data
 
     def write_hdf5(self, f):
-        datasets_group = f.create_group("datasets")
-        for k, v in self.local.items():
-            _write(datasets_group, k, v)
+        write_hdf5(f, self.local, self.archive)
+
+
+def write_hdf5(f, local, archive):
+    """Writes the ``local`` and ``archive`` datasets to the HDF5 file
+    ``f``."""
+    # The groups may exist already in a file of streamed datasets.
+    datasets_group = f.require_group("datasets")
+    for k, v in local.items():
+        _write(datasets_group, k, v)
 
-        archive_group = f.create_group("archive")
-        for k, v in self.archive.items():
-            _write(archive_group, k, v)
+    archive_group = f.require_group("archive")
+    for k, v in archive.items():
+        _write(archive_group, k, v)
 
 
 def _write(group, k, v):
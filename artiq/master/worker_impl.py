@@ -11,6 +11,7 @@ import time
 import os
 import logging
 import traceback
+import threading
 from collections import OrderedDict
 
 import h5py
@@ -21,7 +22,10 @@ from sipyco.logging_tools import multiline_log_config
 
 import artiq
 from artiq.tools import file_import
-from artiq.master.worker_db import DeviceManager, DatasetManager, DummyDevice
+from artiq.master.worker_db import (DeviceManager, DatasetManager,
+                                    ControllerPool, DummyDevice, write_hdf5)
+from artiq.master.worker_codec import codecs
+from artiq.master.results_catalog import ResultsCatalog, read_entry
 from artiq.language.environment import (is_experiment, TraceArgumentManager,
                                         ProcessArgumentManager)
 from artiq.language.core import set_watchdog_factory, TerminationRequested
@@ -32,25 +36,109 @@ from artiq import __version__ as artiq_version
 
 
 ipc = None
+codec = None
+# Called before every request to the master, see DatasetManager.flush()
+flush_datasets = None
+# Held for each request and its reply, as pending dataset modifications are
+# also sent from the timer thread of the DatasetManager.
+ipc_lock = threading.Lock()
 
 
 def get_object():
-    line = ipc.readline().decode()
-    return pyon.decode(line)
+    return codec.read(ipc)
 
 
 def put_object(obj):
-    ds = pyon.encode(obj)
-    ipc.write((ds + "\n").encode())
-
-
-def make_parent_action(action):
+    for data in codec.encode(obj):
+        data = memoryview(data)
+        while data:
+            n = ipc.write(data)
+            if n is None:
+                break
+            data = data[n:]
+
+
+class ParentActionStats:
+    """Number and duration of the requests made to the master through
+    parent actions, per action.
+
+    If ``trace`` is true, the start time and duration of each request are
+    also kept.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self, trace=False):
+        self.calls = dict()  # action -> [count, total time, max time]
+        self.trace = [] if trace else None
+
+    def record(self, action, start_time, duration):
+        try:
+            calls = self.calls[action]
+        except KeyError:
+            calls = self.calls[action] = [0, 0.0, 0.0]
+        calls[0] += 1
+        calls[1] += duration
+        calls[2] = max(calls[2], duration)
+        if self.trace is not None:
+            self.trace.append((action, start_time, duration))
+
+    def copy(self):
+        r = ParentActionStats()
+        r.calls = {k: list(v) for k, v in self.calls.items()}
+        if self.trace is not None:
+            r.trace = list(self.trace)
+        return r
+
+    def total_time(self):
+        return sum(total for _, total, _ in self.calls.values())
+
+    def summary(self):
+        """Returns a text summary, with the actions taking the most time
+        first."""
+        return "; ".join(
+            "{}: {} calls, {:.1f} ms total, {:.1f} ms max".format(
+                action, count, total*1e3, max_time*1e3)
+            for action, (count, total, max_time) in sorted(
+                self.calls.items(), key=lambda x: -x[1][1]))
+
+    def write_hdf5(self, f):
+        group = f.create_group("parent_actions")
+        for action, (count, total, max_time) in self.calls.items():
+            action_group = group.create_group(action)
+            action_group["count"] = count
+            action_group["total_time"] = total
+            action_group["max_time"] = max_time
+        if self.trace:
+            trace_group = f.create_group("parent_action_trace")
+            trace_group["action"] = [x[0].encode() for x in self.trace]
+            trace_group["start_time"] = [x[1] for x in self.trace]
+            trace_group["duration"] = [x[2] for x in self.trace]
+
+
+parent_action_stats = ParentActionStats()
+# The requests of a run are logged as a warning if they take more than this
+# fraction of the time since the start of the run.
+SLOW_REQUESTS_FRACTION = 0.1
+
+
+def make_parent_action(action, flush=True):
     def parent_action(*args, **kwargs):
+        if flush and flush_datasets is not None:
+            flush_datasets()
         request = {"action": action, "args": args, "kwargs": kwargs}
-        put_object(request)
-        reply = get_object()
+        with ipc_lock:
+            start_time = time.time()
+            t0 = time.monotonic()
+            put_object(request)
+            reply = get_object()
+            parent_action_stats.record(action, start_time,
+                                       time.monotonic() - t0)
         if "action" in reply:
             if reply["action"] == "terminate":
+                # In the timer thread of the DatasetManager, this only ends
+                # the thread. The main thread receives the same reply on its
+                # next request, or the master ends the process.
                 sys.exit()
             else:
                 raise ValueError
@@ -68,7 +156,8 @@ class ParentDeviceDB:
 
 class ParentDatasetDB:
     get = make_parent_action("get_dataset")
-    update = make_parent_action("update_dataset")
+    update = make_parent_action("update_dataset", flush=False)
+    update_many = make_parent_action("update_datasets", flush=False)
 
 
 class Watchdog:
@@ -117,6 +206,16 @@ class Scheduler:
             priority = self.priority
         return self._submit(pipeline_name, expid, priority, due_date, flush)
 
+    _submit_many = staticmethod(make_parent_action("scheduler_submit_many"))
+    def submit_many(self, pipeline_name=None, expids=None, priority=None,
+                    due_dates=None, flush=False):
+        if pipeline_name is None:
+            pipeline_name = self.pipeline_name
+        if priority is None:
+            priority = self.priority
+        return self._submit_many(pipeline_name, expids, priority, due_dates,
+                                 flush)
+
     delete = staticmethod(make_parent_action("scheduler_delete"))
     request_termination = staticmethod(
         make_parent_action("scheduler_request_termination"))
@@ -127,6 +226,73 @@ class CCB:
     issue = staticmethod(make_parent_action("ccb_issue"))
 
 
+class ResultsWriter:
+    """Writes result files from a background thread, so that the worker can
+    report the end of a stage before the results are on disk.
+
+    Each file is written under a temporary name and renamed once complete.
+    :meth:`wait` must be called before the worker exits.
+    """
+    def __init__(self, catalog=None):
+        self.catalog = catalog
+        self._thread = None
+
+    def write(self, filename, write_fn, partial_filename=None):
+        """Writes ``filename`` by calling ``write_fn`` with the open file.
+
+        ``partial_filename`` is the name of a closed file that already
+        contains part of the results, such as the streamed datasets. That
+        file is completed and renamed instead of writing a new temporary
+        file. If writing fails, it is kept so that its contents can be
+        recovered.
+
+        The file is then added to the results catalog, if any."""
+        self.wait()
+        # Resolve now, in case the working directory changes meanwhile.
+        filename = os.path.abspath(filename)
+        if partial_filename is not None:
+            partial_filename = os.path.abspath(partial_filename)
+        self._thread = threading.Thread(
+            target=self._write, args=(filename, write_fn, partial_filename),
+            name="results_writer")
+        self._thread.start()
+
+    def _write(self, filename, write_fn, partial_filename):
+        if partial_filename is None:
+            tmp_filename = filename + ".tmp"
+        else:
+            tmp_filename = partial_filename
+        try:
+            with h5py.File(tmp_filename,
+                           "w" if partial_filename is None else "a") as f:
+                write_fn(f)
+                entry = read_entry(f)
+            os.replace(tmp_filename, filename)
+        except:
+            logging.error("Failed to write results to %s", filename,
+                          exc_info=True)
+            if partial_filename is None:
+                try:
+                    os.unlink(tmp_filename)
+                except OSError:
+                    pass
+            else:
+                logging.error("Partial results are kept in %s",
+                              partial_filename)
+            return
+        if self.catalog is not None:
+            try:
+                self.catalog.add(filename, entry)
+            except:
+                logging.warning("Failed to add %s to the results catalog",
+                                filename, exc_info=True)
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
 def get_exp(file, class_name):
     module = file_import(file, prefix="artiq_worker_")
     if class_name is None:
@@ -188,6 +354,16 @@ def examine(device_mgr, dataset_mgr, file):
             del sys.modules[key]
 
 
+def unload_modules(path):
+    """Removes the modules imported from files under ``path`` from
+    ``sys.modules``, so that they are imported again when needed."""
+    path = os.path.join(os.path.realpath(path), "")
+    for name, module in list(sys.modules.items()):
+        filename = getattr(module, "__file__", None)
+        if filename and os.path.realpath(filename).startswith(path):
+            del sys.modules[name]
+
+
 def setup_diagnostics(experiment_file, repository_path):
     def render_diagnostic(self, diagnostic):
         message = "While compiling {}\n".format(experiment_file) + \
@@ -214,8 +390,11 @@ def setup_diagnostics(experiment_file, repository_path):
         render_diagnostic
 
 
-def put_completed():
-    put_object({"action": "completed"})
+def put_completed(**kwargs):
+    if flush_datasets is not None:
+        flush_datasets()
+    with ipc_lock:
+        put_object(dict(kwargs, action="completed"))
 
 
 def put_exception_report():
@@ -235,48 +414,106 @@ def put_exception_report():
             lines += traceback.format_exception_only(type(exc), exc)
         logging.error("".join(lines).rstrip(),
                       exc_info=not hasattr(exc, "parent_traceback"))
-    put_object({"action": "exception"})
+    if flush_datasets is not None:
+        try:
+            flush_datasets()
+        except:
+            logging.warning("Failed to send pending dataset modifications",
+                            exc_info=True)
+    with ipc_lock:
+        put_object({"action": "exception"})
 
 
 def main():
-    global ipc
+    global ipc, codec, flush_datasets
 
     multiline_log_config(level=int(sys.argv[2]))
     ipc = pipe_ipc.ChildComm(sys.argv[1])
+    codec = codecs[sys.argv[3] if len(sys.argv) > 3 else "pyon"]
 
     start_time = None
     run_time = None
+    timings = dict()
     rid = None
     expid = None
     exp = None
     exp_inst = None
     repository_path = None
+    initial_cwd = os.getcwd()
 
-    def write_results():
-        filename = "{:09}-{}.h5".format(rid, exp.__name__)
-        with h5py.File(filename, "w") as f:
-            dataset_mgr.write_hdf5(f)
-            f["artiq_version"] = artiq_version
-            f["rid"] = rid
-            f["start_time"] = start_time
-            f["run_time"] = run_time
-            f["expid"] = pyon.encode(expid)
+    def get_results_filename():
+        return os.path.abspath("{:09}-{}.h5".format(rid, exp.__name__))
 
+    def write_results():
+        filename = get_results_filename()
+        # Streamed datasets are in a separate file, completed by the
+        # results writer.
+        stream_filename = dataset_mgr.close_stream()
+        # The experiment does not run anymore once results are written, so
+        # copying the dataset dictionaries is enough for a snapshot.
+        local = dict(dataset_mgr.local)
+        archive = dict(dataset_mgr.archive)
+        metadata = {
+            "artiq_version": artiq_version,
+            "rid": rid,
+            "start_time": start_time,
+            "run_time": run_time,
+            "expid": pyon.encode(expid)
+        }
+        stage_times = dict(timings)
+        action_stats = parent_action_stats.copy()
+        if action_stats.calls:
+            # Only runs spending a significant part of their time waiting
+            # for the master are reported above the default log level.
+            elapsed = time.time() - start_time
+            if action_stats.total_time() > SLOW_REQUESTS_FRACTION*elapsed:
+                level = logging.WARNING
+            else:
+                level = logging.INFO
+            logging.log(level, "Requests to master: %s",
+                        action_stats.summary())
+
+        def write(f):
+            write_hdf5(f, local, archive)
+            for k, v in metadata.items():
+                f[k] = v
+            timings_group = f.create_group("timings")
+            for k, v in stage_times.items():
+                timings_group[k] = v
+            action_stats.write_hdf5(f)
+        results_writer.write(filename, write, stream_filename)
+
+    # Keeps controller connections for the next run if the process is reset.
+    controller_pool = ControllerPool()
     device_mgr = DeviceManager(ParentDeviceDB,
                                virtual_devices={"scheduler": Scheduler(),
-                                                "ccb": CCB()})
+                                                "ccb": CCB()},
+                               controller_pool=controller_pool)
     dataset_mgr = DatasetManager(ParentDatasetDB)
+    flush_datasets = dataset_mgr.flush
+    # The working directory changes to the results subdirectory of the run.
+    results_writer = ResultsWriter(ResultsCatalog(os.path.abspath("results")))
 
     import_cache.install_hook()
 
     try:
         while True:
-            obj = get_object()
+            # Stops the timer of the DatasetManager before waiting for the
+            # next command, which must not interleave with its requests.
+            flush_datasets()
+            with ipc_lock:
+                obj = get_object()
             action = obj["action"]
             if action == "build":
                 start_time = time.time()
                 rid = obj["rid"]
                 expid = obj["expid"]
+                # The process may have been spawned in advance by a worker
+                # pool, before the log level of the experiment was known.
+                logging.getLogger().setLevel(expid["log_level"])
+                if obj["dataset_batching"] is not None:
+                    dataset_mgr.set_batching(*obj["dataset_batching"])
+                parent_action_stats.reset(obj["trace_parent_actions"])
                 if obj["wd"] is not None:
                     # Using repository
                     experiment_file = os.path.join(obj["wd"], expid["file"])
@@ -294,14 +531,17 @@ def main():
                                    time.strftime("%H", start_local_time))
                 os.makedirs(dirname, exist_ok=True)
                 os.chdir(dirname)
+                dataset_mgr.stream_filename = get_results_filename() + ".part"
                 argument_mgr = ProcessArgumentManager(expid["arguments"])
                 exp_inst = exp((device_mgr, dataset_mgr, argument_mgr, {}))
-                put_completed()
+                put_completed(analyze_ordered=bool(
+                    getattr(exp_inst, "analyze_ordered", False)))
             elif action == "prepare":
                 exp_inst.prepare()
                 put_completed()
             elif action == "run":
                 run_time = time.time()
+                timings = obj.get("timings") or dict()
                 try:
                     exp_inst.run()
                 except:
@@ -311,20 +551,42 @@ def main():
                     raise
                 put_completed()
             elif action == "analyze":
+                timings = obj.get("timings") or dict()
+                analyze_time = time.monotonic()
                 try:
                     exp_inst.analyze()
                     put_completed()
                 finally:
+                    timings["analyze"] = time.monotonic() - analyze_time
                     write_results()
             elif action == "examine":
                 examine(ExamineDeviceMgr, ExamineDatasetMgr, obj["file"])
                 put_completed()
+            elif action == "reset":
+                # Prepare the process for another run.
+                results_writer.wait()
+                device_db = ParentDeviceDB.get_device_db()
+                device_mgr.close_devices(keep_reusable=True,
+                                         device_db=device_db)
+                controller_pool.prune(device_db)
+                dataset_mgr = DatasetManager(ParentDatasetDB)
+                flush_datasets = dataset_mgr.flush
+                os.chdir(initial_cwd)
+                if repository_path is not None:
+                    # The next run may use another revision.
+                    unload_modules(repository_path)
+                start_time = run_time = rid = expid = None
+                exp = exp_inst = repository_path = None
+                timings = dict()
+                put_completed()
             elif action == "terminate":
                 break
     except:
         put_exception_report()
     finally:
         device_mgr.close_devices()
+        controller_pool.close()
+        results_writer.wait()
         ipc.close()
 
 
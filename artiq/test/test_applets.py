@@ -0,0 +1,27 @@
+import sys
+import unittest
+
+from artiq.applets.simple import SimpleApplet
+from artiq.master.sync_filter import filtered_notifier_name
+
+
+class SimpleAppletCase(unittest.TestCase):
+    def _args_init(self, argv):
+        applet = SimpleApplet(None)
+        applet.add_dataset("y", "Y values")
+        applet.add_dataset("x", "X values", required=False)
+        old_argv = sys.argv
+        sys.argv = ["applet"] + argv
+        try:
+            applet.args_init()
+        finally:
+            sys.argv = old_argv
+        return applet
+
+    def test_optional_dataset(self):
+        applet = self._args_init(["y_data"])
+        self.assertEqual(applet.datasets, {"y_data"})
+        self.assertEqual(filtered_notifier_name("datasets", applet.datasets),
+                         filtered_notifier_name("datasets", ["y_data"]))
+        applet = self._args_init(["y_data", "--x", "x_data"])
+        self.assertEqual(applet.datasets, {"x_data", "y_data"})
@@ -1,17 +1,25 @@
 """Tests for the (Env)Experiment-facing dataset interface."""
 
 import copy
+import os
+import tempfile
+import time
 import unittest
 
+import numpy as np
+import h5py
+
 from sipyco.sync_struct import process_mod
 
 from artiq.experiment import EnvExperiment
-from artiq.master.worker_db import DatasetManager
+from artiq.master.databases import DatasetDB
+from artiq.master.worker_db import DatasetManager, write_hdf5
 
 
 class MockDatasetDB:
     def __init__(self):
         self.data = dict()
+        self.mods = []
 
     def get(self, key):
         return self.data[key][1]
@@ -20,6 +28,7 @@ class MockDatasetDB:
         # Copy mod before applying to avoid sharing references to objects
         # between this and the DatasetManager, which would lead to mods being
         # applied twice.
+        self.mods.append(mod)
         process_mod(self.data, copy.deepcopy(mod))
 
     def delete(self, key):
@@ -103,3 +112,287 @@ class ExperimentDatasetCase(unittest.TestCase):
         with self.assertRaises(KeyError):
             self.exp.append(KEY, 0)
 
+
+
+class DatasetBatchingCase(unittest.TestCase):
+    def setUp(self):
+        self.dataset_db = MockDatasetDB()
+        self.dataset_mgr = DatasetManager(self.dataset_db)
+        self.dataset_mgr.set_batching(100.)
+        self.exp = TestExperiment((None, self.dataset_mgr, None, None))
+
+    def test_set_supersedes(self):
+        self.exp.set(KEY, [], broadcast=True)
+        for i in range(10):
+            self.exp.append(KEY, i)
+        self.assertEqual(self.dataset_db.mods, [])
+        self.dataset_mgr.flush()
+        self.assertEqual(len(self.dataset_db.mods), 1)
+        self.assertEqual(self.dataset_db.get(KEY), list(range(10)))
+
+    def test_fold_appends(self):
+        self.exp.set(KEY, [], broadcast=True)
+        self.dataset_mgr.flush()
+        for i in range(10):
+            self.exp.append(KEY, [i])
+        self.exp.mutate_dataset(KEY, 0, "a")
+        self.exp.append(KEY, 10)
+        self.exp.append(KEY, 11)
+        self.dataset_mgr.flush()
+        self.assertEqual(
+            [mod["action"] for mod in self.dataset_db.mods[1:]],
+            ["setitem", "setitem", "setitem"])
+        self.assertEqual(self.dataset_db.get(KEY),
+                         ["a"] + [[i] for i in range(1, 10)] + [10, 11])
+
+    def test_copy_values(self):
+        self.exp.set(KEY, [], broadcast=True)
+        self.dataset_mgr.flush()
+        value = [0]
+        self.exp.append(KEY, value)
+        value.append(1)
+        self.dataset_mgr.flush()
+        self.assertEqual(self.dataset_db.get(KEY), [[0]])
+
+    def test_set_delete(self):
+        self.exp.set(KEY, 0, broadcast=True)
+        self.exp.set(KEY, 1, broadcast=False)
+        self.dataset_mgr.flush()
+        # The database did not have the dataset.
+        self.assertEqual([mod["action"] for mod in self.dataset_db.mods],
+                         ["delitem"])
+        self.dataset_db.mods.clear()
+
+        # The database had the dataset before.
+        self.dataset_db.data[KEY] = (False, -1)
+        self.exp.set(KEY, 0, broadcast=True)
+        self.exp.set(KEY, 1, broadcast=False)
+        self.dataset_mgr.flush()
+        with self.assertRaises(KeyError):
+            self.dataset_db.get(KEY)
+        self.dataset_db.mods.clear()
+
+        self.exp.set(KEY, 0, broadcast=True)
+        self.dataset_mgr.flush()
+        self.exp.set(KEY, 1, broadcast=True)
+        self.exp.set(KEY, 2, broadcast=False)
+        self.dataset_mgr.flush()
+        self.assertEqual([mod["action"] for mod in self.dataset_db.mods],
+                         ["setitem", "delitem"])
+        with self.assertRaises(KeyError):
+            self.dataset_db.get(KEY)
+
+    def test_timer(self):
+        self.dataset_mgr.set_batching(0.05)
+        self.exp.set(KEY, 0, broadcast=True)
+        self.assertEqual(self.dataset_db.mods, [])
+        # Sent without any further modification.
+        time.sleep(0.5)
+        self.assertEqual(self.dataset_db.get(KEY), 0)
+
+    def test_flush_on_get(self):
+        self.exp.set(KEY, 0, broadcast=True, archive=False)
+        self.assertEqual(self.exp.get(KEY), 0)
+        self.assertEqual(len(self.dataset_db.mods), 1)
+
+    def test_budget(self):
+        self.dataset_mgr.set_batching(100., max_pending=4)
+        self.exp.set(KEY, [], broadcast=True)
+        for i in range(3):
+            self.exp.append(KEY, i)
+        self.assertEqual(len(self.dataset_db.mods), 1)
+        self.dataset_mgr.set_batching(0.)
+        self.exp.append(KEY, 3)
+        self.assertEqual(self.dataset_db.get(KEY), [0, 1, 2, 3])
+
+
+class StreamedDatasetCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "results.h5")
+        self.dataset_mgr = DatasetManager(MockDatasetDB())
+        self.dataset_mgr.stream_filename = self.filename
+        self.dataset_mgr.stream_window = 4
+        self.exp = TestExperiment((None, self.dataset_mgr, None, None))
+
+    def tearDown(self):
+        self.dataset_mgr.close_stream()
+        self.tmpdir.cleanup()
+
+    def _read(self):
+        self.assertEqual(self.dataset_mgr.close_stream(), self.filename)
+        with h5py.File(self.filename, "a") as f:
+            write_hdf5(f, self.dataset_mgr.local, self.dataset_mgr.archive)
+        with h5py.File(self.filename, "r") as f:
+            return {k: v[()] for k, v in f["datasets"].items()}
+
+    def test_stream(self):
+        self.exp.set(KEY, [], stream=True)
+        self.exp.set("other", 1)
+        for i in range(10):
+            self.exp.append(KEY, [i, i])
+        self.assertEqual(self.exp.get(KEY), [[i, i] for i in range(6, 10)])
+        self.exp.mutate_dataset(KEY, 8, [0, 0])
+        self.assertEqual(self.exp.get(KEY)[2], [0, 0])
+        datasets = self._read()
+        expected = np.array([[i, i] for i in range(10)])
+        expected[8] = 0
+        np.testing.assert_equal(datasets[KEY], expected)
+        self.assertEqual(datasets["other"], 1)
+
+    def test_stream_array(self):
+        self.exp.set(KEY, np.zeros((0, 2)), stream=True)
+        self.exp.append(KEY, np.ones(2))
+        self.assertEqual(self.exp.get(KEY).shape, (1, 2))
+        self.exp.set("empty", np.zeros((0, 3)), stream=True)
+        datasets = self._read()
+        np.testing.assert_equal(datasets[KEY], np.ones((1, 2)))
+        self.assertEqual(datasets["empty"].shape, (0, 3))
+
+    def test_stream_empty(self):
+        self.exp.set(KEY, np.zeros((0, 2)), stream=True)
+        self.assertEqual(self.exp.get(KEY).shape, (0, 2))
+
+    def test_stream_strings(self):
+        self.exp.set(KEY, ["a"], stream=True)
+        self.exp.set("array", np.array(["a", "bc"]), stream=True)
+        for i in range(6):
+            self.exp.append(KEY, "b"*i)
+        self.exp.mutate_dataset(KEY, 6, "c")
+        self.assertEqual(self.exp.get(KEY), ["bb", "bbb", "bbbb", "c"])
+        datasets = self._read()
+        self.assertEqual(list(datasets[KEY]),
+                         [b"a", b"", b"b", b"bb", b"bbb", b"bbbb", b"c"])
+        self.assertEqual(list(datasets["array"]), [b"a", b"bc"])
+
+    def test_stream_broadcast(self):
+        with self.assertRaises(ValueError):
+            self.exp.set(KEY, [], broadcast=True, stream=True)
+
+    def test_replace_stream(self):
+        self.exp.set(KEY, [1, 2], stream=True)
+        self.exp.set(KEY, 3)
+        self.assertEqual(self._read()[KEY], 3)
+
+
+class DatasetDBJournalCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.persist_file = os.path.join(self.tmpdir.name, "dataset_db.pyon")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _populate(self):
+        ddb = DatasetDB(self.persist_file, journal=True)
+        ddb.set("a", 1, persist=True)
+        ddb.set("b", [], persist=True)
+        ddb.set("c", 3)
+        ddb.update({"action": "append", "path": ["b", 1], "x": 2})
+        ddb.set("a", 4)
+        ddb.set("c", 5, persist=True)
+        ddb.set("d", 6, persist=True)
+        ddb.delete("d")
+        return ddb
+
+    def test_replay(self):
+        self._populate()
+        self.assertFalse(os.path.exists(self.persist_file))
+        ddb = DatasetDB(self.persist_file, journal=True)
+        self.assertEqual(ddb.data.raw_view,
+                         {"a": (True, 4), "b": (True, [2]), "c": (True, 5)})
+
+    def test_compact(self):
+        ddb = self._populate()
+        ddb.save()
+        with open(ddb.journal_file) as f:
+            self.assertEqual(len(f.readlines()), 1)
+        ddb.set("a", 7)
+        ddb = DatasetDB(self.persist_file, journal=True)
+        self.assertEqual(ddb.get("a"), 7)
+        self.assertEqual(ddb.get("b"), [2])
+
+    def test_truncated_tail(self):
+        ddb = self._populate()
+        ddb._close_journal()
+        with open(ddb.journal_file, "a") as f:
+            f.write("{\"action\": \"setitem\", \"pa")
+        ddb = DatasetDB(self.persist_file, journal=True)
+        self.assertEqual(ddb.get("a"), 4)
+        ddb.set("e", 8, persist=True)
+        ddb = DatasetDB(self.persist_file, journal=True)
+        self.assertEqual(ddb.get("e"), 8)
+
+    def test_stale_journal(self):
+        ddb = self._populate()
+        ddb.save()
+        journal = open(ddb.journal_file).read()
+        ddb.set("a", 9)
+        ddb.save()
+        # Simulate a crash after writing the dataset file, but before
+        # restarting the journal.
+        with open(ddb.journal_file, "w") as f:
+            f.write(journal + "{\"action\": \"delitem\", \"path\": [], "
+                    "\"key\": \"b\"}\n")
+        ddb = DatasetDB(self.persist_file, journal=True)
+        self.assertEqual(ddb.get("a"), 9)
+        self.assertEqual(ddb.get("b"), [2])
+
+
+class DatasetDBSidecarCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.persist_file = os.path.join(self.tmpdir.name, "dataset_db.pyon")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _sidecars(self, ddb):
+        return sorted(os.listdir(ddb.sidecar_dir))
+
+    def test_sidecar(self):
+        ddb = DatasetDB(self.persist_file, sidecar_threshold=1000)
+        ddb.set("small", np.arange(10), persist=True)
+        ddb.set("large", np.arange(1000), persist=True)
+        ddb.set("volatile", np.arange(1000))
+        ddb.save()
+        names = self._sidecars(ddb)
+        self.assertEqual(len(names), 1)
+        self.assertLess(os.path.getsize(self.persist_file), 1000)
+
+        ddb = DatasetDB(self.persist_file, sidecar_threshold=1000)
+        self.assertEqual(set(ddb.data.raw_view.keys()), {"small", "large"})
+        large = ddb.get("large")
+        self.assertIs(type(large), np.ndarray)
+        np.testing.assert_equal(large, np.arange(1000))
+        ddb.save()
+        self.assertEqual(self._sidecars(ddb), names)
+
+        ddb.update({"action": "setitem", "path": ["large", 1],
+                    "key": 0, "value": -1})
+        ddb.save()
+        self.assertNotEqual(self._sidecars(ddb), names)
+        self.assertEqual(len(self._sidecars(ddb)), 1)
+        ddb = DatasetDB(self.persist_file)
+        self.assertEqual(ddb.get("large")[0], -1)
+        np.testing.assert_equal(ddb.get("large")[1:], np.arange(1, 1000))
+
+        # Sidecars are turned back into PYON when disabled.
+        ddb.save()
+        self.assertEqual(self._sidecars(ddb), [])
+        ddb = DatasetDB(self.persist_file)
+        np.testing.assert_equal(ddb.get("large")[1:], np.arange(1, 1000))
+
+    def test_sidecar_journal(self):
+        ddb = DatasetDB(self.persist_file, journal=True,
+                        sidecar_threshold=1000)
+        ddb.set("large", np.arange(1000), persist=True)
+        ddb.save()
+        ddb.update({"action": "setitem", "path": ["large", 1],
+                    "key": 0, "value": -1})
+        ddb = DatasetDB(self.persist_file, journal=True,
+                        sidecar_threshold=1000)
+        self.assertEqual(ddb.get("large")[0], -1)
+        ddb.save()
+        ddb = DatasetDB(self.persist_file, sidecar_threshold=1000)
+        self.assertEqual(ddb.get("large")[0], -1)
@@ -0,0 +1,151 @@
+"""Tests for the creation and reuse of devices and controller clients by
+DeviceManager."""
+
+import asyncio
+import threading
+import unittest
+
+from sipyco.pc_rpc import Server
+
+from artiq.master.worker_db import DeviceManager, ControllerPool
+
+
+class MockDeviceDB:
+    def __init__(self, data):
+        self.data = data
+
+    def get_device_db(self):
+        return self.data
+
+    def get(self, key, resolve_alias=False):
+        desc = self.data[key]
+        if resolve_alias:
+            while isinstance(desc, str):
+                desc = self.data[desc]
+        return desc
+
+
+closed = []
+
+
+class Device:
+    def __init__(self, dmgr, name, depends=None):
+        self.name = name
+        if depends is not None:
+            self.dependency = dmgr.get(depends)
+
+    def close(self):
+        closed.append(self.name)
+
+
+def _local(name, depends=None, **kwargs):
+    desc = {
+        "type": "local",
+        "module": __name__,
+        "class": "Device",
+        "arguments": {"name": name, "depends": depends}
+    }
+    desc.update(kwargs)
+    return desc
+
+
+class DeviceManagerCase(unittest.TestCase):
+    def setUp(self):
+        closed.clear()
+        self.ddb = MockDeviceDB({
+            "core": _local("core"),
+            "ttl": _local("ttl", "core", reusable=True),
+            "ttl_alias": "ttl",
+            "other": _local("other", "core")
+        })
+        self.dmgr = DeviceManager(self.ddb)
+
+    def test_get(self):
+        ttl = self.dmgr.get("ttl")
+        self.assertIs(self.dmgr.get("ttl_alias"), ttl)
+        self.assertIs(self.dmgr.get("other").dependency, ttl.dependency)
+        self.dmgr.close_devices()
+        self.assertEqual(closed, ["other", "ttl", "core"])
+        self.assertIsNot(self.dmgr.get("ttl"), ttl)
+
+    def test_keep_reusable(self):
+        ttl = self.dmgr.get("ttl")
+        self.dmgr.get("other")
+        self.dmgr.close_devices(keep_reusable=True)
+        # Devices requested by reusable devices are kept too.
+        self.assertEqual(closed, ["other"])
+        self.assertIs(self.dmgr.get("ttl"), ttl)
+        self.assertIs(self.dmgr.get("core"), ttl.dependency)
+
+        self.dmgr.close_devices()
+        self.assertEqual(closed, ["other", "ttl", "core"])
+
+    def test_keep_reusable_changed(self):
+        ttl = self.dmgr.get("ttl")
+        self.dmgr.get("other")
+        # Changed entries are closed, along with the devices they requested.
+        self.ddb.data["ttl"] = _local("ttl2", "core", reusable=True)
+        self.dmgr.close_devices(keep_reusable=True)
+        self.assertEqual(closed, ["other", "ttl", "core"])
+        ttl2 = self.dmgr.get("ttl")
+        self.assertIsNot(ttl2, ttl)
+
+        # Reusable devices are closed when a device they requested changes.
+        closed.clear()
+        self.ddb.data["core"] = _local("core2")
+        self.dmgr.close_devices(keep_reusable=True)
+        self.assertEqual(closed, ["ttl2", "core"])
+
+        # ...and when their entry is removed.
+        closed.clear()
+        self.dmgr.get("ttl")
+        del self.ddb.data["ttl_alias"]
+        del self.ddb.data["ttl"]
+        self.dmgr.close_devices(keep_reusable=True)
+        self.assertEqual(closed, ["ttl2", "core2"])
+
+    def test_unhashable_arguments(self):
+        self.ddb.data["set"] = _local("set", channels={1, 2}, reusable=True)
+        dev = self.dmgr.get("set")
+        self.assertIs(self.dmgr.get("set"), dev)
+        self.dmgr.close_devices(keep_reusable=True)
+        self.assertIs(self.dmgr.get("set"), dev)
+
+
+class Target:
+    def ping(self):
+        return True
+
+
+class ControllerPoolCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = Server({"target": Target()})
+        self.loop.run_until_complete(self.server.start("::1", 7777))
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.run_until_complete(self.server.stop())
+        self.loop.close()
+
+    def test_pool(self):
+        desc = {"type": "controller", "host": "::1", "port": 7777}
+        pool = ControllerPool()
+        dmgr = DeviceManager(MockDeviceDB({"ctl": desc}),
+                             controller_pool=pool)
+        try:
+            client = dmgr.get("ctl")
+            self.assertTrue(client.ping())
+            dmgr.close_devices()
+            self.assertIs(dmgr.get("ctl"), client)
+            dmgr.close_devices()
+
+            # Changes of the device database invalidate the pooled client.
+            pool.prune({"ctl": dict(desc, target_name="other")})
+            self.assertIsNot(dmgr.get("ctl"), client)
+            dmgr.close_devices()
+        finally:
+            pool.close()
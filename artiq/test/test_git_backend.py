@@ -0,0 +1,161 @@
+"""Tests for the checkout of Git revisions with a shared store of files."""
+
+import hashlib
+import os
+import stat
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from artiq.master.experiments import (_CheckoutStore, GitBackend,
+                                      _GIT_FILEMODE_TREE, _GIT_FILEMODE_BLOB)
+
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+
+def _tree(git, files):
+    entries = []
+    for name, content in files.items():
+        if isinstance(content, dict):
+            oid = _tree(git, content)
+            filemode = _GIT_FILEMODE_TREE
+        else:
+            oid = hashlib.sha1(content).hexdigest()
+            git[oid] = SimpleNamespace(data=content)
+            filemode = _GIT_FILEMODE_BLOB
+        entries.append(SimpleNamespace(name=name, id=oid, filemode=filemode))
+    oid = "tree{}".format(len(git))
+    git[oid] = entries
+    return oid
+
+
+def _commit(git, files):
+    # Stand-in for a pygit2 commit, with the objects stored in git.
+    return SimpleNamespace(tree=git[_tree(git, files)])
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class CheckoutStoreCase(unittest.TestCase):
+    def setUp(self):
+        self.git = dict()
+        self.store = _CheckoutStore(self.git)
+        self.commits = [
+            _commit(self.git, {"a.py": b"a", "sub": {"b.py": b"b"}}),
+            _commit(self.git, {"a.py": b"a", "c.py": b"c"})
+        ]
+
+    def tearDown(self):
+        if os.path.exists(self.store.root):
+            self.store.close()
+
+    def _blob_files(self):
+        return [os.path.join(d, f)
+                for d, _, files in os.walk(self.store.blob_dir)
+                for f in files]
+
+    def test_share(self):
+        path1, _ = self.store.checkout(self.commits[0])
+        path2, _ = self.store.checkout(self.commits[1])
+        self.assertEqual(_read(os.path.join(path1, "sub", "b.py")), b"b")
+        self.assertEqual(_read(os.path.join(path2, "c.py")), b"c")
+        a1 = os.path.join(path1, "a.py")
+        a2 = os.path.join(path2, "a.py")
+        self.assertTrue(os.path.samefile(a1, a2))
+        self.assertEqual(stat.S_IMODE(os.stat(a1).st_mode), 0o444)
+        self.assertEqual(len(self._blob_files()), 3)
+
+    def test_dispose(self):
+        checkouts = [self.store.checkout(commit) for commit in self.commits]
+        self.store.dispose(*checkouts[0])
+        self.assertFalse(os.path.exists(checkouts[0][0]))
+        # The blob of b.py is only removed with its last link.
+        self.assertEqual(sorted(_read(f) for f in self._blob_files()),
+                         [b"a", b"c"])
+        self.assertEqual(_read(os.path.join(checkouts[1][0], "a.py")), b"a")
+        self.store.dispose(*checkouts[1])
+        self.assertEqual(self._blob_files(), [])
+
+    def test_modified(self):
+        path1, _ = self.store.checkout(self.commits[0])
+        a1 = os.path.join(path1, "a.py")
+        os.chmod(a1, 0o644)
+        with open(a1, "wb") as f:
+            f.write(b"modified")
+        path2, blobs2 = self.store.checkout(self.commits[1])
+        a2 = os.path.join(path2, "a.py")
+        self.assertEqual(_read(a2), b"a")
+        self.assertFalse(os.path.samefile(a1, a2))
+        self.store.dispose(path2, blobs2)
+        self.assertEqual(_read(a1), b"modified")
+
+    def test_close(self):
+        path, _ = self.store.checkout(self.commits[0])
+        self.store.close()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(self.store.root))
+
+
+@unittest.skipIf(pygit2 is None, "pygit2 is not installed")
+class GitBackendCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        repo = pygit2.init_repository(self.tmpdir.name)
+        signature = pygit2.Signature("test", "test@example.com")
+        self.revs = []
+        parents = []
+        for i in range(3):
+            builder = repo.TreeBuilder()
+            builder.insert("exp.py", repo.create_blob(str(i).encode()),
+                           pygit2.GIT_FILEMODE_BLOB)
+            builder.insert("lib.py", repo.create_blob(b"lib"),
+                           pygit2.GIT_FILEMODE_BLOB)
+            oid = repo.create_commit("HEAD", signature, signature,
+                                     "commit {}".format(i), builder.write(),
+                                     parents)
+            parents = [oid]
+            self.revs.append(str(oid))
+        self.backend = GitBackend(self.tmpdir.name, shared_store=True,
+                                  keep_checkouts=1)
+
+    def tearDown(self):
+        if os.path.exists(self.backend._store.root):
+            self.backend.close()
+        self.tmpdir.cleanup()
+
+    def test_keep_checkouts(self):
+        backend = self.backend
+        path0, message = backend.request_rev(self.revs[0])
+        self.assertEqual(message, "commit 0")
+        backend.release_rev(self.revs[0])
+        # The most recently released checkout is kept.
+        self.assertTrue(os.path.exists(path0))
+        self.assertEqual(backend.request_rev(self.revs[0])[0], path0)
+        backend.release_rev(self.revs[0])
+
+        path1, _ = backend.request_rev(self.revs[1])
+        path2, _ = backend.request_rev(self.revs[2])
+        self.assertTrue(os.path.samefile(os.path.join(path1, "lib.py"),
+                                         os.path.join(path2, "lib.py")))
+        backend.release_rev(self.revs[1])
+        self.assertFalse(os.path.exists(path0))
+        self.assertTrue(os.path.exists(path1))
+        backend.release_rev(self.revs[2])
+        self.assertFalse(os.path.exists(path1))
+        self.assertEqual(_read(os.path.join(path2, "exp.py")), b"2")
+
+    def test_close(self):
+        path0, _ = self.backend.request_rev(self.revs[0])
+        path1, _ = self.backend.request_rev(self.revs[1])
+        self.backend.release_rev(self.revs[1])
+        # Checkouts still in use are removed as well.
+        self.backend.close()
+        self.assertFalse(os.path.exists(path0))
+        self.assertFalse(os.path.exists(path1))
+        self.assertFalse(os.path.exists(self.backend._store.root))
@@ -0,0 +1,48 @@
+import unittest
+import logging
+
+from artiq.master.log import LogForwarder
+
+
+def _record(source, msg):
+    record = logging.LogRecord("test", logging.INFO, __file__, 0, msg,
+                               None, None)
+    record.source = source
+    return record
+
+
+class LogForwarderCase(unittest.TestCase):
+    def setUp(self):
+        self.records = []
+        self.batches = []
+        self.forwarder = LogForwarder(rate=0.0, burst=3, backlog_size=4)
+        self.forwarder.callback = self.records.append
+        self.forwarder.batch_callback = self.batches.append
+
+    def test_batches(self):
+        self.forwarder.emit(_record("a", "1"))
+        self.forwarder.emit(_record("b", "2"))
+        self.forwarder.send()
+        self.forwarder.send()
+        self.assertEqual(len(self.batches), 1)
+        seq, records = self.batches[0]
+        self.assertEqual(seq, 1)
+        self.assertEqual([(r[1], r[3]) for r in records],
+                         [("a", "test:1"), ("b", "test:2")])
+        self.assertEqual(self.records, records)
+
+    def test_rate_limit(self):
+        for i in range(5):
+            self.forwarder.emit(_record("a", str(i)))
+        self.forwarder.emit(_record("b", "x"))
+        self.forwarder.send()
+        _, records = self.batches[0]
+        self.assertEqual([(r[1], r[3]) for r in records],
+                         [("a", "test:0"), ("a", "test:1"), ("a", "test:2"),
+                          ("b", "test:x"),
+                          ("a", "artiq.master.log:2 messages suppressed")])
+        self.assertEqual(records[-1][0], logging.WARNING)
+
+        seq, backlog = self.forwarder.get_backlog()
+        self.assertEqual(seq, 1)
+        self.assertEqual(backlog, records[1:])
@@ -0,0 +1,193 @@
+"""Tests for the examination of the experiment files of a repository."""
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+from sipyco import pyon
+
+from artiq.master.worker import WorkerInternalException
+from artiq.master.experiments import _RepoScanner, _ScanCache, _blob_id
+
+
+class _Worker:
+    # Stand-in for a worker, that reads "class_name:name" pairs from the
+    # examined file. Files containing "crash" make the worker fail.
+    def __init__(self, pool):
+        self.pool = pool
+        self.closed = False
+
+    async def examine(self, rid, filename):
+        assert not self.closed
+        filename = os.path.relpath(filename, self.pool.root)
+        self.pool.examined.append(filename)
+        await asyncio.sleep(self.pool.delays.get(filename, 0.0))
+        with open(os.path.join(self.pool.root, filename)) as f:
+            text = f.read()
+        if text == "crash":
+            raise WorkerInternalException
+        description = dict()
+        for pair in text.split():
+            class_name, name = pair.split(":")
+            description[class_name] = {
+                "name": name,
+                "arginfo": {},
+                "scheduler_defaults": {}
+            }
+        return description
+
+    async def close(self):
+        self.closed = True
+
+
+class _WorkerPool:
+    def __init__(self, root, delays=dict()):
+        self.root = root
+        self.delays = delays
+        self.examined = []
+        self.workers = []
+
+    def get(self):
+        worker = _Worker(self)
+        self.workers.append(worker)
+        return worker
+
+
+class _RepositoryCase(unittest.TestCase):
+    def setUp(self):
+        if os.name == "nt":
+            self.loop = asyncio.ProactorEventLoop()
+        else:
+            self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.loop.close()
+
+    def _write(self, files):
+        for filename, text in files.items():
+            path = os.path.join(self.root, filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(text)
+
+    def _scan(self, pool, concurrency, cache=None):
+        scanner = _RepoScanner(pool, cache, concurrency)
+        return self.loop.run_until_complete(scanner.scan(self.root))
+
+
+class RepoScannerCase(_RepositoryCase):
+    def test_order(self):
+        self._write({
+            "a.py": "A:Exp",
+            "b.py": "B1:Exp B2:Exp",
+            "c.py": "C:Exp",
+            os.path.join("sub", "d.py"): "D:Exp",
+            ".hidden.py": "H:Exp",
+            "notes.txt": "T:Exp"
+        })
+        expected = [
+            ("Exp", ("a.py", "A")),
+            ("Exp1", ("b.py", "B1")),
+            ("Exp2", ("b.py", "B2")),
+            ("Exp3", ("c.py", "C")),
+            ("sub/Exp", (os.path.join("sub", "d.py"), "D"))
+        ]
+        # Duplicate names are renamed in path order, whichever worker
+        # finishes first.
+        for delays in ({"a.py": 0.05, "b.py": 0.02},
+                       {"c.py": 0.05, "b.py": 0.02}):
+            for concurrency in 1, 3:
+                pool = _WorkerPool(self.root, delays)
+                entries = self._scan(pool, concurrency)
+                self.assertEqual(
+                    [(name, (entry["file"], entry["class_name"]))
+                     for name, entry in entries.items()],
+                    expected)
+                self.assertEqual(len(pool.workers), concurrency)
+                self.assertTrue(all(w.closed for w in pool.workers))
+
+    def test_crash(self):
+        files = {"{}.py".format(c): "{}:{}".format(c, c) for c in "abcdef"}
+        files["b.py"] = "crash"
+        files["c.py"] = "crash"
+        self._write(files)
+        pool = _WorkerPool(self.root, {"a.py": 0.02})
+        entries = self._scan(pool, 2)
+        # Each file is examined once, and the crashed workers are replaced.
+        self.assertEqual(sorted(pool.examined), sorted(files.keys()))
+        self.assertEqual(sorted(entries.keys()), ["a", "d", "e", "f"])
+        self.assertEqual(len(pool.workers), 4)
+        self.assertTrue(all(w.closed for w in pool.workers))
+
+
+class ScanCacheCase(_RepositoryCase):
+    def setUp(self):
+        _RepositoryCase.setUp(self)
+        self.cache_file = os.path.join(self.root, ".cache")
+
+    def test_hit(self):
+        description = {"Exp": {"name": "Exp"}}
+        cache = _ScanCache(self.cache_file)
+        self.assertIsNone(cache.get("a.py", _blob_id(b"a")))
+        cache.set("a.py", _blob_id(b"a"), description)
+        cache.set("b.py", _blob_id(b"b"), description)
+        cache.save()
+
+        cache = _ScanCache(self.cache_file)
+        self.assertEqual(cache.get("a.py", _blob_id(b"a")), description)
+        self.assertIsNone(cache.get("a.py", _blob_id(b"a2")))
+        self.assertIsNone(cache.get("c.py", _blob_id(b"a")))
+        # Only the entries used since the last save are kept.
+        cache.save()
+        cache = _ScanCache(self.cache_file)
+        self.assertEqual(cache.get("a.py", _blob_id(b"a")), description)
+        self.assertIsNone(cache.get("b.py", _blob_id(b"b")))
+
+    def test_scan(self):
+        self._write({"a.py": "A:A", "b.py": "B:B"})
+        pool = _WorkerPool(self.root)
+        cache = _ScanCache(self.cache_file)
+        entries = self._scan(pool, 1, cache)
+        cache.save()
+        self.assertEqual(sorted(pool.examined), ["a.py", "b.py"])
+
+        # Only the file that changed is examined again.
+        self._write({"b.py": "B:C"})
+        pool = _WorkerPool(self.root)
+        cache = _ScanCache(self.cache_file)
+        new_entries = self._scan(pool, 1, cache)
+        self.assertEqual(pool.examined, ["b.py"])
+        self.assertEqual(new_entries["A"], entries["A"])
+        self.assertEqual(sorted(new_entries.keys()), ["A", "C"])
+
+    def test_version(self):
+        cache = _ScanCache(self.cache_file)
+        cache.set("a.py", _blob_id(b"a"), {})
+        cache.save()
+        data = pyon.load_file(self.cache_file)
+        data["artiq_version"] = "0.0"
+        pyon.store_file(self.cache_file, data)
+        cache = _ScanCache(self.cache_file)
+        self.assertIsNone(cache.get("a.py", _blob_id(b"a")))
+
+    def test_invalid(self):
+        for text in ("{\"artiq_version\": ", "[1, 2]", "{\"entries\": 1}"):
+            with open(self.cache_file, "w") as f:
+                f.write(text)
+            cache = _ScanCache(self.cache_file)
+            self.assertIsNone(cache.get("a.py", _blob_id(b"a")))
+            cache.set("a.py", _blob_id(b"a"), {})
+            # The invalid file is replaced.
+            cache.save()
+            cache = _ScanCache(self.cache_file)
+            self.assertEqual(cache.get("a.py", _blob_id(b"a")), {})
+            os.unlink(self.cache_file)
+
+        # Missing file
+        cache = _ScanCache(self.cache_file)
+        self.assertIsNone(cache.get("a.py", _blob_id(b"a")))
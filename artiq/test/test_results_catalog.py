@@ -0,0 +1,134 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import h5py
+
+from sipyco import pyon
+
+from artiq.master.results_catalog import ResultsCatalog, read_entry
+from artiq.master.rid_counter import RIDCounter
+
+
+def _write_result(results_dir, rid, class_name, datasets):
+    dirname = os.path.join(results_dir, "2020-01-01", "12")
+    os.makedirs(dirname, exist_ok=True)
+    filename = os.path.join(dirname, "{:09}-{}.h5".format(rid, class_name))
+    with h5py.File(filename, "w") as f:
+        group = f.create_group("datasets")
+        for k, v in datasets.items():
+            group[k] = v
+        f.create_group("archive")
+        f["rid"] = rid
+        f["start_time"] = 1.0e9 + rid
+        f["run_time"] = 1.0e9 + rid
+        f["artiq_version"] = "6.0"
+        f["expid"] = pyon.encode({"file": "exp.py", "class_name": class_name,
+                                  "repo_rev": "abc", "arguments": {}})
+    return filename
+
+
+class ResultsCatalogCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.results_dir = os.path.join(self.tmpdir.name, "results")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _runs(self, catalog):
+        db = sqlite3.connect(catalog.path)
+        try:
+            return db.execute(
+                "SELECT rid, class_name, repo_rev, "
+                "GROUP_CONCAT(key) FROM runs "
+                "LEFT JOIN datasets ON datasets.run_id = runs.id "
+                "GROUP BY runs.id ORDER BY rid").fetchall()
+        finally:
+            db.close()
+
+    def test_add_rebuild(self):
+        catalog = ResultsCatalog(self.results_dir)
+        self.assertIsNone(catalog.last_rid())
+        filenames = [_write_result(self.results_dir, rid, "Exp", {"x": rid})
+                     for rid in range(3)]
+        for filename in filenames[:2]:
+            with h5py.File(filename, "r") as f:
+                catalog.add(filename, read_entry(f))
+        with h5py.File(filenames[1], "r") as f:
+            catalog.add(filenames[1], read_entry(f))
+        self.assertEqual(catalog.last_rid(), 1)
+        self.assertEqual(self._runs(catalog),
+                         [(0, "Exp", "abc", "x"), (1, "Exp", "abc", "x")])
+
+        with open(os.path.join(os.path.dirname(filenames[0]),
+                               "000000003-Broken.h5"), "w"):
+            pass
+        self.assertEqual(catalog.rebuild(), 3)
+        self.assertEqual(catalog.last_rid(), 2)
+
+    def test_rid_counter(self):
+        cache = os.path.join(self.tmpdir.name, "last_rid.pyon")
+        _write_result(self.results_dir, 41, "Exp", {})
+        self.assertEqual(RIDCounter(cache, self.results_dir).get(), 42)
+        os.unlink(cache)
+        # The catalog takes precedence over the result files.
+        catalog = ResultsCatalog(self.results_dir)
+        with h5py.File(_write_result(self.results_dir, 50, "Exp", {}),
+                       "r") as f:
+            catalog.add(f.filename, dict(read_entry(f), rid=60))
+        self.assertEqual(RIDCounter(cache, self.results_dir).get(), 61)
+        counter = RIDCounter(cache, self.results_dir)
+        self.assertEqual(list(counter.get_many(3)), [62, 63, 64])
+        self.assertEqual(RIDCounter(cache, self.results_dir).get(), 65)
+
+        # Result files missing from the catalog are found in the directories
+        # of its last entry or later.
+        _write_result(self.results_dir, 70, "Exp", {})
+        os.unlink(cache)
+        self.assertEqual(RIDCounter(cache, self.results_dir).get(), 71)
+        # A cache that is behind the catalog is not used.
+        with open(cache, "w") as f:
+            f.write("10\n")
+        self.assertEqual(RIDCounter(cache, self.results_dir).get(), 61)
+
+    def test_readonly(self):
+        catalog = ResultsCatalog(self.results_dir)
+        self.assertEqual(catalog.query(), [])
+        self.assertEqual(catalog.count(), 0)
+        self.assertIsNone(catalog.last_rid())
+        self.assertFalse(os.path.exists(self.results_dir))
+
+    def test_query(self):
+        catalog = ResultsCatalog(self.results_dir)
+        for rid in range(6):
+            class_name = "Even" if rid % 2 == 0 else "Odd"
+            datasets = {"x": rid, "array": [rid]*10}
+            if rid >= 3:
+                datasets["y"] = "y{}".format(rid)
+            filename = _write_result(self.results_dir, rid, class_name,
+                                     datasets)
+            with h5py.File(filename, "r") as f:
+                catalog.add(filename, read_entry(f))
+
+        runs = catalog.query(class_name="Even")
+        self.assertEqual([run["rid"] for run in runs], [0, 2, 4])
+        self.assertEqual(runs[0]["path"], "2020-01-01/12/000000000-Even.h5")
+        self.assertEqual(runs[0]["repo_rev"], "abc")
+        self.assertEqual(runs[0]["datasets"], {"x": 0, "array": None})
+        self.assertEqual(runs[2]["datasets"],
+                         {"x": 4, "y": "y4", "array": None})
+
+        self.assertEqual(
+            [run["rid"] for run in catalog.query(datasets=["y"])], [3, 4, 5])
+        self.assertEqual(
+            [run["rid"] for run in catalog.query(
+                min_start_time=1.0e9 + 1, max_start_time=1.0e9 + 4)],
+            [1, 2, 3])
+        self.assertEqual(
+            [run["rid"] for run in catalog.query(min_rid=2, max_rid=4,
+                                                 offset=1, limit=1)],
+            [3])
+        self.assertEqual(catalog.count(class_name="Odd", datasets=["y"]), 2)
+        self.assertEqual(catalog.query(class_name="Other"), [])
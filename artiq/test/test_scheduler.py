@@ -17,6 +17,32 @@ class EmptyExperiment(EnvExperiment):
         pass
 
 
+class SlowPrepareExperiment(EnvExperiment):
+    def build(self):
+        pass
+
+    def prepare(self):
+        sleep(0.5)
+
+    def run(self):
+        pass
+
+
+class SlowAnalyzeExperiment(EnvExperiment):
+    def build(self):
+        pass
+
+    def run(self):
+        pass
+
+    def analyze(self):
+        sleep(1.0)
+
+
+class OrderedAnalyzeExperiment(SlowAnalyzeExperiment):
+    analyze_ordered = True
+
+
 class BackgroundExperiment(EnvExperiment):
     def build(self):
         self.setattr_device("scheduler")
@@ -83,6 +109,30 @@ class _RIDCounter:
         self._next_rid += 1
         return rid
 
+    def get_many(self, n):
+        rids = range(self._next_rid, self._next_rid + n)
+        self._next_rid += n
+        return rids
+
+
+class _BadRevisionError(Exception):
+    pass
+
+
+class _StubRepoBackend:
+    def request_rev(self, rev):
+        if rev == "bad":
+            raise _BadRevisionError(rev)
+        return None, None
+
+    def release_rev(self, rev):
+        pass
+
+
+class _StubExperimentDB:
+    cur_rev = "good"
+    repo_backend = _StubRepoBackend()
+
 
 class SchedulerCase(unittest.TestCase):
     def setUp(self):
@@ -128,6 +178,69 @@ class SchedulerCase(unittest.TestCase):
         scheduler.notifier.publish = None
         loop.run_until_complete(scheduler.stop())
 
+        scheduler.metrics.publish()
+        stages = scheduler.metrics.notifier.raw_view["pipelines"]["main"]
+        for stage in ("worker_spawn", "build", "prepare", "prepare_done",
+                      "run", "run_done", "analyze"):
+            self.assertEqual(stages[stage]["total"], 1)
+        # The timed run is deleted without leaving the pending status.
+        self.assertEqual(stages["pending"]["total"], 2)
+        self.assertEqual(stages["delete"]["total"], 2)
+        self.assertIn(
+            "artiq_scheduler_stage_seconds_count"
+            "{pipeline=\"main\",stage=\"run\"} 1",
+            scheduler.metrics.format_text())
+
+    def test_submit_many(self):
+        loop = self.loop
+        scheduler = Scheduler(_RIDCounter(0), dict(), None)
+        expid = _get_expid("EmptyExperiment")
+
+        deleted = []
+        done = asyncio.Event()
+        def notify(mod):
+            if mod["action"] == "delitem":
+                deleted.append(mod["key"])
+                if len(deleted) == 3:
+                    done.set()
+        scheduler.notifier.publish = notify
+
+        scheduler.start()
+        late = time() + 100000
+        rids = scheduler.submit_many("main", [expid]*4, 1, [None, late, None, None])
+        self.assertEqual(rids, [0, 1, 2, 3])
+        self.assertEqual(scheduler.get_status()[1]["due_date"], late)
+        self.assertEqual(scheduler.get_status()[3]["priority"], 1)
+        loop.run_until_complete(done.wait())
+        scheduler.notifier.publish = None
+        loop.run_until_complete(scheduler.stop())
+        self.assertEqual(deleted, [0, 2, 3])
+
+    def test_submit_many_error(self):
+        loop = self.loop
+        scheduler = Scheduler(_RIDCounter(0), dict(), _StubExperimentDB())
+        expid = _get_expid("EmptyExperiment")
+        bad_expid = dict(expid, repo_rev="bad")
+
+        deleted = asyncio.Queue()
+        def notify(mod):
+            if mod["action"] == "delitem":
+                deleted.put_nowait(mod["key"])
+        scheduler.notifier.publish = notify
+
+        scheduler.start()
+        # Keep the pipeline, and let its stages wait for runs.
+        scheduler.submit("main", expid, due_date=time() + 100000)
+        loop.run_until_complete(asyncio.sleep(0.1))
+        with self.assertRaises(_BadRevisionError):
+            scheduler.submit_many("main", [expid, bad_expid, expid])
+        # The run submitted before the error is still executed.
+        self.assertEqual(loop.run_until_complete(
+            asyncio.wait_for(deleted.get(), 10)), 1)
+        self.assertEqual(list(scheduler.get_status().keys()), [0])
+        scheduler.notifier.publish = None
+        loop.run_until_complete(scheduler.stop())
+
     def test_pending_priority(self):
         """Check due dates take precedence over priorities when waiting to
         prepare."""
@@ -428,5 +541,71 @@ class SchedulerCase(unittest.TestCase):
         loop.run_until_complete(done.wait())
         loop.run_until_complete(scheduler.stop())
 
+    def test_prepare_ahead(self):
+        loop = self.loop
+        scheduler = Scheduler(_RIDCounter(0), dict(), None,
+                              pipeline_prepare_ahead={"main": 3})
+        self.assertEqual(scheduler.get_prepare_ahead("main"), 3)
+        self.assertEqual(scheduler.get_prepare_ahead("other"), 1)
+        expid = _get_expid("SlowPrepareExperiment")
+
+        statuses = []
+        done = asyncio.Event()
+        def notify(mod):
+            if mod["path"] and mod["key"] == "status":
+                statuses.append((mod["path"][0], mod["value"]))
+            if mod["action"] == "delitem" and mod["key"] == 2:
+                done.set()
+        scheduler.notifier.publish = notify
+
+        scheduler.start()
+        for i in range(3):
+            scheduler.submit("main", expid, 0, None, False)
+        loop.run_until_complete(done.wait())
+        scheduler.notifier.publish = None
+        loop.run_until_complete(scheduler.stop())
+
+        # All runs are prepared concurrently, and in priority order.
+        self.assertEqual(statuses[:3], [(0, "preparing"), (1, "preparing"),
+                                        (2, "preparing")])
+        running = [rid for rid, status in statuses if status == "running"]
+        self.assertEqual(running, [0, 1, 2])
+
+    def test_analyze_concurrency(self):
+        loop = self.loop
+        scheduler = Scheduler(_RIDCounter(0), dict(), None,
+                              prepare_ahead=4, analyze_concurrency=3)
+        expid = _get_expid("SlowAnalyzeExperiment")
+        expid_ordered = _get_expid("OrderedAnalyzeExperiment")
+
+        statuses = []
+        done = asyncio.Event()
+        def notify(mod):
+            if mod["path"] and mod["key"] == "status":
+                statuses.append((mod["path"][0], mod["value"]))
+            if mod["action"] == "delitem" and mod["key"] == 3:
+                done.set()
+        scheduler.notifier.publish = notify
+
+        scheduler.start()
+        scheduler.submit("main", expid, 0, None, False)
+        scheduler.submit("main", expid, 0, None, False)
+        scheduler.submit("main", expid_ordered, 0, None, False)
+        scheduler.submit("main", expid, 0, None, False)
+        loop.run_until_complete(done.wait())
+        scheduler.notifier.publish = None
+        loop.run_until_complete(scheduler.stop())
+
+        # RIDs 0 and 1 are analyzed concurrently, then the ordered RID 2
+        # alone, then RID 3.
+        analyze = [(rid, status) for rid, status in statuses
+                   if status in ("analyzing", "deleting")]
+        self.assertEqual(sorted(analyze[:2]), [(0, "analyzing"),
+                                              (1, "analyzing")])
+        self.assertEqual(sorted(analyze[2:4]), [(0, "deleting"),
+                                               (1, "deleting")])
+        self.assertEqual(analyze[4:], [(2, "analyzing"), (2, "deleting"),
+                                       (3, "analyzing"), (3, "deleting")])
+
     def tearDown(self):
         self.loop.close()
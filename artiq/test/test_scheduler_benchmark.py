@@ -0,0 +1,415 @@
+"""Benchmarks of the scheduler, which do not require hardware.
+
+:class:`SchedulerBenchmarkCase` measures the run selection of the scheduler
+stages. The runs are never handed to a worker process; their status is
+advanced directly, so that only the bookkeeping of the scheduler is
+measured.
+
+:class:`SchedulerThroughputCase` drives a complete :class:`Scheduler`
+through several scenarios (submission bursts, one run at a time and in a
+batch, preemption of a run that pauses, due date storms and many
+pipelines) and reports the throughput and the latency distributions of the
+scheduler stages. The experiments of this
+module are emulated in-process by stub workers, so that the overhead of the
+scheduler dominates. :class:`SchedulerWorkerThroughputCase` runs the same
+scenarios with fewer runs through real worker processes, for end-to-end
+numbers. It is skipped unless the ``ARTIQ_BENCHMARK_WORKERS`` environment
+variable is set.
+
+By default, the benchmarks only use a few runs, as a fast check that the
+scenarios complete. Set the ``ARTIQ_BENCHMARK`` environment variable for
+the full benchmarks.
+"""
+
+import unittest
+import asyncio
+import logging
+import os
+import sys
+import time
+import tempfile
+
+from sipyco.sync_struct import Notifier
+
+from artiq.experiment import *
+from artiq.master.scheduler import (Scheduler, RunStatus, RunPool,
+                                    PrepareStage, RunStage, AnalyzeStage)
+from artiq.master.worker import WorkerPool
+
+
+artiq_benchmark = os.getenv("ARTIQ_BENCHMARK")
+artiq_benchmark_workers = os.getenv("ARTIQ_BENCHMARK_WORKERS")
+
+N_RUNS = 10000 if artiq_benchmark else 200
+
+
+class EmptyExperiment(EnvExperiment):
+    def build(self):
+        pass
+
+    def run(self):
+        pass
+
+
+class PausingExperiment(EnvExperiment):
+    def build(self):
+        self.setattr_device("scheduler")
+
+    def run(self):
+        try:
+            while True:
+                time.sleep(0.001)
+                if self.scheduler.check_pause():
+                    self.scheduler.pause()
+        except TerminationRequested:
+            pass
+
+
+def _get_expid(class_name="EmptyExperiment"):
+    return {
+        "log_level": logging.WARNING,
+        "file": sys.modules[__name__].__file__,
+        "class_name": class_name,
+        "arguments": dict()
+    }
+
+
+class _RIDCounter:
+    def __init__(self, next_rid):
+        self._next_rid = next_rid
+
+    def get(self):
+        rid = self._next_rid
+        self._next_rid += 1
+        return rid
+
+    def get_many(self, n):
+        rids = range(self._next_rid, self._next_rid + n)
+        self._next_rid += n
+        return rids
+
+
+class SchedulerBenchmarkCase(unittest.TestCase):
+    def setUp(self):
+        if os.name == "nt":
+            self.loop = asyncio.ProactorEventLoop()
+        else:
+            self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    async def _drain(self, pool):
+        prepare = PrepareStage(pool, None)
+        run_stage = RunStage(pool, None)
+        analyze = AnalyzeStage(pool, None)
+        order = []
+        while pool.runs:
+            run = prepare._get_run()
+            run.status = RunStatus.preparing
+            run.status = RunStatus.prepare_done
+            run = run_stage.get_run()
+            run.status = RunStatus.running
+            run.status = RunStatus.run_done
+            run = analyze._get_run()
+            run.status = RunStatus.analyzing
+            run.status = RunStatus.deleting
+            order.append(run.rid)
+            await pool.delete(run.rid)
+        return order
+
+    def test_drain(self):
+        pool = RunPool(_RIDCounter(0), WorkerPool(), Notifier(dict()), None)
+
+        t0 = time.monotonic()
+        for i in range(N_RUNS):
+            pool.submit(_get_expid(), i % 10, None, False, "main")
+        t1 = time.monotonic()
+        order = self.loop.run_until_complete(self._drain(pool))
+        t2 = time.monotonic()
+
+        # Highest priority first, then lowest RID first.
+        self.assertEqual(order, sorted(range(N_RUNS),
+                                       key=lambda rid: (-(rid % 10), rid)))
+
+        print()
+        print("| Step   | Runs/s   |")
+        print("| ------ | -------- |")
+        print("| submit | {:>8.0f} |".format(N_RUNS/(t1 - t0)))
+        print("| drain  | {:>8.0f} |".format(N_RUNS/(t2 - t1)))
+
+    def tearDown(self):
+        self.loop.close()
+
+
+class _StubWorker:
+    """Stand-in for :class:`~artiq.master.worker.Worker` that emulates the
+    experiments of this module without a worker process."""
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.closed = asyncio.Event()
+        self.ipc = None
+        self.spawn_time = None
+        self.analyze_ordered = False
+        self.rid = None
+        self.class_name = None
+
+    async def build(self, rid, pipeline_name, wd, expid, priority):
+        self.rid = rid
+        self.class_name = expid["class_name"]
+        await asyncio.sleep(0)
+
+    async def prepare(self):
+        await asyncio.sleep(0)
+
+    async def _pausing_loop(self):
+        check_pause = self.handlers["scheduler_check_pause"]
+        while True:
+            await asyncio.sleep(0.001)
+            if check_pause(self.rid):
+                return False
+
+    async def run(self, timings=None):
+        if self.class_name == "PausingExperiment":
+            return await self._pausing_loop()
+        await asyncio.sleep(0)
+        return True
+
+    async def resume(self, request_termination):
+        if request_termination:
+            return True
+        return await self._pausing_loop()
+
+    async def analyze(self, timings=None):
+        await asyncio.sleep(0)
+
+    async def close(self):
+        self.closed.set()
+
+
+class _StubWorkerPool:
+    def __init__(self, handlers):
+        self.handlers = handlers
+
+    def get(self):
+        return _StubWorker(self.handlers)
+
+    async def release(self, worker):
+        await worker.close()
+
+
+class _StageSamples:
+    """Collects the stage durations recorded by the scheduler, for all
+    pipelines together. Used in place of
+    :class:`~artiq.master.metrics.StageMetrics`."""
+    def __init__(self):
+        self.samples = dict()
+
+    def record(self, pipeline_name, stage, duration):
+        self.samples.setdefault(stage, []).append(duration)
+
+
+class _Harness:
+    """Scheduler with stub worker handlers, which records the time between
+    the moment each run could start (submission or due date) and its first
+    ``running`` status as the ``start`` stage."""
+    def __init__(self, real_workers):
+        handlers = {
+            "get_device_db": lambda: {},
+            "get_device": lambda key, resolve_alias=False: {"type": "dummy"},
+            "get_dataset": lambda key: 0,
+            "update_dataset": lambda mod: None
+        }
+        if real_workers:
+            worker_pool = None
+        else:
+            worker_pool = _StubWorkerPool(handlers)
+        self.scheduler = Scheduler(_RIDCounter(0), handlers, None,
+                                   worker_pool)
+        handlers["scheduler_check_pause"] = self.scheduler.check_pause
+        self.stages = _StageSamples()
+        self.scheduler.metrics = self.stages
+        self.scheduler.notifier.publish = self._publish
+
+        self._eligible = dict()
+        self._deleted = 0
+        self._expected = None
+        self._done = asyncio.Event()
+
+    def submit(self, class_name="EmptyExperiment", pipeline_name="main",
+               priority=0, due_date=None):
+        eligible = time.time()
+        if due_date is not None:
+            eligible = max(eligible, due_date)
+        rid = self.scheduler.submit(pipeline_name, _get_expid(class_name),
+                                    priority, due_date)
+        self._eligible[rid] = eligible
+        return rid
+
+    def submit_many(self, n, class_name="EmptyExperiment",
+                    pipeline_name="main"):
+        eligible = time.time()
+        rids = self.scheduler.submit_many(
+            pipeline_name, [_get_expid(class_name) for i in range(n)])
+        for rid in rids:
+            self._eligible[rid] = eligible
+        return rids
+
+    def _publish(self, mod):
+        if mod["action"] == "delitem" and not mod["path"]:
+            self._deleted += 1
+            if self._deleted == self._expected:
+                self._done.set()
+        elif (mod["path"] and mod["key"] == "status"
+                and mod["value"] == "running"):
+            eligible = self._eligible.pop(mod["path"][0], None)
+            if eligible is not None:
+                self.stages.record(None, "start", time.time() - eligible)
+
+    async def wait_deleted(self, n):
+        """Waits until ``n`` runs have been deleted in total."""
+        self._expected = n
+        if self._deleted < n:
+            self._done.clear()
+            await self._done.wait()
+
+    async def wait_status(self, rid, status):
+        while self.scheduler.get_status()[rid]["status"] != status:
+            await asyncio.sleep(0.001)
+
+
+def _ms(duration):
+    return "{:>9.3f}".format(1e3*duration)
+
+
+def _print_report(results):
+    print()
+    print("| Scenario    | Runs  | Runs/s   |")
+    print("| ----------- | ----- | -------- |")
+    for name, n, rate, _ in results:
+        print("| {:11} | {:>5} | {:>8.1f} |".format(name, n, rate))
+    print()
+    print("| Scenario    | Stage        | Count | p50 (ms)  | p90 (ms)  "
+          "| p99 (ms)  | Max (ms)  |")
+    print("| ----------- | ------------ | ----- | --------- | --------- "
+          "| --------- | --------- |")
+    for name, _, _, stages in results:
+        for stage, samples in sorted(stages.samples.items()):
+            samples = sorted(samples)
+            quantiles = [samples[min(int(q*len(samples)), len(samples) - 1)]
+                         for q in (0.5, 0.9, 0.99)]
+            print("| {:11} | {:12} | {:>5} | {} | {} | {} | {} |".format(
+                name, stage, len(samples), *map(_ms, quantiles),
+                _ms(samples[-1])))
+
+
+class SchedulerThroughputCase(unittest.TestCase):
+    real_workers = False
+    if artiq_benchmark:
+        n_burst = 2000
+        n_preempt = 200
+        n_due = 1000
+        n_pipelines = 50
+        n_pipeline_runs = 20
+    else:
+        n_burst = 50
+        n_preempt = 20
+        n_due = 50
+        n_pipelines = 5
+        n_pipeline_runs = 4
+
+    def setUp(self):
+        if os.name == "nt":
+            self.loop = asyncio.ProactorEventLoop()
+        else:
+            self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    async def _burst(self, harness):
+        for i in range(self.n_burst):
+            harness.submit()
+        await harness.wait_deleted(self.n_burst)
+        return self.n_burst
+
+    async def _batch(self, harness):
+        harness.submit_many(self.n_burst)
+        await harness.wait_deleted(self.n_burst)
+        return self.n_burst
+
+    async def _preempt(self, harness):
+        # Each run preempts the background run, which pauses.
+        background = harness.submit("PausingExperiment", priority=-1)
+        await harness.wait_status(background, "running")
+        for i in range(self.n_preempt):
+            harness.submit()
+        await harness.wait_deleted(self.n_preempt)
+        harness.scheduler.request_termination(background)
+        await harness.wait_deleted(self.n_preempt + 1)
+        return self.n_preempt + 1
+
+    async def _due_dates(self, harness):
+        # Due dates spread over 0.5s in shuffled order, with a few already
+        # elapsed and a few priorities.
+        now = time.time()
+        for i in range(self.n_due):
+            offset = (i*7919 % self.n_due)/self.n_due
+            harness.submit(priority=i % 3, due_date=now + 0.5*offset - 0.05)
+        await harness.wait_deleted(self.n_due)
+        return self.n_due
+
+    async def _pipelines(self, harness):
+        n = self.n_pipelines*self.n_pipeline_runs
+        for i in range(n):
+            harness.submit(pipeline_name="p{}".format(i % self.n_pipelines))
+        await harness.wait_deleted(n)
+        return n
+
+    def _run_scenario(self, scenario):
+        harness = _Harness(self.real_workers)
+        harness.scheduler.start()
+        try:
+            t0 = time.monotonic()
+            n = self.loop.run_until_complete(scenario(harness))
+            t1 = time.monotonic()
+        finally:
+            self.loop.run_until_complete(harness.scheduler.stop())
+        self.assertEqual(harness.scheduler.get_status(), dict())
+        return n, n/(t1 - t0), harness.stages
+
+    def test_throughput(self):
+        results = []
+        for name, scenario in [("burst", self._burst),
+                               ("batch", self._batch),
+                               ("preempt", self._preempt),
+                               ("due_dates", self._due_dates),
+                               ("pipelines", self._pipelines)]:
+            results.append((name, ) + self._run_scenario(scenario))
+        _print_report(results)
+
+        stages = dict((r[0], r[3].samples) for r in results)
+        self.assertEqual(len(stages["burst"]["start"]), self.n_burst)
+        self.assertGreaterEqual(len(stages["preempt"]["paused"]),
+                                self.n_preempt//10)
+
+    def tearDown(self):
+        self.loop.close()
+
+
+@unittest.skipUnless(artiq_benchmark_workers, "no ARTIQ_BENCHMARK_WORKERS")
+class SchedulerWorkerThroughputCase(SchedulerThroughputCase):
+    real_workers = True
+    n_burst = 20
+    n_preempt = 5
+    n_due = 20
+    n_pipelines = 5
+    n_pipeline_runs = 4
+
+    def setUp(self):
+        SchedulerThroughputCase.setUp(self)
+        # The workers write the results into the current directory.
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+        SchedulerThroughputCase.tearDown(self)
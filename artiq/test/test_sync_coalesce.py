@@ -0,0 +1,63 @@
+import unittest
+import asyncio
+
+from sipyco.sync_struct import Notifier
+
+from artiq.master.sync_coalesce import CoalescedNotifier
+
+
+class CoalescedNotifierCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.source = Notifier({0: {"status": "running"}})
+        self.coalescer = CoalescedNotifier(self.source, 0.01)
+        self.mods = []
+        self.coalescer.notifier.publish = self.mods.append
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_flush(self):
+        self.source[1] = {"status": "pending", "priority": 0}
+        self.source[1]["status"] = "preparing"
+        self.source[1]["status"] = "prepare_done"
+        self.source[0]["status"] = "run_done"
+        self.source[0]["status"] = "analyzing"
+        self.source[2] = {"status": "pending"}
+        del self.source[2]
+        self.assertEqual(self.mods, [])
+        self.coalescer.flush()
+        self.assertEqual(self.mods, [
+            {"action": "setitem", "path": [], "key": 1,
+             "value": {"status": "prepare_done", "priority": 0}},
+            {"action": "setitem", "path": [0], "key": "status",
+             "value": "analyzing"}
+        ])
+        self.assertEqual(self.coalescer.notifier.raw_view,
+                         self.source.raw_view)
+
+        # Changes are detected as the copy does not share the dictionaries
+        # of the source.
+        self.mods.clear()
+        self.source[1]["status"] = "running"
+        del self.source[0]
+        self.coalescer.flush()
+        self.assertEqual(self.mods, [
+            {"action": "setitem", "path": [1], "key": "status",
+             "value": "running"},
+            {"action": "delitem", "path": [], "key": 0}
+        ])
+
+    def test_period(self):
+        self.coalescer.start()
+        try:
+            self.source[0]["status"] = "run_done"
+            self.source[0]["status"] = "analyzing"
+            self.loop.run_until_complete(asyncio.sleep(0.1))
+            self.assertEqual(self.mods, [
+                {"action": "setitem", "path": [0], "key": "status",
+                 "value": "analyzing"}
+            ])
+        finally:
+            self.loop.run_until_complete(self.coalescer.stop())
@@ -0,0 +1,77 @@
+import unittest
+import asyncio
+
+from sipyco import sync_struct
+from sipyco.sync_struct import Notifier, Subscriber
+
+from artiq.master import sync_filter
+from artiq.master.sync_filter import FilteredPublisher, filtered_notifier_name
+
+
+class FilteredPublisherCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def _subscribe(self, port, notifier_name):
+        mods = []
+        data = dict()
+
+        def init(x):
+            data.update(x)
+            return data
+        subscriber = Subscriber(notifier_name, init, mods.append)
+        await subscriber.connect("127.0.0.1", port)
+        return subscriber, data, mods
+
+    async def _test(self):
+        datasets = Notifier({"a.x": (False, 1), "b": (False, 2)})
+        publisher = FilteredPublisher({"datasets": datasets},
+                                      filterable=["datasets"])
+        await publisher.start("127.0.0.1", 0)
+        port = publisher.server.sockets[0].getsockname()[1]
+        try:
+            subscribers = [
+                await self._subscribe(port, "datasets"),
+                await self._subscribe(
+                    port, filtered_notifier_name("datasets", ["c"], ["a."]))
+            ]
+            while not all(mods for _, _, mods in subscribers):
+                await asyncio.sleep(0.01)
+
+            datasets["b"] = (False, [])
+            datasets["b"][1].append(3)
+            datasets["c"] = (False, [])
+            datasets["c"][1].append(4)
+            datasets["a.y"] = (False, 5)
+            del datasets["a.x"]
+            while len(subscribers[0][2]) < 7 or len(subscribers[1][2]) < 5:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)
+
+            full, filtered = subscribers
+            self.assertEqual(full[1], datasets.raw_view)
+            self.assertEqual(len(full[2]), 7)
+            self.assertEqual(filtered[1],
+                             {"c": (False, [4]), "a.y": (False, 5)})
+            self.assertEqual(len(filtered[2]), 5)
+            self.assertEqual(filtered[2][0]["struct"], {"a.x": (False, 1)})
+            for subscriber, _, _ in subscribers:
+                await subscriber.close()
+        finally:
+            await publisher.stop()
+
+    def test_filter(self):
+        self.loop.run_until_complete(self._test())
+
+    def test_name(self):
+        self.assertEqual(filtered_notifier_name("datasets", {"y", None}),
+                         filtered_notifier_name("datasets", ["y"]))
+
+    def test_protocol_version(self):
+        # FilteredPublisher implements the protocol of sipyco subscribers.
+        self.assertEqual(sync_filter._protocol_banner,
+                         sync_struct._protocol_banner)
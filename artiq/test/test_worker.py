@@ -3,10 +3,16 @@ import logging
 import asyncio
 import sys
 import os
+import glob
+import tempfile
 from time import sleep
 
+import h5py
+
 from artiq.experiment import *
 from artiq.master.worker import *
+from artiq.master.experiments import ExamineCache
+from artiq.master.results_catalog import ResultsCatalog
 
 
 class SimpleExperiment(EnvExperiment):
@@ -53,6 +59,41 @@ class WatchdogTimeoutInBuild(EnvExperiment):
         pass
 
 
+class AppendDatasets(EnvExperiment):
+    def build(self):
+        pass
+
+    def run(self):
+        self.set_dataset("points", [], broadcast=True)
+        for i in range(100):
+            self.append_to_dataset("points", i)
+        self.set_dataset("count", 100, broadcast=True)
+
+
+class ResultsExperiment(EnvExperiment):
+    def build(self):
+        pass
+
+    def run(self):
+        self.set_dataset("result", 42)
+        self.set_dataset("points", [], stream=True)
+        for i in range(100):
+            self.append_to_dataset("points", i)
+
+
+class StreamCrashExperiment(EnvExperiment):
+    def build(self):
+        pass
+
+    def run(self):
+        self.set_dataset("points", [], stream=True)
+        for i in range(100):
+            self.append_to_dataset("points", i)
+        # Cannot be written to HDF5.
+        self.set_dataset("invalid", {"a": 1})
+        raise TypeError
+
+
 async def _call_worker(worker, expid):
     try:
         await worker.build(0, "main", None, expid, 0)
@@ -63,18 +104,80 @@ async def _call_worker(worker, expid):
         await worker.close()
 
 
-def _run_experiment(class_name):
-    expid = {
+class ParentActionsExperiment(EnvExperiment):
+    def build(self):
+        pass
+
+    def run(self):
+        for i in range(3):
+            with watchdog(10*s):
+                pass
+
+
+def _get_expid(class_name):
+    return {
         "log_level": logging.WARNING,
         "file": sys.modules[__name__].__file__,
         "class_name": class_name,
         "arguments": dict()
     }
+
+
+def _run_experiment(class_name, **kwargs):
+    expid = _get_expid(class_name)
     loop = asyncio.get_event_loop()
-    worker = Worker({})
+    worker = Worker({}, **kwargs)
     loop.run_until_complete(_call_worker(worker, expid))
 
 
+async def _call_pooled_worker(pool, expid):
+    pool.start()
+    try:
+        while not pool.stats.raw_view["idle"]:
+            await asyncio.sleep(0.1)
+        # The second worker is requested before the replacement process
+        # has been spawned.
+        workers = [pool.get(), pool.get()]
+        for worker in workers:
+            await _call_worker(worker, expid)
+    finally:
+        await pool.close()
+
+
+async def _call_reused_worker(pool, expid):
+    pool.start()
+    try:
+        while not pool.stats.raw_view["idle"]:
+            await asyncio.sleep(0.1)
+        worker = pool.get()
+        process = worker.ipc.process
+        await worker.build(0, "main", None, expid, 0)
+        await worker.prepare()
+        await worker.run()
+        await worker.analyze()
+        await pool.release(worker)
+        # The process of the first run is handed out again.
+        worker = pool.get()
+        assert worker.ipc.process is process
+        await _call_worker(worker, expid)
+    finally:
+        await pool.close()
+
+
+_examined_experiment = """
+from artiq.experiment import *
+
+class DatasetDefault(EnvExperiment):
+    def build(self):
+        self.setattr_argument("n", NumberValue(self.get_dataset("n", 1)))
+        self.setattr_argument("m", NumberValue(self.get_dataset("m", 2)))
+"""
+
+
+def _get_default(description, argument):
+    return description["DatasetDefault"]["arginfo"][argument][0]["default"]
+
+
 class WorkerCase(unittest.TestCase):
     def setUp(self):
         if os.name == "nt":
@@ -105,5 +208,137 @@ class WorkerCase(unittest.TestCase):
         with self.assertRaises(WorkerWatchdogTimeout):
             _run_experiment("WatchdogTimeoutInBuild")
 
+    def test_pool(self):
+        pool = WorkerPool({}, size=1)
+        self.loop.run_until_complete(
+            _call_pooled_worker(pool, _get_expid("SimpleExperiment")))
+        self.assertEqual(pool.stats.raw_view["hits"], 1)
+        self.assertEqual(pool.stats.raw_view["misses"], 1)
+        self.assertEqual(pool.stats.raw_view["idle"], 0)
+
+    def test_pool_reuse(self):
+        pool = WorkerPool({}, size=1, reuse=True)
+        self.loop.run_until_complete(
+            _call_reused_worker(pool, _get_expid("SimpleExperiment")))
+        self.assertEqual(pool.stats.raw_view["reused"], 1)
+        self.assertEqual(pool.stats.raw_view["hits"], 2)
+        self.assertEqual(pool.stats.raw_view["misses"], 0)
+
+    def test_dataset_batching(self):
+        mods = []
+        worker = Worker({"update_dataset": mods.append},
+                        dataset_batching=(100.0, 256))
+        self.loop.run_until_complete(
+            _call_worker(worker, _get_expid("AppendDatasets")))
+        self.assertEqual([mod["key"] for mod in mods], ["points", "count"])
+        self.assertEqual(mods[0]["value"], (False, list(range(100))))
+
+    def test_results(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                _run_experiment("ResultsExperiment")
+            finally:
+                os.chdir(cwd)
+            filenames = glob.glob(os.path.join(tmpdir, "results", "*", "*",
+                                               "*"))
+            self.assertEqual([os.path.basename(f) for f in filenames],
+                             ["000000000-ResultsExperiment.h5"])
+            with h5py.File(filenames[0], "r") as f:
+                self.assertEqual(f["datasets"]["result"][()], 42)
+                self.assertEqual(list(f["datasets"]["points"][()]),
+                                 list(range(100)))
+                self.assertEqual(f["rid"][()], 0)
+                self.assertIn("analyze", f["timings"])
+            self.assertEqual(
+                ResultsCatalog(os.path.join(tmpdir, "results")).last_rid(), 0)
+
+    def test_results_stream_crash(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                with self.assertLogs() as logs:
+                    with self.assertRaises(WorkerInternalException):
+                        _run_experiment("StreamCrashExperiment")
+            finally:
+                os.chdir(cwd)
+            self.assertTrue(any("Partial results are kept" in line
+                                for line in logs.output))
+            # The results file is not written, but the file with the
+            # streamed datasets is kept.
+            filenames = glob.glob(os.path.join(tmpdir, "results", "*", "*",
+                                               "*"))
+            self.assertEqual([os.path.basename(f) for f in filenames],
+                             ["000000000-StreamCrashExperiment.h5.part"])
+            with h5py.File(filenames[0], "r") as f:
+                self.assertEqual(list(f["datasets"]["points"][()]),
+                                 list(range(100)))
+
+    def test_parent_action_stats(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                _run_experiment("ParentActionsExperiment",
+                                trace_parent_actions=True)
+            finally:
+                os.chdir(cwd)
+            filename, = glob.glob(os.path.join(tmpdir, "results", "*", "*",
+                                               "*.h5"))
+            with h5py.File(filename, "r") as f:
+                actions = f["parent_actions"]
+                self.assertEqual(actions["create_watchdog"]["count"][()], 3)
+                self.assertEqual(actions["delete_watchdog"]["count"][()], 3)
+                self.assertEqual(len(f["parent_action_trace"]["action"]), 6)
+                self.assertEqual(f["parent_action_trace"]["action"][0],
+                                 b"create_watchdog")
+
+    def test_examine_cache(self):
+        datasets = {"n": 5}
+        device_db = {"core": {"type": "local"}}
+        workers = []
+        def new_worker():
+            worker = Worker({"get_dataset": datasets.__getitem__,
+                             "get_device_db": lambda: device_db})
+            workers.append(worker)
+            return worker
+        cache = ExamineCache(datasets.__getitem__, lambda: device_db)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "examined.py")
+            with open(filename, "w") as f:
+                f.write(_examined_experiment)
+
+            def examine():
+                return self.loop.run_until_complete(
+                    cache.examine(new_worker, filename))
+            self.assertEqual(_get_default(examine(), "n"), 5)
+            self.assertEqual(_get_default(examine(), "m"), 2)
+            self.assertEqual(len(workers), 1)
+
+            datasets["n"] = 6
+            self.assertEqual(_get_default(examine(), "n"), 6)
+            # Creating a dataset that was missing also invalidates the entry.
+            datasets["m"] = 3
+            self.assertEqual(_get_default(examine(), "m"), 3)
+            examine()
+            self.assertEqual(len(workers), 3)
+
+            with open(filename, "a") as f:
+                f.write("\n")
+            examine()
+            self.assertEqual(len(workers), 4)
+
+            device_db = {"core": {"type": "dummy"}}
+            examine()
+            self.assertEqual(len(workers), 5)
+
+            self.loop.run_until_complete(
+                cache.examine(new_worker, filename, refresh=True))
+            self.assertEqual(len(workers), 6)
+            examine()
+            self.assertEqual(len(workers), 6)
+
     def tearDown(self):
         self.loop.close()
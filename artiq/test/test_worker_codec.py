@@ -0,0 +1,155 @@
+"""Tests and benchmark of the master-worker message encodings.
+
+The benchmark starts worker processes and is skipped unless the
+``ARTIQ_BENCHMARK`` environment variable is set.
+"""
+
+import unittest
+import asyncio
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from artiq.experiment import *
+from artiq.master.worker import Worker
+from artiq.master.worker_codec import codecs
+
+
+class DatasetRoundTrip(EnvExperiment):
+    def build(self):
+        pass
+
+    def run(self):
+        for i in range(self.get_dataset("n")):
+            value = self.get_dataset("payload", archive=False)
+            self.set_dataset("echo", value, broadcast=True, archive=False)
+
+
+class _Pipe:
+    # Returns at most 3 bytes per read, to exercise reassembly of frames.
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, n):
+        data, self.data = self.data[:min(n, 3)], self.data[min(n, 3):]
+        return data
+
+    def readline(self):
+        n = self.data.find(b"\n") + 1 or len(self.data)
+        data, self.data = self.data[:n], self.data[n:]
+        return data
+
+
+def _roundtrip(codec, obj):
+    data = b"".join(bytes(buf) for buf in codec.encode(obj))
+    return codec.read(_Pipe(data))
+
+
+class WorkerCodecCase(unittest.TestCase):
+    def test_roundtrip(self):
+        obj = {
+            "action": "update_dataset",
+            "mod": OrderedDict([
+                ("value", (True, np.arange(12.).reshape(3, 4)[:, ::2])),
+                ("nested", [1, {"a": np.array([True, False])}, "x"]),
+                ("empty", np.zeros((0, 3), dtype=np.int32)),
+                ("scalar", np.int64(3)),
+                ("complex", np.array([1+2j], dtype=np.complex64))
+            ])
+        }
+        for name, codec in codecs.items():
+            with self.subTest(codec=name):
+                decoded = _roundtrip(codec, obj)
+                mod = decoded["mod"]
+                self.assertIsInstance(mod, OrderedDict)
+                self.assertEqual(list(mod.keys()), list(obj["mod"].keys()))
+                self.assertIsInstance(mod["value"], tuple)
+                self.assertIs(mod["value"][0], True)
+                for k in "empty", "complex":
+                    np.testing.assert_equal(mod[k], obj["mod"][k])
+                    self.assertEqual(mod[k].dtype, obj["mod"][k].dtype)
+                np.testing.assert_equal(mod["value"][1],
+                                        obj["mod"]["value"][1])
+                np.testing.assert_equal(mod["nested"][1]["a"],
+                                        [True, False])
+                self.assertEqual(mod["nested"][2], "x")
+                self.assertEqual(mod["scalar"], 3)
+
+    def test_binary_arrays_writable(self):
+        array = _roundtrip(codecs["binary"], np.arange(4))
+        array[0] = 5
+        np.testing.assert_equal(array, [5, 1, 2, 3])
+
+    def test_truncated(self):
+        for name, codec in codecs.items():
+            with self.subTest(codec=name):
+                data = b"".join(bytes(buf)
+                                for buf in codec.encode(np.arange(4)))
+                with self.assertRaises(EOFError):
+                    codec.read(_Pipe(b""))
+                if name == "binary":
+                    with self.assertRaises(EOFError):
+                        codec.read(_Pipe(data[:-1]))
+
+
+artiq_benchmark = os.getenv("ARTIQ_BENCHMARK")
+
+
+@unittest.skipUnless(artiq_benchmark, "no ARTIQ_BENCHMARK")
+class WorkerCodecBenchmarkCase(unittest.TestCase):
+    def setUp(self):
+        if os.name == "nt":
+            self.loop = asyncio.ProactorEventLoop()
+        else:
+            self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def _run(self, codec, n, payload):
+        received = []
+        handlers = {
+            "get_dataset": {"n": n, "payload": payload}.__getitem__,
+            "update_dataset": lambda mod: received.append(mod["value"][1])
+        }
+        expid = {
+            "log_level": logging.WARNING,
+            "file": sys.modules[__name__].__file__,
+            "class_name": "DatasetRoundTrip",
+            "arguments": dict()
+        }
+        worker = Worker(handlers, codec=codec)
+        try:
+            await worker.build(0, "main", None, expid, 0)
+            await worker.prepare()
+            t0 = time.monotonic()
+            await worker.run()
+            t1 = time.monotonic()
+        finally:
+            await worker.close()
+        self.assertEqual(len(received), n)
+        np.testing.assert_equal(received[-1], payload)
+        return t1 - t0
+
+    def test_benchmark(self):
+        results = []
+        for size, n in (1, 1000), (200000, 5):
+            payload = np.arange(size, dtype=np.float64)
+            for codec in codecs:
+                t = self.loop.run_until_complete(self._run(codec, n, payload))
+                results.append((codec, payload.nbytes, 1e6*t/n,
+                                2*n*payload.nbytes/t/1e6))
+
+        lines = ["",
+                 "| Codec  | Array bytes | Round trip (us) | MB/s     |",
+                 "| ------ | ----------- | --------------- | -------- |"]
+        for codec, nbytes, latency, throughput in results:
+            lines.append("| {:6} | {:>11} | {:>15.0f} | {:>8.1f} |".format(
+                codec, nbytes, latency, throughput))
+        # Alongside the output of the test runner.
+        sys.stderr.write("\n".join(lines) + "\n")
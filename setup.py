@@ -26,6 +26,7 @@ console_scripts = [
     "artiq_ddb_template = artiq.frontend.artiq_ddb_template:main",
     "artiq_master = artiq.frontend.artiq_master:main",
     "artiq_mkfs = artiq.frontend.artiq_mkfs:main",
+    "artiq_results_catalog = artiq.frontend.artiq_results_catalog:main",
     "artiq_rtiomon = artiq.frontend.artiq_rtiomon:main",
     "artiq_sinara_tester = artiq.frontend.artiq_sinara_tester:main",
     "artiq_session = artiq.frontend.artiq_session:main",